@@ -1,5 +1,9 @@
 import os
-import shelve
+import struct
+import time
+import zlib
+
+import msgpack
 import redis
 import requests
 
@@ -17,7 +21,8 @@ from pytz import timezone
 
 from core.settings.base import GEOCODE_API_KEY, GEOCODE_URL
 from core.shortcuts import get_object_or_None
-from crea_parser.models import Geolocation, Property
+from crea_parser.models import Address, Geolocation, Property
+from crea_parser.submodels.metadata import PropertyPropertyType
 from django.contrib.gis.geos import Point
 
 from ddf_manager.ddf_logger import logger
@@ -60,7 +65,19 @@ class TaskLock(object):
             logger.error(f"Something went wrong with acquiring the lock with key of {self.key}.")
             logger.error(e)
 
-    def release_lock(self):
+    def get_token(self):
+        """Token of the acquired lock, lets another task release it with `release_lock(token)`."""
+
+        if self.lock and self.lock.local.token:
+            return self.lock.local.token.decode()
+        return None
+
+    def release_lock(self, token=None):
+        if token and not self.lock:
+            # Releasing a lock acquired by another task
+            self.lock = REDIS_CLIENT.lock(self.key, timeout=self.timeout)
+            self.lock.local.token = token.encode()
+
         if self.lock:
             self.lock.release()
             logger.info(f"Released a lock with a key of {self.key}.")
@@ -156,31 +173,72 @@ class HomeswiprMailer(object):
             return False
 
 
+class PackedRows(object):
+    """
+    A batch of rows packed by DiskCacheManager.pack_rows, ready to be written
+    """
+
+    def __init__(self, payload, ids):
+        self.payload = payload
+        # Listing id of every row, None for the rows without one
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+
 class DiskCacheManager(object):
     """
-    A dedicated class for disk cache, this should
-    make things easier to refactor in the future if
-    we want to implement a different implementation.
+    A dedicated class for disk cache, used to spill the fetched
+    listings to disk instead of keeping them in memory.
 
-    Currently using the python native shelfing which
-    should create a database file based on a dictinoary
+    Rows are appended to a single segment file as length prefixed,
+    zlib compressed msgpack batches:
+
+        [compressed size: uint32][rows count: uint32][zlib(msgpack(rows))]
+
+    An in memory index keeps the offset of every batch and the batch and
+    position of every listing id, so rows can be streamed in order with
+    one sequential read or looked up by listing id. The segment file is
+    only flushed (no fsync) on inserts, and since every batch carries its
+    own size a crashed sync can be resumed from the spilled data with
+    `resume_disk_cache`.
+
+    `pack_rows` builds a batch out of any iterable of rows, consuming one
+    row at a time, so a streamed RETS reply is packed as it is parsed
+    without the page ever being held as a list. It doesn't touch the file
+    and can be called from the page fetcher threads, the packed batch is
+    then appended by `insert_row_on_disk`.
 
     NOTE: Please make sure to close and ignore the file
     """
 
-    disk_cache = None
-    shelf_index = 0
-    # Keep count here to lessen things that we count
-    disk_cache_count = 0
+    BATCH_HEADER = struct.Struct(">II")
 
     # Default name for disk_cache
     # As much as possible, use a specifric name to avoid
     # corruption of a cache
     disk_cache_name = "disk_cache"
 
-    def __init__(self, disk_cache_name=None):
+    def __init__(self, disk_cache_name=None, id_key="ID"):
         if disk_cache_name:
             self.disk_cache_name = disk_cache_name
+        self.id_key = id_key
+
+        self.disk_cache = None
+        self._reset_index()
+
+    @property
+    def file_path(self):
+        return os.path.join(settings.PROJECT_PATH, f"{self.disk_cache_name}.seg")
+
+    def _reset_index(self):
+        # [(offset, size, rows count)] per batch
+        self.batches = []
+        # {listing id: (batch index, position in batch)}
+        self.listing_index = {}
+        # Keep count here to lessen things that we count
+        self.disk_cache_count = 0
 
     def initialize_disk_cache(self):
         """
@@ -189,58 +247,167 @@ class DiskCacheManager(object):
         """
 
         # Enssures that we get a fresh one everytime
+        self.close()
         self._remove_old_db()
+        self._reset_index()
 
-        self.disk_cache = shelve.open(f"{self.disk_cache_name}")
+        self.disk_cache = open(self.file_path, "w+b")
 
-        # More safety precaution
-        self.disk_cache.clear()
+    def resume_disk_cache(self):
+        """
+        Reopens the segment file left by a previous (crashed) run and
+        rebuilds the index from it. A batch that was only partially
+        written is truncated.
+        Returns the number of recovered rows.
+        """
+        self.close()
+        self._reset_index()
+
+        if not os.path.exists(self.file_path):
+            self.disk_cache = open(self.file_path, "w+b")
+            return 0
+
+        self.disk_cache = open(self.file_path, "r+b")
+        offset = 0
+        end = os.path.getsize(self.file_path)
+        while offset + self.BATCH_HEADER.size <= end:
+            self.disk_cache.seek(offset)
+            size, count = self.BATCH_HEADER.unpack(self.disk_cache.read(self.BATCH_HEADER.size))
+            if offset + self.BATCH_HEADER.size + size > end:
+                break
 
-    def insert_row_on_disk(self, value):
+            try:
+                rows = self._read_batch(offset, size)
+            except Exception as e:
+                logger.error(f"Corrupted disk cache batch at offset {offset}: {e}")
+                break
+            self._index_batch(offset, size, [self._get_row_id(row) for row in rows])
+            offset += self.BATCH_HEADER.size + size
+
+        if offset < end:
+            logger.warning(f"Truncating {end - offset} bytes of a partially written disk cache batch")
+            self.disk_cache.truncate(offset)
+
+        self.disk_cache.seek(0, os.SEEK_END)
+        logger.info(f"Resumed disk cache {self.disk_cache_name} with {self.disk_cache_count} rows")
+        return self.disk_cache_count
+
+    def pack_rows(self, rows):
         """
-        Insert a row on disk
+        Packs an iterable of rows (a list, a generator...) into a batch
+        for insert_row_on_disk, the rows are consumed one at a time
         """
-        if type(value) != list:
-            value = [value]
+        packer = msgpack.Packer(use_bin_type=True, default=str)
+        packed_rows = []
+        ids = []
+        for row in rows:
+            packed_rows.append(packer.pack(row))
+            ids.append(self._get_row_id(row))
 
-        self.disk_cache_count += len(value)
+        # Same bytes as msgpack.packb(list(rows))
+        payload = zlib.compress(packer.pack_array_header(len(packed_rows)) + b"".join(packed_rows), 1)
+        return PackedRows(payload, ids)
 
-        self.disk_cache[f"data-{self.shelf_index}"] = value
-        self.shelf_index += 1
-        self.disk_cache.sync()
+    def insert_row_on_disk(self, value):
+        """
+        Insert a row, a list of rows or a batch packed by pack_rows on disk
+        """
+        if isinstance(value, dict):
+            value = [value]
+        if not isinstance(value, PackedRows):
+            value = self.pack_rows(value)
+
+        self.disk_cache.seek(0, os.SEEK_END)
+        offset = self.disk_cache.tell()
+        self.disk_cache.write(self.BATCH_HEADER.pack(len(value.payload), len(value)))
+        self.disk_cache.write(value.payload)
+        self.disk_cache.flush()
+
+        self._index_batch(offset, len(value.payload), value.ids)
+
+    def _get_row_id(self, row):
+        if isinstance(row, dict):
+            return row.get(self.id_key)
+        return None
+
+    def _index_batch(self, offset, size, ids):
+        batch_index = len(self.batches)
+        self.batches.append((offset, size, len(ids)))
+        for position, row_id in enumerate(ids):
+            if row_id is not None:
+                self.listing_index[row_id] = (batch_index, position)
+        self.disk_cache_count += len(ids)
+
+    def _read_batch(self, offset, size):
+        self.disk_cache.seek(offset + self.BATCH_HEADER.size)
+        return msgpack.unpackb(zlib.decompress(self.disk_cache.read(size)), raw=False)
 
     def get_all_disk_saved_keys(self):
         """
         Get all disk saved keys
         """
-        # This might be specific to shelf implementation
-        # If we want to have a sql lite implementaion.
-        # Just return the keys of the row
-        return list(self.disk_cache.keys())
+        return [f"data-{index}" for index in range(len(self.batches))]
 
     def get_disk_row(self, key):
         """
         Get row based on a key passed
         """
-        return self.disk_cache[key]
+        offset, size, count = self.batches[int(str(key).rsplit("-", 1)[-1])]
+        return self._read_batch(offset, size)
+
+    def iter_rows(self):
+        """
+        Streams every saved row (list of listings) in insertion order
+        """
+        for offset, size, count in list(self.batches):
+            yield self._read_batch(offset, size)
+
+    def iter_listings(self):
+        """
+        Streams every saved listing in insertion order
+        """
+        for rows in self.iter_rows():
+            yield from rows
+
+    def get_listing_ids(self):
+        """
+        Get the ids of every saved listing without reading the rows
+        """
+        return list(self.listing_index.keys())
+
+    def get_listing(self, listing_id):
+        """
+        Get a single listing by its id, None if it wasn't saved
+        """
+        if listing_id not in self.listing_index:
+            return None
+        batch_index, position = self.listing_index[listing_id]
+        offset, size, count = self.batches[batch_index]
+        return self._read_batch(offset, size)[position]
+
+    def close(self):
+        if self.disk_cache is not None and not self.disk_cache.closed:
+            self.disk_cache.close()
 
     def wipe(self):
         """
         Closes and wipes everything on the memory
         for better storage management
         """
-        self.disk_cache.close()
+        self.close()
         self._remove_old_db()
+        self._reset_index()
 
     def _remove_old_db(self):
 
-        file_path = os.path.join(settings.PROJECT_PATH, f"{self.disk_cache_name}")
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
 
-        with_extension_path = os.path.join(settings.PROJECT_PATH, f"{self.disk_cache_name}.db")
-        if os.path.exists(with_extension_path):
-            os.remove(with_extension_path)
+        # Leftovers of the old shelve based disk cache
+        for extension in ("", ".db", ".dat", ".dir", ".bak"):
+            file_path = os.path.join(settings.PROJECT_PATH, f"{self.disk_cache_name}{extension}")
+            if os.path.exists(file_path):
+                os.remove(file_path)
 
 
 class FileAttachmentUploadManager(object):
@@ -369,6 +536,191 @@ class PropertyGeolocationManager(object):
             return False, made_the_request
 
 
+class AutoCompleteIndex(object):
+    """
+    Typeahead index of the distinct street addresses, communities and cities of the searchable
+    properties, with their listing counts.
+
+    Every kind is a redis sorted set with all the scores at 0, so a prefix is answered by a single
+    ZRANGEBYLEX without touching the property tables. Members are "normalized\x00display\x00count",
+    the index is rebuilt from the database after every DDF sync (homeswipr.tasks.rebuild_auto_complete_index).
+
+    A lexical scan only ranks its first `scan_limit` matches, which a prefix of one or two characters
+    easily exceeds. The prefixes up to `ranked_prefix_length` characters (and the empty one) get their own
+    sorted set of their `ranked_size` terms with the most listings, scored by listing count.
+    Longer prefixes are ranked among their first `scan_limit` lexical matches.
+    """
+
+    ADDRESS = "address"
+    COMMUNITY = "community"
+    CITY = "city"
+
+    KINDS = (ADDRESS, COMMUNITY, CITY)
+
+    key_prefix = "auto_complete"
+    separator = "\x00"
+
+    def __init__(self, client=None, scan_limit=500, batch_size=1000, ranked_prefix_length=2, ranked_size=100):
+        self.client = client or REDIS_CLIENT
+        # Lexical matches read per search, ranked by listing count
+        self.scan_limit = scan_limit
+        self.batch_size = batch_size
+        # Prefixes answered from their ranked set, and the terms kept per set (the largest page size)
+        self.ranked_prefix_length = ranked_prefix_length
+        self.ranked_size = ranked_size
+
+    def get_key(self, kind):
+        return f"{self.key_prefix}:{kind}"
+
+    def get_ranked_key(self, kind, prefix):
+        return f"{self.get_key(kind)}:ranked:{prefix}"
+
+    def get_ranked_prefixes_key(self, kind):
+        return f"{self.get_key(kind)}:ranked_prefixes"
+
+    def rank_prefixes(self, kind_terms):
+        """
+        Top terms of every short prefix, {prefix: {display: listing count}}
+        """
+        listing_counts = {}
+        for (normalized, display), listing_count in kind_terms.items():
+            for length in range(min(len(normalized), self.ranked_prefix_length) + 1):
+                prefix_counts = listing_counts.setdefault(normalized[:length], {})
+                prefix_counts[display] = max(prefix_counts.get(display, 0), listing_count)
+
+        return {
+            prefix: dict(sorted(prefix_counts.items(), key=lambda item: (-item[1], item[0]))[: self.ranked_size])
+            for prefix, prefix_counts in listing_counts.items()
+        }
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(text.split()).lower() if text else ""
+
+    def is_built(self):
+        return bool(self.client.exists(self.get_key("built_at")))
+
+    def collect_terms(self):
+        """
+        Counts the listings of every term, {kind: {(normalized, display): listing count}}
+        """
+        terms = {kind: {} for kind in self.KINDS}
+
+        def count(kind, normalized, display):
+            if normalized:
+                key = (normalized, display)
+                terms[kind][key] = terms[kind].get(key, 0) + 1
+
+        addresses = Address.objects.filter(
+            connected_property__search_index__property_type_pk__in=PropertyPropertyType.get_valid_property_type_as_list()
+        ).values_list("street_address", "address_line1", "city", "community_name")
+
+        for street_address, address_line1, city, community_name in addresses.iterator(chunk_size=self.batch_size):
+            city = " ".join(city.split())
+            street_address = " ".join(street_address.split()) or " ".join(address_line1.split())
+            display = f"{street_address}, {city}" if city else street_address
+
+            # Both spellings of the street lead to the same address
+            normalized_streets = {self.normalize(street_address), self.normalize(address_line1)}
+            for normalized in normalized_streets:
+                count(self.ADDRESS, normalized, display)
+
+            community_name = " ".join(community_name.split())
+            if community_name:
+                count(self.COMMUNITY, self.normalize(community_name), f"{community_name}, {city}" if city else community_name)
+            count(self.CITY, self.normalize(city), city)
+
+        return terms
+
+    def rebuild(self, terms=None):
+        """
+        Replaces the index, the sets are written to temporary keys then renamed in a single transaction
+        so the readers never see a half built index. Returns the number of terms per kind.
+        """
+        if terms is None:
+            terms = self.collect_terms()
+
+        counts = {}
+        ranked_prefixes = {}
+        pipeline = self.client.pipeline(transaction=False)
+        for kind in self.KINDS:
+            temporary_key = f"{self.get_key(kind)}:building"
+            pipeline.delete(temporary_key)
+            members = [
+                self.separator.join([normalized, display, str(listing_count)])
+                for (normalized, display), listing_count in terms.get(kind, {}).items()
+            ]
+            for index in range(0, len(members), self.batch_size):
+                pipeline.zadd(temporary_key, {member: 0 for member in members[index:index + self.batch_size]})
+            counts[kind] = len(members)
+
+            ranked_prefixes[kind] = self.rank_prefixes(terms.get(kind, {}))
+            for prefix, listing_counts in ranked_prefixes[kind].items():
+                temporary_key = f"{self.get_ranked_key(kind, prefix)}:building"
+                pipeline.delete(temporary_key)
+                pipeline.zadd(temporary_key, listing_counts)
+        pipeline.execute()
+
+        # Ranked sets of the previous build whose prefix is gone
+        stale_prefixes = {
+            kind: {prefix.decode() for prefix in self.client.smembers(self.get_ranked_prefixes_key(kind))}
+            - set(ranked_prefixes[kind])
+            for kind in self.KINDS
+        }
+
+        pipeline = self.client.pipeline(transaction=True)
+        for kind in self.KINDS:
+            if counts[kind]:
+                pipeline.rename(f"{self.get_key(kind)}:building", self.get_key(kind))
+            else:
+                pipeline.delete(self.get_key(kind))
+
+            for prefix in ranked_prefixes[kind]:
+                pipeline.rename(f"{self.get_ranked_key(kind, prefix)}:building", self.get_ranked_key(kind, prefix))
+            for prefix in stale_prefixes[kind]:
+                pipeline.delete(self.get_ranked_key(kind, prefix))
+            pipeline.delete(self.get_ranked_prefixes_key(kind))
+            if ranked_prefixes[kind]:
+                pipeline.sadd(self.get_ranked_prefixes_key(kind), *ranked_prefixes[kind])
+        pipeline.set(self.get_key("built_at"), int(time.time()))
+        pipeline.execute()
+
+        logger.info(f"Auto complete index rebuilt, terms per kind: {counts}")
+        return counts
+
+    def search(self, kind, prefix, limit=10):
+        """
+        Terms of `kind` starting with `prefix`, the ones with the most listings first
+        """
+        normalized = self.normalize(prefix)
+        if len(normalized) <= self.ranked_prefix_length and limit <= self.ranked_size:
+            ranked = [
+                (display.decode(), int(listing_count))
+                for display, listing_count in self.client.zrange(
+                    self.get_ranked_key(kind, normalized), 0, -1, withscores=True
+                )
+            ]
+            if ranked:
+                ranked.sort(key=lambda item: (-item[1], item[0]))
+                return [{"text": display, "listing_count": listing_count} for display, listing_count in ranked[:limit]]
+            # No ranked set, the prefix has no terms or the index predates them
+
+        normalized = normalized.encode()
+        start = b"[" + normalized if normalized else b"-"
+        end = b"[" + normalized + b"\xff" if normalized else b"+"
+
+        listing_counts = {}
+        for member in self.client.zrangebylex(self.get_key(kind), start, end, start=0, num=self.scan_limit):
+            try:
+                normalized_term, display, listing_count = member.decode().split(self.separator)
+            except ValueError:
+                continue
+            listing_counts[display] = max(listing_counts.get(display, 0), int(listing_count))
+
+        ranked = sorted(listing_counts.items(), key=lambda item: (-item[1], item[0]))
+        return [{"text": display, "listing_count": listing_count} for display, listing_count in ranked[:limit]]
+
+
 class TimezoneManager(object):
     """
     Custom class to localize timezone.
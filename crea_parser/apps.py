@@ -1,5 +1,20 @@
 from django.apps import AppConfig
+from django.db import connections
+from django.db.models.signals import pre_migrate
+
+
+def create_search_extensions(using, **kwargs):
+    # The trigram index of the PropertySearchIndex needs pg_trgm,
+    # created before the migrations run so a fresh database can build the index
+    connection = connections[using]
+    if connection.vendor != "postgresql":
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
 
 
 class CreaParserConfig(AppConfig):
     name = "crea_parser"
+
+    def ready(self):
+        pre_migrate.connect(create_search_extensions, sender=self)
@@ -0,0 +1,123 @@
+# Benchmark of the compiled field mappers against the per key DDFManagerTypeCasting dispatch
+import json
+import logging
+import os
+import time
+
+from core.shortcuts import convert_to_snakecase
+from core.utils import DiskCacheManager
+from crea_parser.utils import metadata_lookup_registry
+from ddf_manager.db_field_mapper import get_field_mapper
+from ddf_manager.db_mapping import (
+    DDFManagerTypeCasting,
+    building_children,
+    db_fields,
+    property_children,
+    rename_fields_dict,
+)
+from crea_parser.models import Building, Property, PropertyInfo
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+DEFAULT_FIXTURE = os.path.join(
+    settings.PROJECT_PATH, "crea_parser", "tests", "fixtures", "ddf_listings_sample.json"
+)
+
+
+def legacy_filter_fields(TABLE, input, field_name_and_internal_value, rename_fields):
+    # The per key dispatch filter_fields used before the compiled mappers
+    output = {}
+    m2m_output = {}
+    for key in input.keys():
+        snake_case_input_key = convert_to_snakecase(key)
+        if not input[key]:
+            continue
+        elif key in rename_fields or snake_case_input_key in field_name_and_internal_value.keys():
+            django_key = rename_fields.get(key, snake_case_input_key)
+            if django_key not in field_name_and_internal_value:
+                continue
+            internal_type = field_name_and_internal_value[django_key].get("internal_type", "")
+            casted = DDFManagerTypeCasting(TABLE, django_key, input[key], internal_type).type_cast_field()
+            if internal_type == "ManyToManyField":
+                m2m_output.update(casted)
+            else:
+                output.update(casted)
+    return output, m2m_output
+
+
+def get_mapping_jobs(listing):
+    # (model, db_fields table, record) for the records of a listing the writers map
+    jobs = [
+        (Property, db_fields["property_fields"], listing),
+        (PropertyInfo, db_fields["property_info_fields"], listing),
+    ]
+    children = list(property_children)
+    if isinstance(listing.get("Building"), dict):
+        jobs.append((Building, db_fields["building_fields"], listing["Building"]))
+        children += [
+            (item, itemClass, item_db_fields, single_element_dict, listing["Building"])
+            for (item, itemClass, item_db_fields, single_element_dict) in building_children
+        ]
+
+    for child in children:
+        item, itemClass, item_db_fields, single_element_dict = child[:4]
+        source = child[4] if len(child) > 4 else listing
+        if item not in source:
+            continue
+        table = source[item]
+        if isinstance(table, dict) and single_element_dict in table:
+            table = table[single_element_dict]
+        for record in table if isinstance(table, list) else [table]:
+            if isinstance(record, dict) and record:
+                jobs.append((itemClass, db_fields[item_db_fields], record))
+    return jobs
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the compiled DDF field mappers on a fixture of DDF listings"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fixture", default=DEFAULT_FIXTURE, help="JSON list of DDF listings")
+        parser.add_argument(
+            "--from-disk-cache",
+            action="store_true",
+            help="Use the listings spilled by the last fetch (fetch_listing_disk_cache) instead of the fixture",
+        )
+        parser.add_argument("--repeat", type=int, default=200, help="Passes over the listings")
+
+    def handle(self, *args, **options):
+        if options["from_disk_cache"]:
+            disk_cache = DiskCacheManager(disk_cache_name="fetch_listing_disk_cache")
+            disk_cache.resume_disk_cache()
+            listings = list(disk_cache.iter_listings())
+            disk_cache.close()
+        else:
+            with open(options["fixture"]) as fixture:
+                listings = json.load(fixture)
+
+        jobs = [job for listing in listings for job in get_mapping_jobs(listing)]
+        metadata_lookup_registry.ensure_loaded()
+
+        # Measure the mapping itself, not the log handlers
+        logging.disable(logging.CRITICAL)
+        try:
+            results = {}
+            for name, map_record in (
+                ("legacy", lambda model, table_fields, record: legacy_filter_fields(model, record, table_fields, rename_fields_dict)),
+                ("compiled", lambda model, table_fields, record: get_field_mapper(model, table_fields).map(record)),
+            ):
+                start = time.perf_counter()
+                for _ in range(options["repeat"]):
+                    outputs = [map_record(*job) for job in jobs]
+                elapsed = time.perf_counter() - start
+                results[name] = outputs
+                records = len(jobs) * options["repeat"]
+                self.stdout.write(
+                    f"{name:<9} {records / elapsed:10.0f} records/s "
+                    f"{len(listings) * options['repeat'] / elapsed:8.0f} listings/s ({elapsed:.2f}s)"
+                )
+        finally:
+            logging.disable(logging.NOTSET)
+
+        mismatches = sum(1 for legacy, compiled in zip(results["legacy"], results["compiled"]) if legacy != compiled)
+        self.stdout.write(f"{len(listings)} listings, {len(jobs)} records, {mismatches} mismatching outputs")
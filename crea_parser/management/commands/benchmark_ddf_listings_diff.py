@@ -0,0 +1,81 @@
+# Micro-benchmark of the master list reconciliation used by DDFClient.download_remaining_listings
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from ddf_manager.ddf_client.ddf_diff import diff_listings
+from django.core.management.base import BaseCommand
+
+LAST_UPDATED_FORMAT = "%a, %d %b %Y %H:%M:%S GMT"
+
+
+def legacy_diff(master_listings_keys, previous_listings_keys):
+    # The list based reconciliation diff_listings replaced
+    added = [key for key in master_listings_keys if key not in previous_listings_keys]
+    removed = [key for key in previous_listings_keys if key not in master_listings_keys]
+    return added, removed
+
+
+def build_listings(size, churn=0.02):
+    # Master list and db listings sharing all but `churn` of their ids
+    base = datetime(2020, 5, 1, tzinfo=timezone.utc)
+    ids = [str(20000000 + index) for index in range(size + int(size * churn))]
+    previous_ids = ids[: size]
+    master_ids = ids[int(size * churn) :]
+    random.shuffle(master_ids)
+
+    previous = {
+        listing_id: base + timedelta(seconds=index)
+        for index, listing_id in enumerate(previous_ids)
+    }
+    master_list = []
+    for listing_id in master_ids:
+        last_updated = previous.get(listing_id, base)
+        if random.random() < churn:
+            last_updated += timedelta(days=1)
+        master_list.append(
+            {"ID": listing_id, "LastUpdated": last_updated.strftime(LAST_UPDATED_FORMAT)}
+        )
+    return master_list, previous
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the master list reconciliation at several sizes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 500000])
+        parser.add_argument(
+            "--legacy-max-size",
+            type=int,
+            default=10000,
+            help="Largest size the quadratic list based diff is run for",
+        )
+
+    def handle(self, *args, **options):
+        for size in options["sizes"]:
+            master_list, previous = build_listings(size)
+            previous_keys = list(previous.keys())
+
+            start = time.perf_counter()
+            keys_diff = diff_listings(master_list, previous_keys)
+            keys_elapsed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            full_diff = diff_listings(master_list, previous)
+            full_elapsed = time.perf_counter() - start
+
+            self.stdout.write(
+                f"{size:>7} keys: ids only {keys_elapsed:7.3f}s "
+                f"({size / keys_elapsed:12.0f} keys/s), "
+                f"with LastUpdated {full_elapsed:7.3f}s ({size / full_elapsed:10.0f} keys/s) "
+                f"added={len(full_diff.added)} removed={len(full_diff.removed)} "
+                f"changed={len(full_diff.changed)}"
+            )
+
+            if size <= options["legacy_max_size"]:
+                master_keys = [record["ID"] for record in master_list]
+                start = time.perf_counter()
+                added, removed = legacy_diff(master_keys, previous_keys)
+                legacy_elapsed = time.perf_counter() - start
+                assert added == keys_diff.added and removed == keys_diff.removed
+                self.stdout.write(f"{size:>7} keys: legacy list diff {legacy_elapsed:7.3f}s")
@@ -0,0 +1,99 @@
+# Benchmark of the concurrent RETS page fetcher against a local stub RETS server
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import requests
+from ddf_manager.ddf_client.ddf_page_fetcher import PageFetcher
+from ddf_manager.rets_lib.parsers.search import OneXSearchCursor
+from django.core.management.base import BaseCommand
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def build_stub_page(records):
+    details = "".join(
+        f'<PropertyDetails ID="{index}" LastUpdated="Fri, 01 May 2020 00:00:00 GMT">'
+        f"<ListingID>{index}</ListingID><PublicRemarks>Stub listing {index}</PublicRemarks>"
+        f"<Address><StreetAddress>{index} Stub street</StreetAddress><City>Stubville</City></Address>"
+        "</PropertyDetails>"
+        for index in range(records)
+    )
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<RETS ReplyCode="0" ReplyText="Operation Successful">'
+        f'<COUNT Records="{records}" /><RETS-RESPONSE>{details}</RETS-RESPONSE></RETS>'
+    ).encode()
+
+
+def make_stub_handler(body, latency):
+    class StubRETSHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            # Simulates the round trip and processing time of the CREA server
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/xml")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return StubRETSHandler
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the DDF page fetcher (pages per second) against a local stub RETS server"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--pages", type=int, default=40)
+        parser.add_argument("--records", type=int, default=100, help="Records per page")
+        parser.add_argument("--latency", type=float, default=0.2, help="Stub server latency in seconds")
+        parser.add_argument(
+            "--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16]
+        )
+
+    def handle(self, *args, **options):
+        body = build_stub_page(options["records"])
+        server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), make_stub_handler(body, options["latency"])
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/search"
+
+        self.stdout.write(
+            f"{options['pages']} pages of {options['records']} records, "
+            f"{options['latency']}s stub latency"
+        )
+        try:
+            for concurrency in options["concurrency"]:
+                client = requests.Session()
+                fetcher = PageFetcher(concurrency=concurrency, retries=0)
+                fetcher.mount_pool(client)
+
+                def fetch(offset):
+                    response = client.get(url, params={"Offset": offset}, stream=True)
+                    result = OneXSearchCursor().stream_xml(response, "Property")
+                    return list(result["Data"]), result["Count"]
+
+                start = time.perf_counter()
+                records = 0
+                for offset, listings, count in fetcher.fetch_pages(
+                    fetch, range(options["pages"])
+                ):
+                    records += len(listings)
+                elapsed = time.perf_counter() - start
+                client.close()
+
+                self.stdout.write(
+                    f"concurrency={concurrency:<3} {options['pages'] / elapsed:8.2f} pages/s "
+                    f"{records / elapsed:10.1f} records/s ({elapsed:.2f}s)"
+                )
+        finally:
+            server.shutdown()
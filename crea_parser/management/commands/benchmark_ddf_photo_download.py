@@ -0,0 +1,89 @@
+# Benchmark of the pooled photo transfer engine against a local stub photo server
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import requests
+from ddf_manager.ddf_client.ddf_photo_transfer import PhotoTransfer
+from django.core.management.base import BaseCommand
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def make_stub_handler(body, latency):
+    class StubPhotoHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            # Simulates the round trip of the photo CDN
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return StubPhotoHandler
+
+
+def legacy_download(url, photo_path):
+    # The per photo download the handlers used before PhotoTransfer
+    with open(photo_path, "wb") as f:
+        f.write(requests.get(url).content)
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the photo downloads (photos per second) against a local stub photo server"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--photos", type=int, default=200)
+        parser.add_argument("--size", type=int, default=200, help="Photo size in KB")
+        parser.add_argument("--latency", type=float, default=0.05, help="Stub server latency in seconds")
+        parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8, 16])
+
+    def handle(self, *args, **options):
+        body = os.urandom(options["size"] * 1024)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), make_stub_handler(body, options["latency"]))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+        photos = options["photos"]
+
+        self.stdout.write(f"{photos} photos of {options['size']}KB, {options['latency']}s stub latency")
+        try:
+            with tempfile.TemporaryDirectory() as media_dir:
+                start = time.perf_counter()
+                for index in range(photos):
+                    legacy_download(f"{base_url}/{index}.jpg", os.path.join(media_dir, f"legacy-{index}.jpg"))
+                self.report("legacy", photos, len(body), time.perf_counter() - start)
+
+                for concurrency in options["concurrency"]:
+                    photo_transfer = PhotoTransfer(concurrency=concurrency, retries=0)
+                    start = time.perf_counter()
+                    for index in range(photos):
+                        photo_transfer.submit(
+                            index,
+                            photo_transfer.save_to_file,
+                            f"{base_url}/{index}.jpg",
+                            os.path.join(media_dir, f"{concurrency}-{index}.jpg"),
+                        )
+                    failed = photo_transfer.wait()
+                    elapsed = time.perf_counter() - start
+                    photo_transfer.close()
+                    self.report(f"concurrency={concurrency}", photos - len(failed), len(body), elapsed)
+        finally:
+            server.shutdown()
+
+    def report(self, name, photos, size, elapsed):
+        self.stdout.write(
+            f"{name:<16} {photos / elapsed:8.1f} photos/s {photos * size / elapsed / 1024 / 1024:8.1f} MB/s "
+            f"({elapsed:.2f}s)"
+        )
@@ -0,0 +1,111 @@
+# Latency benchmark of the keyword search of PropertyHelperMixin.filter_property_by_keyword.
+# Seeds synthetic listings in a transaction that is rolled back, nothing is left in the database.
+import random
+import statistics
+import time
+
+from crea_parser.models import Property, PropertySearchIndex
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from homeswipr.mixins import PropertyHelperMixin
+
+STREET_NAMES = [
+    "main", "king", "queen", "yonge", "bloor", "dundas", "college", "spadina", "bathurst", "church",
+    "jasper", "whyte", "macleod", "portage", "granville", "robson", "hastings", "cambie", "oak", "maple",
+]
+STREET_SUFFIXES = ["street", "avenue", "road", "drive", "crescent", "boulevard", "way", "lane"]
+CITIES = ["toronto", "calgary", "edmonton", "vancouver", "winnipeg", "ottawa", "halifax", "regina"]
+COMMUNITIES = ["riverside", "downtown", "westmount", "beltline", "kitsilano", "glenora", "annex", "crestwood"]
+
+# (label, keyword) pairs, a full address, a prefix typed as you go, a postal code, a typo and a community
+QUERIES = [
+    ("full address", "123 main street toronto"),
+    ("prefix", "123 mai"),
+    ("postal code", "m5v 2t6"),
+    ("typo", "123 mian street toronto"),
+    ("community", "beltline"),
+]
+
+
+def build_address_parts():
+    street_number = str(random.randint(1, 9999))
+    street_name = random.choice(STREET_NAMES)
+    street_suffix = random.choice(STREET_SUFFIXES)
+    city = random.choice(CITIES)
+    community = random.choice(COMMUNITIES)
+    postal_code = f"m{random.randint(1, 9)}v {random.randint(1, 9)}t{random.randint(1, 9)}"
+    return f"{street_number} {street_name} {street_suffix}", city, community, postal_code
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks the keyword search against the legacy ILIKE scan on synthetic listings, "
+        "the seeded listings are rolled back"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size", type=int, default=100000, help="Synthetic listings to seed")
+        parser.add_argument("--repeat", type=int, default=20, help="Runs of every query")
+
+    def seed(self, size):
+        properties = Property.objects.bulk_create(
+            [Property(ddf_id=f"bench-{index}", listing_id=f"B{index:08d}") for index in range(size)],
+            batch_size=5000,
+        )
+        rows = []
+        for property_obj in properties:
+            street_address, city, community, postal_code = build_address_parts()
+            rows.append(
+                PropertySearchIndex(
+                    connected_property_id=property_obj.pk,
+                    listing_id=property_obj.listing_id,
+                    city=city,
+                    community_name=community,
+                    search_document=" ".join(
+                        [property_obj.listing_id.lower(), street_address, city, community, postal_code]
+                    ),
+                )
+            )
+        PropertySearchIndex.objects.bulk_create(rows, batch_size=5000)
+        PropertySearchIndex.objects.filter(connected_property__ddf_id__startswith="bench-").update(
+            search_vector=PropertySearchIndex.get_search_vector()
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {PropertySearchIndex._meta.db_table}")
+
+    def time_query(self, queryset, repeat):
+        timings = []
+        count = 0
+        for _ in range(repeat):
+            start = time.perf_counter()
+            # A page of the list, like the paginated endpoints
+            count = len(list(queryset.values_list("pk", flat=True)[:20]))
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        return count, statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+    def handle(self, *args, **options):
+        search = PropertyHelperMixin()
+
+        with transaction.atomic():
+            start = time.perf_counter()
+            self.seed(options["size"])
+            self.stdout.write(f"Seeded {options['size']} listings in {time.perf_counter() - start:.1f}s")
+
+            base_queryset = Property.objects.filter(ddf_id__startswith="bench-")
+            for label, keyword in QUERIES:
+                legacy = base_queryset.filter(
+                    Q(search_index__search_document__icontains=keyword)
+                    | Q(search_index__city__icontains=keyword)
+                    | Q(search_index__community_name__icontains=keyword)
+                ).distinct()
+                engine = search.filter_property_by_keyword(base_queryset, keyword).order_by("-search_rank")
+
+                for name, queryset in (("legacy ilike", legacy), ("search engine", engine)):
+                    count, p50, p95 = self.time_query(queryset, options["repeat"])
+                    self.stdout.write(
+                        f"{label:>12} {name:>13}: p50 {p50:8.2f}ms p95 {p95:8.2f}ms ({count} results in the page)"
+                    )
+
+            transaction.set_rollback(True)
@@ -1,11 +1,28 @@
-from ddf_manager.db_summary import add_geolocation_all
+from ddf_manager.db_geocode import BatchGeocoder, backfill_coordinates
+from ddf_manager.settings import GEOCODE_BATCH_SIZE, GEOCODE_CONCURRENCY, GEOCODE_RATE_LIMIT
 from django.core.management.base import BaseCommand
 
-from crea_parser.tasks import fetch_ddf_listings
 
 class Command(BaseCommand):
-    help = "Reinitializes the geo location process"
+    help = "Geocodes the properties that are missing coordinates, resumes an interrupted run"
 
-    def handle(self, *args, **kwargs):
-        override = False
-        add_geolocation_all(override)
+    override = False
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=GEOCODE_BATCH_SIZE, help="Properties per chunk")
+        parser.add_argument("--concurrency", type=int, default=GEOCODE_CONCURRENCY, help="Geocoder requests in flight")
+        parser.add_argument(
+            "--rate-limit", type=float, default=GEOCODE_RATE_LIMIT, help="Geocoder requests per second, 0 to disable"
+        )
+        parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint of an interrupted run")
+
+    def handle(self, *args, **options):
+        counters = backfill_coordinates(
+            override=self.override,
+            chunk_size=options["chunk_size"],
+            restart=options["restart"],
+            geocoder=BatchGeocoder(options["concurrency"], options["rate_limit"]),
+            report=self.stdout.write,
+        )
+        self.stdout.write(f"Total geolocations added: {counters['geolocations_added']}")
+        self.stdout.write(f"Total geolocation requests: {counters['requests']}")
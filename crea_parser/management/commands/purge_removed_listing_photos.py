@@ -0,0 +1,23 @@
+from ddf_manager import manager as ddf_manager
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Deletes the photos of the listings that are no longer in the db"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report the photos and bytes that would be reclaimed",
+        )
+
+    def handle(self, *args, **options):
+        result = ddf_manager.purge_removed_photos(dry_run=options["dry_run"])
+        if result is None:
+            self.stderr.write("Failed to purge the removed listings photos, check the ddf logs")
+            return
+
+        objects_count, total_bytes = result
+        action = "Would reclaim" if options["dry_run"] else "Reclaimed"
+        self.stdout.write(f"{action} {objects_count} photos, {total_bytes / 1024 / 1024:.1f} MB")
@@ -0,0 +1,21 @@
+from crea_parser.models import Property, PropertySearchIndex
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the property search index of every active property, and removes the rows of the inactive ones"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=500, help="Properties per chunk")
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+
+        removed = PropertySearchIndex.remove(Property.objects.filter(is_active=False).values("pk"))
+        self.stdout.write(f"Removed {removed} rows of inactive properties")
+
+        property_ids = list(Property.active_objects.order_by("pk").values_list("pk", flat=True))
+        written = 0
+        for index in range(0, len(property_ids), chunk_size):
+            written += PropertySearchIndex.refresh(property_ids[index:index + chunk_size])
+            self.stdout.write(f"{written} of {len(property_ids)} rows rebuilt")
@@ -1,9 +1,7 @@
-from ddf_manager.db_summary import add_geolocation_all
-from django.core.management.base import BaseCommand
+from .find_missing_coordinates import Command as FindMissingCoordinatesCommand
 
 
-class Command(BaseCommand):
-    help = "Reinitializes the geo location process"
+class Command(FindMissingCoordinatesCommand):
+    help = "Reinitializes the geo location process, geocodes every property again"
 
-    def handle(self, *args, **kwargs):
-        add_geolocation_all()
+    override = True
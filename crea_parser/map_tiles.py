@@ -0,0 +1,140 @@
+import math
+import time
+
+from django.core.cache import cache
+
+##Geohash tiles of the map search.
+##Every PropertySearchIndex row stores the geohash of its coordinates, a geohash cell of precision p
+##is then a map tile, and the listings of a tile are the rows whose geohash starts with the cell.
+##Tile responses are cached per cell and a version per cell invalidates them, a listing change bumps
+##the versions of the cells of every precision containing it.
+
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# Precision of the geohash stored on the rows, about 4.8m x 4.8m
+GEOHASH_PRECISION = 9
+
+# Tile precision per map zoom level (index), the clusters are 2 precisions finer than their tile
+TILE_PRECISION_BY_ZOOM = [1, 1, 1, 1, 2, 2, 3, 3, 4, 4, 4, 5, 5, 5, 6, 6, 6, 7, 7, 7, 7]
+CLUSTER_PRECISION_OFFSET = 2
+
+# Largest tile precision of the map search, the versions of the finer cells aren't kept
+MAX_TILE_PRECISION = max(TILE_PRECISION_BY_ZOOM)
+
+# Zoom level from which individual pins are returned instead of clusters
+PINS_MIN_ZOOM = 15
+
+# Pins returned per tile at most
+MAX_PINS_PER_TILE = 500
+
+# Tiles of a bbox at most, a larger bbox is covered with coarser tiles
+MAX_TILES_PER_REQUEST = 64
+
+TILE_CACHE_TIMEOUT = 6 * 60 * 60
+TILE_VERSION_KEY = "map_tile_version:{cell}"
+
+
+def encode_geohash(latitude, longitude, precision=GEOHASH_PRECISION):
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(geohash) < precision:
+        if even:
+            middle = (lng_range[0] + lng_range[1]) / 2
+            if longitude >= middle:
+                bits = (bits << 1) | 1
+                lng_range[0] = middle
+            else:
+                bits = bits << 1
+                lng_range[1] = middle
+        else:
+            middle = (lat_range[0] + lat_range[1]) / 2
+            if latitude >= middle:
+                bits = (bits << 1) | 1
+                lat_range[0] = middle
+            else:
+                bits = bits << 1
+                lat_range[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(GEOHASH_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(geohash)
+
+
+def get_cell_size(precision):
+    """
+    Returns the (latitude, longitude) degrees of a cell of the precision
+    """
+    bits = precision * 5
+    lng_bits = math.ceil(bits / 2)
+    lat_bits = bits // 2
+    return 180.0 / (2 ** lat_bits), 360.0 / (2 ** lng_bits)
+
+
+def get_tile_precision(zoom):
+    return TILE_PRECISION_BY_ZOOM[max(0, min(int(zoom), len(TILE_PRECISION_BY_ZOOM) - 1))]
+
+
+def get_cluster_precision(tile_precision):
+    return min(tile_precision + CLUSTER_PRECISION_OFFSET, GEOHASH_PRECISION)
+
+
+def get_covering_cells(west, south, east, north, precision):
+    """
+    Geohash cells of the precision covering the bbox, coarser cells if it takes more than
+    MAX_TILES_PER_REQUEST. Returns (cells, precision).
+    """
+    south, north = max(-90.0, min(south, north)), min(90.0, max(south, north))
+    west, east = max(-180.0, min(west, east)), min(180.0, max(west, east))
+
+    while True:
+        lat_step, lng_step = get_cell_size(precision)
+        first_row = math.floor((south + 90.0) / lat_step)
+        last_row = min(math.floor((north + 90.0) / lat_step), int(180.0 / lat_step) - 1)
+        first_column = math.floor((west + 180.0) / lng_step)
+        last_column = min(math.floor((east + 180.0) / lng_step), int(360.0 / lng_step) - 1)
+
+        if precision > 1 and (last_row - first_row + 1) * (last_column - first_column + 1) > MAX_TILES_PER_REQUEST:
+            precision -= 1
+            continue
+
+        cells = []
+        for row in range(first_row, last_row + 1):
+            for column in range(first_column, last_column + 1):
+                # The center of the grid cell is encoded to the cell itself
+                cells.append(
+                    encode_geohash(
+                        -90.0 + (row + 0.5) * lat_step, -180.0 + (column + 0.5) * lng_step, precision
+                    )
+                )
+        return cells, precision
+
+
+def get_tile_versions(cells):
+    """
+    Returns {cell: version} of the cached responses of the cells
+    """
+    keys = {TILE_VERSION_KEY.format(cell=cell): cell for cell in cells}
+    versions = cache.get_many(list(keys.keys()))
+    return {cell: versions.get(key, 0) for key, cell in keys.items()}
+
+
+def invalidate_tiles(geohashes):
+    """
+    Bumps the versions of every tile containing the geohashes, their cached responses are then ignored
+    """
+    cells = set()
+    for geohash in geohashes:
+        if geohash:
+            cells.update(geohash[:precision] for precision in range(1, MAX_TILE_PRECISION + 1))
+    if not cells:
+        return
+
+    version = time.time_ns()
+    cache.set_many({TILE_VERSION_KEY.format(cell=cell): version for cell in cells}, timeout=None)
@@ -5,7 +5,7 @@ from ddf_manager.settings import CREA_LOGIN_URL, CREA_USERNAME, CREA_PASSWORD
 from ddf_manager.rets_lib.session import Session
 from ddf_manager.ddf_logger import logger
 
-from core.shortcuts import get_object_or_None, convert_to_snakecase
+from core.shortcuts import convert_to_snakecase
 
 
 class CreaModelBaseMetaDataManager(object):
@@ -50,26 +50,10 @@ class CreaModelBaseMetaDataManager(object):
     @classmethod
     def _metadata_to_dict(cls, response):
         # parse metadata into a dictionary, (homeswipr natural fields)
-
-        # Parse data
-        dict_xml = xmltodict.parse(response.text)
-
-        raw_lookup = []
-
-        try:
-            raw_lookup = dict_xml.get('RETS').get('METADATA').get('METADATA-LOOKUP_TYPE').get('LookupType')
-        except Exception as e:
+        lookups = parse_lookup_types(response)
+        if not lookups:
             logger.error(f"Something went wrong with parsing on the lookup {cls._get_metadata_general_name()}")
-            logger.error(f"The error status {e}")
-            logger.error(f"raw lookup data {dict_xml}")
-
-        logger.debug(f"Got a raw look up of {raw_lookup}!")
-
-        final_list = []
-
-        for item in raw_lookup:
-            final_list.append(dict(item))
-        return final_list
+        return lookups.get(cls.lookup_name) or next(iter(lookups.values()), [])
 
     @classmethod
     def _get_keys_length(cls):
@@ -85,27 +69,29 @@ class CreaModelBaseMetaDataManager(object):
         return params
 
     @classmethod
-    def fetch_and_update_metadata(cls):
+    def update_metadata(cls, data):
         """
-        Process metadata to insert it into our database
+        Inserts the fetched entries missing from the table, with one existence query and one bulk_create.
+        Returns (inserted count, completed_without_a_hitch)
         """
 
-        logger.info(f"Starting fetch and update metadata resource {cls._get_metadata_general_name()} located on the class {cls.__name__}")
-
         # Something is concenring about the request
         completed_without_a_hitch = True
 
         # Base only intercepts 4 fields, long value, value, metadata_entry_id, and short value
         number_of_expected_mapped_fields = cls._get_keys_length()
 
-        data = cls._fetch_metadata()
-
         if not data:
             completed_without_a_hitch = False
 
+        existing_ids = set(
+            cls.active_objects.filter(
+                metadata_entry_id__in=[item.get("MetadataEntryID", "") for item in data]
+            ).values_list("metadata_entry_id", flat=True)
+        )
+
+        to_create = []
         for item in data:
-            logger.debug(f"Found item: {item}")
-            exists = get_object_or_None(cls.active_objects, metadata_entry_id=item.get('MetadataEntryID', ""))
             metadata_entry_id = item.get("MetadataEntryID", "")
             short_val = item.get("ShortValue", "")
 
@@ -119,26 +105,25 @@ class CreaModelBaseMetaDataManager(object):
                 )
                 completed_without_a_hitch = False
 
-            if not exists and metadata_entry_id != -1:
-                try:
-                    params = cls._map_fields(item)
-                    instance = cls(**params)
-                    instance.save()
-                    logger.info(
-                        f"Inserted a metadata from resource {cls._get_metadata_general_name()} with a MetadataEntryId of {metadata_entry_id} and value of {short_val}"
-                    )
-                except Exception as e:
-                    logger.error(
-                        f"Something went wrong on trying to insert on {cls._get_metadata_general_name()} with an error of {e}"
-                    )
-                    logger.error(
-                        f"Item value contains: {item}"
-                    )
-                    completed_without_a_hitch = False
-            else:
-                logger.info(
-                    f"Skipping a metadata from resource {cls._get_metadata_general_name()} with a MetadataEntryId of {metadata_entry_id} and value of {short_val} due to it already existing"
-                )
+            if metadata_entry_id in existing_ids or not metadata_entry_id:
+                continue
+            # Duplicated entries of the response are only inserted once
+            existing_ids.add(metadata_entry_id)
+            to_create.append(cls(**cls._map_fields(item)))
+
+        try:
+            cls.objects.bulk_create(to_create)
+        except Exception as e:
+            logger.error(
+                f"Something went wrong on trying to insert on {cls._get_metadata_general_name()} with an error of {e}"
+            )
+            return 0, False
+
+        if to_create:
+            logger.info(
+                f"Inserted {len(to_create)} metadata from resource {cls._get_metadata_general_name()}, "
+                f"skipped {len(data) - len(to_create)} already existing"
+            )
 
         if completed_without_a_hitch == False:
             # Logs as critical if the metadata is not inserted properly,
@@ -147,4 +132,41 @@ class CreaModelBaseMetaDataManager(object):
                 f"Something is wrong with inserting the {cls._get_metadata_general_name()} metadata! please check the logs for more information"
             )
 
+        return len(to_create), completed_without_a_hitch
+
+    @classmethod
+    def fetch_and_update_metadata(cls):
+        """
+        Process metadata to insert it into our database
+        """
+
+        logger.info(f"Starting fetch and update metadata resource {cls._get_metadata_general_name()} located on the class {cls.__name__}")
+
+        inserted_count, completed_without_a_hitch = cls.update_metadata(cls._fetch_metadata())
         return completed_without_a_hitch
+
+
+def parse_lookup_types(response):
+    """
+    Parses a METADATA-LOOKUP_TYPE response, of one lookup or of every lookup of a resource (Resource:*).
+    Returns {lookup name: list of entries dict}
+    """
+    dict_xml = xmltodict.parse(response.text)
+
+    lookups = {}
+    try:
+        lookup_types = dict_xml.get("RETS").get("METADATA").get("METADATA-LOOKUP_TYPE")
+        if isinstance(lookup_types, dict):
+            lookup_types = [lookup_types]
+
+        for lookup_type in lookup_types or []:
+            entries = lookup_type.get("LookupType") or []
+            if isinstance(entries, dict):
+                # Lookup with a single entry
+                entries = [entries]
+            lookups[lookup_type.get("@Lookup", "")] = [dict(entry) for entry in entries]
+    except Exception as e:
+        logger.error(f"The error status {e}")
+        logger.error(f"raw lookup data {dict_xml}")
+
+    return lookups
@@ -1,4 +1,5 @@
 import decimal
+import re
 
 from core.models import CommonInfo
 from core.shortcuts import get_object_or_None
@@ -7,9 +8,14 @@ from ddf_manager.ddf_logger import logger
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericRelation
 from django.contrib.gis.db import models as geomodels
-from django.db import models
+from django.contrib.postgres.fields import ArrayField, JSONField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchQuery, SearchVector, SearchVectorField
+from django.db import models, transaction
+from django.utils import timezone
 from model_utils import FieldTracker
 
+from crea_parser.map_tiles import encode_geohash, invalidate_tiles
 from crea_parser.submodels.metadata import (PropertyAccessType, PropertyAmenity, PropertyAmenityNearby, PropertyAmperage,
     PropertyAppliance, PropertyArchitecturalStyle, PropertyBasementDevelopment, PropertyBasementFeature, PropertyBasementType,
     PropertyBoard, PropertyBuildingType, PropertyBusinessSubType, PropertyBusinessType, PropertyCeilingType, PropertyClearCeilingHeight,
@@ -1409,6 +1415,26 @@ class PropertyPhoto(ConnectedToPropertyBaseModel):
         ]
 
 
+class PhotoDigest(CommonInfo):
+    """
+    Content hash of a stored listing/agent photo, keyed by its storage path (S3 key or local path).
+    Used by the ddf manager photo transfers to skip identical bytes, send conditional requests
+    and reuse identical photos across listings.
+    """
+
+    listing_key = models.CharField(max_length=64, db_index=True)
+    storage_key = models.CharField(max_length=255, unique=True)
+    digest = models.CharField(max_length=64, db_index=True)  # sha256 hex digest
+    size = models.PositiveIntegerField(default=0)
+
+    # Validators of the source response, sent back as If-None-Match/If-Modified-Since
+    etag = models.TextField(blank=True)
+    last_modified = models.TextField(blank=True)
+
+    def __str__(self, *args, **kwargs):
+        return self.storage_key
+
+
 class Land(ConnectedToPropertyBaseModel):
 
     size_total = models.DecimalField(
@@ -1767,6 +1793,340 @@ class Geolocation(ConnectedToPropertyBaseModel):
             return "No longitude"
 
 
+class GeocodedAddress(CommonInfo):
+    """
+    Geocoder cache, the coordinates of a normalized address.
+    A row without coordinates is an address the geocoder didn't find.
+    """
+
+    normalized_address = models.TextField(unique=True)
+    coordinates = geomodels.PointField(blank=True, null=True)
+
+    def __str__(self, *args, **kwargs):
+        return self.normalized_address
+
+
+class PropertySearchIndex(CommonInfo):
+    """
+    Flattened copy of the searchable fields of an active property, one row per listing.
+    The advance search filters this single table instead of joining the property children,
+    the rows are rebuilt by the ddf manager writers and the agent property endpoints (see refresh).
+    """
+
+    connected_property = models.OneToOneField(
+        Property, on_delete=models.CASCADE, related_name="search_index"
+    )
+    listing_id = models.CharField(max_length=225, blank=True, db_index=True)
+
+    # PropertyInfo.listing_type
+    listing_type = models.SmallIntegerField(null=True, blank=True)
+
+    # The price, or the lease of a rental
+    general_price = models.DecimalField(
+        max_digits=102, decimal_places=2, null=True, blank=True, db_index=True
+    )
+    bedrooms_total = models.SmallIntegerField(null=True, blank=True, db_index=True)
+    bathroom_total = models.SmallIntegerField(null=True, blank=True, db_index=True)
+
+    city = models.TextField(blank=True)
+    community_name = models.TextField(blank=True)
+    neighbourhood = models.TextField(blank=True)
+    subdivision = models.TextField(blank=True)
+
+    # Primary key of the PropertyPropertyType, the other ids are crea metadata entry ids
+    property_type_pk = models.IntegerField(null=True, blank=True, db_index=True)
+    transaction_type_entry_id = models.CharField(max_length=255, blank=True, db_index=True)
+    ownership_type_entry_id = models.CharField(max_length=255, blank=True)
+    building_type_entry_ids = ArrayField(models.CharField(max_length=255), default=list, blank=True)
+    basement_type_entry_ids = ArrayField(models.CharField(max_length=255), default=list, blank=True)
+    basement_feature_entry_ids = ArrayField(models.CharField(max_length=255), default=list, blank=True)
+    architectural_style_entry_ids = ArrayField(models.CharField(max_length=255), default=list, blank=True)
+
+    # Primary keys of the PropertyParkingType
+    parking_type_pks = ArrayField(models.IntegerField(), default=list, blank=True)
+
+    zoning_description = models.TextField(blank=True)
+    constructed_year = models.SmallIntegerField(null=True, blank=True)
+
+    size_total = models.DecimalField(max_digits=50, decimal_places=2, null=True, blank=True)
+    size_frontage = models.DecimalField(max_digits=50, decimal_places=2, null=True, blank=True)
+    size_total_text = models.TextField(blank=True)
+    size_total_unit_entry_id = models.CharField(max_length=255, blank=True)
+
+    photo_count = models.PositiveIntegerField(default=0)
+    has_video = models.BooleanField(default=False)
+    coordinates = geomodels.PointField(blank=True, null=True)
+
+    # Copies of the coordinates for the map search, the geohash prefixes are the map tiles (see crea_parser.map_tiles)
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+    geohash = models.CharField(max_length=12, blank=True, db_index=True)
+
+    creation_date = models.DateTimeField(blank=True, null=True, db_index=True)
+    listing_contract_date = models.DateTimeField(blank=True, null=True, db_index=True)
+    last_updated = models.DateTimeField(blank=True, null=True)
+
+    # Lower cased listing id and address parts, matched by substring and trigram similarity
+    search_document = models.TextField(blank=True)
+
+    # Full text document, the address (weight A) and the public remarks (weight C)
+    search_vector = SearchVectorField(null=True, blank=True)
+
+    # Text search configuration of the vector and the queries, addresses aren't stemmed
+    SEARCH_CONFIG = "simple"
+
+    class Meta:
+        verbose_name_plural = "Property Search Index"
+        indexes = [
+            GinIndex(fields=["building_type_entry_ids"]),
+            GinIndex(fields=["basement_type_entry_ids"]),
+            GinIndex(fields=["basement_feature_entry_ids"]),
+            GinIndex(fields=["architectural_style_entry_ids"]),
+            GinIndex(fields=["parking_type_pks"]),
+            GinIndex(fields=["search_vector"]),
+            # Needs the pg_trgm extension, created by crea_parser.apps on pre_migrate
+            GinIndex(
+                fields=["search_document"],
+                name="search_index_document_trgm",
+                opclasses=["gin_trgm_ops"],
+            ),
+        ]
+
+    def __str__(self, *args, **kwargs):
+        return f"Search index of {self.listing_id}"
+
+    @staticmethod
+    def _get_child(instance, related_name):
+        # Reverse one to one accessors raise when the child is missing
+        try:
+            return getattr(instance, related_name)
+        except models.ObjectDoesNotExist:
+            return None
+
+    @classmethod
+    def build_row(cls, property_obj, parking_type_pks=None, photo_count=0):
+        """
+        Builds the unsaved row of a property fetched with select_related/prefetch_related (see refresh)
+        """
+        row = cls(
+            connected_property_id=property_obj.pk,
+            listing_id=property_obj.listing_id,
+            creation_date=property_obj.creation_date,
+            last_updated=property_obj.last_updated,
+            parking_type_pks=sorted(parking_type_pks or []),
+            photo_count=photo_count,
+        )
+
+        address = cls._get_child(property_obj, "Address")
+        if address:
+            row.city = address.city
+            row.community_name = address.community_name
+            row.neighbourhood = address.neighbourhood
+            row.subdivision = address.subdivision
+        row.search_document = cls.build_search_document(property_obj.listing_id, address)
+
+        info = cls._get_child(property_obj, "Info")
+        if info:
+            row.listing_type = info.listing_type
+            row.general_price = info.price if info.price is not None else info.lease
+            row.property_type_pk = info.property_type_id
+            row.transaction_type_entry_id = info.transaction_type.metadata_entry_id if info.transaction_type else ""
+            row.ownership_type_entry_id = info.ownership_type.metadata_entry_id if info.ownership_type else ""
+            row.zoning_description = info.zoning_description or ""
+            row.listing_contract_date = info.listing_contract_date
+
+        building = cls._get_child(property_obj, "Building")
+        if building:
+            row.bedrooms_total = building.bedrooms_total
+            row.bathroom_total = building.bathroom_total
+            row.constructed_year = building.constructed_date.year if building.constructed_date else None
+            row.building_type_entry_ids = [item.metadata_entry_id for item in building.model_type.all()]
+            row.basement_type_entry_ids = [item.metadata_entry_id for item in building.basement_type.all()]
+            row.basement_feature_entry_ids = [item.metadata_entry_id for item in building.basement_features.all()]
+            row.architectural_style_entry_ids = [item.metadata_entry_id for item in building.architectural_style.all()]
+
+        land = cls._get_child(property_obj, "land")
+        if land:
+            row.size_total = land.size_total
+            row.size_frontage = land.size_frontage
+            row.size_total_text = land.size_total_text
+            row.size_total_unit_entry_id = land.size_total_unit.metadata_entry_id if land.size_total_unit else ""
+
+        alternate_url = cls._get_child(property_obj, "alternate_url")
+        row.has_video = bool(alternate_url and alternate_url.video_link)
+
+        geolocation = cls._get_child(property_obj, "Geo")
+        if geolocation:
+            row.set_coordinates(geolocation.coordinates)
+
+        return row
+
+    def set_coordinates(self, coordinates):
+        self.coordinates = coordinates
+        if coordinates:
+            self.latitude = coordinates.y
+            self.longitude = coordinates.x
+            self.geohash = encode_geohash(coordinates.y, coordinates.x)
+        else:
+            self.latitude = None
+            self.longitude = None
+            self.geohash = ""
+
+    @staticmethod
+    def _get_row_state(row):
+        # Values of the row served by the map search, the dates and the computed vector aren't compared
+        return tuple(
+            field.value_from_object(row)
+            for field in row._meta.concrete_fields
+            if field.name not in ("id", "date_created", "date_updated", "search_vector")
+        )
+
+    @staticmethod
+    def _invalidate_map_tiles(geohashes):
+        # After the commit, a tile cached before it would be stale again
+        geohashes = set(geohashes)
+        if geohashes:
+            transaction.on_commit(lambda: invalidate_tiles(geohashes))
+
+    @classmethod
+    def refresh(cls, property_ids):
+        """
+        Rebuilds the rows of the given properties with a fixed number of queries,
+        the rows of the inactive or missing properties are removed.
+        Returns the number of rows written.
+        """
+        property_ids = list(set(property_ids))
+        if not property_ids:
+            return 0
+
+        properties = (
+            Property.active_objects.filter(pk__in=property_ids)
+            .select_related(
+                "Address", "Info", "Info__transaction_type", "Info__ownership_type",
+                "Building", "land", "land__size_total_unit", "alternate_url", "Geo",
+            )
+            .prefetch_related(
+                "Building__model_type", "Building__basement_type",
+                "Building__basement_features", "Building__architectural_style",
+            )
+        )
+
+        parking_type_pks = {}
+        for property_id, parking_type_pk in Parking.objects.filter(
+            connected_property__in=property_ids, name__isnull=False
+        ).values_list("connected_property_id", "name_id"):
+            parking_type_pks.setdefault(property_id, set()).add(parking_type_pk)
+
+        photo_counts = dict(
+            PropertyPhoto.objects.filter(connected_property__in=property_ids)
+            .values("connected_property_id")
+            .annotate(count=models.Count("pk"))
+            .values_list("connected_property_id", "count")
+        )
+
+        rows = [
+            cls.build_row(
+                property_obj,
+                parking_type_pks.get(property_obj.pk),
+                photo_counts.get(property_obj.pk, 0),
+            )
+            for property_obj in properties
+        ]
+
+        with transaction.atomic():
+            old_rows = {
+                row.connected_property_id: row
+                for row in cls.objects.filter(connected_property__in=property_ids).defer("search_vector")
+            }
+            cls.objects.filter(connected_property__in=property_ids).delete()
+            cls.objects.bulk_create(rows, batch_size=500)
+            cls.objects.filter(connected_property__in=property_ids).update(
+                search_vector=cls.get_search_vector()
+            )
+
+            # Only the tiles of the listings that changed are invalidated
+            changed_geohashes = []
+            new_rows = {row.connected_property_id: row for row in rows}
+            for property_id in property_ids:
+                old_row, new_row = old_rows.get(property_id), new_rows.get(property_id)
+                if old_row and new_row and cls._get_row_state(old_row) == cls._get_row_state(new_row):
+                    continue
+                changed_geohashes += [row.geohash for row in (old_row, new_row) if row]
+            cls._invalidate_map_tiles(changed_geohashes)
+
+        return len(rows)
+
+    @staticmethod
+    def build_search_document(listing_id, address=None):
+        parts = [listing_id]
+        if address:
+            parts += [
+                address.street_address, address.address_line1, address.address_line2,
+                address.street_number, address.street_direction_prefix, address.street_name,
+                address.street_suffix, address.street_direction_suffix, address.unit_number,
+                address.box_number, address.city, address.province, address.postal_code,
+                address.community_name, address.neighbourhood, address.subdivision,
+            ]
+        return " ".join(" ".join(part.split()) for part in parts if part).lower()
+
+    @classmethod
+    def get_search_vector(cls):
+        """
+        Vector expression of the rows, computed by the database on update.
+        The remarks are read from the PropertyInfo, they aren't copied on the row.
+        """
+        remarks = PropertyInfo.objects.filter(
+            connected_property=models.OuterRef("connected_property")
+        ).values("public_remarks")[:1]
+        return SearchVector("search_document", weight="A", config=cls.SEARCH_CONFIG) + SearchVector(
+            models.Subquery(remarks, output_field=models.TextField()), weight="C", config=cls.SEARCH_CONFIG
+        )
+
+    @classmethod
+    def get_keyword_search(cls, search_text):
+        """
+        Returns the (prefix SearchQuery, normalized text) of a keyword, None if nothing searchable was typed.
+        Every word of the keyword has to prefix a word of the document, so the results narrow down as the user types.
+        """
+        text = " ".join(search_text.split()).lower() if search_text else ""
+        words = re.findall(r"[^\W_]+", text)
+        if not words:
+            return None
+        query = SearchQuery(
+            " & ".join(f"{word}:*" for word in words), search_type="raw", config=cls.SEARCH_CONFIG
+        )
+        return query, text
+
+    @classmethod
+    def remove(cls, property_ids):
+        """
+        Removes the rows of the given properties, property_ids can be a queryset
+        """
+        with transaction.atomic():
+            rows = cls.objects.filter(connected_property__in=property_ids)
+            cls._invalidate_map_tiles(rows.exclude(geohash="").values_list("geohash", flat=True))
+            return rows.delete()[0]
+
+    @classmethod
+    def update_coordinates(cls, coordinates_by_property):
+        """
+        Writes {property id: Point} to the existing rows, used by the geocoder
+        """
+        rows = list(cls.objects.filter(connected_property__in=list(coordinates_by_property.keys())))
+        now = timezone.now()
+        geohashes = []
+        for row in rows:
+            geohashes.append(row.geohash)
+            row.set_coordinates(coordinates_by_property[row.connected_property_id])
+            row.date_updated = now
+            geohashes.append(row.geohash)
+        with transaction.atomic():
+            cls.objects.bulk_update(
+                rows, ["coordinates", "latitude", "longitude", "geohash", "date_updated"], batch_size=500
+            )
+            cls._invalidate_map_tiles(geohash for geohash in geohashes if geohash)
+
+
 class DDF_LastUpdate(CommonInfo):
 
     # NOTE: Fields are still camel case due to how parser inserts the field.
@@ -1777,3 +2137,91 @@ class DDF_LastUpdate(CommonInfo):
 
     def __str__(self, *args, **kwargs):
         return f"{self.LastUpdate}"
+
+
+class SyncRun(CommonInfo):
+    """
+    Checkpoints of a DDF sync (crea_parser.tasks.fetch_ddf_listings).
+    Every stage records its progress as it goes, so a sync interrupted by a worker restart
+    or the task lock timeout resumes at its last completed page or shard instead of starting over.
+    """
+
+    STATUS_RUNNING = "running"
+    STATUS_COMPLETED = "completed"
+    STATUS_FAILED = "failed"
+
+    STATUS_CHOICES = (
+        (STATUS_RUNNING, "Running"),
+        (STATUS_COMPLETED, "Completed"),
+        (STATUS_FAILED, "Failed"),
+    )
+
+    # In order, `stage` is the stage in progress
+    STAGE_ACTIVE_PAGES = "active_pages"
+    STAGE_MASTER_LIST = "master_list"
+    STAGE_BY_ID_PAGES = "by_id_pages"
+    STAGE_WRITE = "write"
+    STAGE_REMOVALS = "removals"
+
+    STAGE_CHOICES = (
+        (STAGE_ACTIVE_PAGES, "Active pages fetch"),
+        (STAGE_MASTER_LIST, "Master list"),
+        (STAGE_BY_ID_PAGES, "By ID pages fetch"),
+        (STAGE_WRITE, "Records or shards write"),
+        (STAGE_REMOVALS, "Removals"),
+    )
+
+    STAGES = [stage for stage, name in STAGE_CHOICES]
+
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_RUNNING, db_index=True)
+    stage = models.CharField(max_length=32, choices=STAGE_CHOICES, default=STAGE_ACTIVE_PAGES)
+    fetch_and_update_every_single_record = models.BooleanField(default=False)
+
+    # Time stamps of the fetch, kept as is when the run is resumed
+    last_update = models.TextField(blank=True)
+    new_last_update = models.TextField(blank=True)
+
+    # Active listings since last_update, and the offset of the next page to fetch
+    active_count = models.IntegerField(default=0)
+    active_next_offset = models.IntegerField(default=0)
+
+    master_count = models.IntegerField(default=0)
+    by_id_count = models.IntegerField(default=0)
+    by_id_downloaded = models.IntegerField(default=0)
+
+    removed_listings = JSONField(default=list, blank=True)
+    shards = JSONField(default=list, blank=True)
+    shards_written = JSONField(default=list, blank=True)
+
+    resumed_count = models.PositiveIntegerField(default=0)
+    completed_at = models.DateTimeField(blank=True, null=True)
+    error = models.TextField(blank=True)
+
+    def __str__(self, *args, **kwargs):
+        return f"Sync run {self.pk} ({self.status}, {self.stage})"
+
+    def is_done(self, stage):
+        """
+        Returns True if the stage was completed
+        """
+        return self.STAGES.index(self.stage) > self.STAGES.index(stage)
+
+    def checkpoint(self, stage=None, **progress):
+        """
+        Saves the progress fields, and moves the run to `stage` if given
+        """
+        if stage is not None:
+            progress["stage"] = stage
+        for field, value in progress.items():
+            setattr(self, field, value)
+        self.save(update_fields=list(progress.keys()) + ["date_updated"])
+
+    def complete(self):
+        self.status = self.STATUS_COMPLETED
+        self.completed_at = timezone.now()
+        self.save(update_fields=["status", "completed_at", "date_updated"])
+
+    def fail(self, error=""):
+        self.status = self.STATUS_FAILED
+        self.error = str(error)
+        self.save(update_fields=["status", "error", "date_updated"])
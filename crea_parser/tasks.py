@@ -1,30 +1,28 @@
+from celery import chord
 from core.celery import app
 from core.settings.base import FETCH_CREA_SAMPLE
 from ddf_manager import manager as ddf_manager
+from ddf_manager.db_geocode import geocode_properties
+from ddf_manager.db_sharded_write import write_shard
+from ddf_manager.settings import INGEST_SHARDS
 
 from core.utils import TaskLock
 
 from ddf_manager.ddf_logger import logger
 
 
-from crea_parser.submodels.metadata import metadata_models
-from homeswipr.tasks import pre_warm_endpoints, email_user_from_saved_search
+from crea_parser.models import SyncRun
+from crea_parser.utils import metadata_refresher
+from homeswipr.tasks import pre_warm_endpoints, email_user_from_saved_search, rebuild_auto_complete_index
 
 def fetch_all_metadata():
-    # Fetches all available metadata in crea
-    # TODO: I think we need to track the last time
-    # we fetched metadata, that way we can skip if it's already on our
-    # database
+    # Fetches all available metadata in crea over a single login,
+    # skipped if the server's metadata version didn't change since the last refresh
+    # Returns True if something went wrong, or something is concerning about the fetch that we made
+    return metadata_refresher.refresh()
 
-    # Something went wrong, or something is concerning about the fetch that we made
-    general_error = False
+FETCH_DDF_LISTINGS_LOCK_KEY = "fetch_ddf_listings"
 
-    for model in metadata_models:
-        without_a_hitch = model.fetch_and_update_metadata()
-        if not without_a_hitch:
-            general_error = True
-    
-    return general_error
 
 @app.task
 def fetch_ddf_listings(hour_timeout=2, fetch_and_update_every_single_record=False):
@@ -32,7 +30,7 @@ def fetch_ddf_listings(hour_timeout=2, fetch_and_update_every_single_record=Fals
     # Initialize and try to acquire the lock with a 2 hour timeout
     # the timeout is there to release the lock if something went wrong with the server
 
-    fetch_ddf_listings_lock = TaskLock(key="fetch_ddf_listings", timeout=60*60*hour_timeout)
+    fetch_ddf_listings_lock = TaskLock(key=FETCH_DDF_LISTINGS_LOCK_KEY, timeout=60*60*hour_timeout)
 
     logger.warning(f"Locking task for {hour_timeout} hour/hours to avoid conflicts...")
     fetch_ddf_listings_lock.check_and_acquire_lock()
@@ -45,15 +43,99 @@ def fetch_ddf_listings(hour_timeout=2, fetch_and_update_every_single_record=Fals
 
     something_went_wrong = False
 
-    # TODO: Find a way to make the metadata fetch avoid redudant request
     something_went_wrong = fetch_all_metadata()
-    
+
     if not something_went_wrong:
+        # Resumes the sync interrupted by a restart or the lock timeout, if any
+        sync_run = ddf_manager.start_sync_run(fetch_and_update_every_single_record)
+
+    if not something_went_wrong and INGEST_SHARDS > 1:
+        sync_plan = ddf_manager.update_server(
+            sample=FETCH_CREA_SAMPLE, task_id=fetch_ddf_listings.request.id,
+            fetch_and_update_every_single_record=fetch_and_update_every_single_record,
+            sharded=True,
+            sync_run=sync_run,
+        )
+        if sync_plan:
+            # The shards are written in parallel, the lock is released by the chord callback
+            finalize = finalize_ddf_listings_sync.s(
+                sync_plan["Removed_Listings"],
+                sync_plan["New_Last_Update"],
+                fetch_ddf_listings_lock.get_token(),
+                hour_timeout,
+                sync_plan["Sync_Run"],
+            )
+            if sync_plan["Shards"]:
+                chord(
+                    write_ddf_listings_shard.s(shard, fetch_and_update_every_single_record, sync_plan["Sync_Run"])
+                    for shard in sync_plan["Shards"]
+                )(finalize)
+            else:
+                finalize.delay([])
+            return
+    elif not something_went_wrong:
         ddf_manager.update_server(
             sample=FETCH_CREA_SAMPLE, task_id=fetch_ddf_listings.request.id, 
-            fetch_and_update_every_single_record=fetch_and_update_every_single_record
+            fetch_and_update_every_single_record=fetch_and_update_every_single_record,
+            sync_run=sync_run,
         )
         pre_warm_endpoints.delay()
+        rebuild_auto_complete_index.delay()
         email_user_from_saved_search.delay('immediately')
 
     fetch_ddf_listings_lock.release_lock()
+
+
+@app.task
+def write_ddf_listings_shard(shard_name, fetch_and_update_every_single_record=False, sync_run_id=None):
+    # Writes one shard of a sharded fetch_ddf_listings in its own transaction.
+    # Never raises, a failed task would fail the chord and finalize_ddf_listings_sync
+    # wouldn't release the fetch_ddf_listings lock
+    try:
+        written = write_shard(shard_name, fetch_and_update_every_single_record)
+        if written and sync_run_id:
+            ddf_manager.record_shard_written(sync_run_id, shard_name)
+        return written
+    except Exception as e:
+        logger.error(e)
+        logger.error(f"Error in writing the listings shard {shard_name}")
+        return False
+
+
+@app.task
+def finalize_ddf_listings_sync(
+    shards_written, removed_listings, new_last_update, lock_token=None, hour_timeout=2, sync_run_id=None
+):
+    # Chord callback of a sharded fetch_ddf_listings, runs once every shard is written
+
+    try:
+        sync_run = SyncRun.objects.filter(pk=sync_run_id).first() if sync_run_id else None
+        if all(shards_written):
+            if sync_run is not None:
+                sync_run.checkpoint(SyncRun.STAGE_REMOVALS)
+            ddf_manager.finalize_update(removed_listings, new_last_update)
+            if sync_run is not None:
+                sync_run.complete()
+            logger.info("DB updated successfully")
+        else:
+            # Keep the old time stamp, the next task resumes the sync run and writes the failed shards again
+            ddf_manager.delete_records(removed_listings)
+            logger.error(
+                f"{shards_written.count(False)} of {len(shards_written)} shards failed, LastUpdate time stamp wasn't advanced"
+            )
+
+        pre_warm_endpoints.delay()
+        rebuild_auto_complete_index.delay()
+        email_user_from_saved_search.delay('immediately')
+    except Exception as e:
+        logger.error(e)
+        logger.error("Error in finalizing the sharded listings update")
+    finally:
+        if lock_token:
+            TaskLock(key=FETCH_DDF_LISTINGS_LOCK_KEY, timeout=60*60*hour_timeout).release_lock(lock_token)
+
+
+@app.task
+def geocode_ddf_properties(property_ids, override=False):
+    # Queued by the DDF writers (ddf_manager.db_geocode.queue_geocoding)
+    return geocode_properties(property_ids, override)
@@ -1,5 +1,5 @@
 import factory
-from crea_parser.models import Property
+from crea_parser.models import Property, PropertySearchIndex
 from crea_parser.tests.factories.address import PropertyAddressFactory
 from crea_parser.tests.factories.agent import AgentFactory
 from crea_parser.tests.factories.alternate_url import AlternateUrlFactory
@@ -90,3 +90,9 @@ class PropertyFactory(factory.django.DjangoModelFactory):
     room = factory.RelatedFactory(RoomFactory, factory_related_name="connected_property")
 
     utility = factory.RelatedFactory(UtilityFactory, factory_related_name="connected_property")
+
+    @factory.post_generation
+    def search_index(obj, create, extracted, **kwargs):
+        # Declared last, runs once the related factories above are created
+        if create:
+            PropertySearchIndex.refresh([obj.pk])
@@ -0,0 +1,90 @@
+import copy
+import json
+import os
+from unittest import mock
+
+from crea_parser.models import Parking, Property, Room
+from crea_parser.utils import metadata_lookup_registry
+from ddf_manager.db_bulk_write import BulkRecordsWriter
+from django.conf import settings
+from django.test import TestCase
+
+FIXTURE = os.path.join(settings.PROJECT_PATH, "crea_parser", "tests", "fixtures", "ddf_listings_sample.json")
+
+
+@mock.patch("ddf_manager.db_bulk_write.DIFF_CHILDREN_RECORDS", True)
+@mock.patch("ddf_manager.db_bulk_write.ASYNC_GEOCODING", True)
+@mock.patch("ddf_manager.db_bulk_write.queue_geocoding")
+class BulkWriteChildrenDiffTestCases(TestCase):
+    """
+    Test cases of the children rows diff of the bulk writer on an updated listing
+    """
+
+    def setUp(self, *args, **kwargs):
+        with open(FIXTURE) as fixture:
+            self.listing = json.load(fixture)[0]
+        metadata_lookup_registry.load()
+        return super().setUp(*args, **kwargs)
+
+    def write(self, listing, existing=None):
+        writer = BulkRecordsWriter()
+        writer.write_chunk([(copy.deepcopy(listing), existing)])
+        return writer
+
+    def get_rooms(self, property_obj):
+        return {room.dimension: room.pk for room in Room.objects.filter(connected_property=property_obj)}
+
+    def test_rewrite_updated_listing_writes_only_the_children_delta(self, *args, **kwargs):
+        self.write(self.listing)
+        property_obj = Property.objects.get(ddf_id=self.listing["ID"])
+        rooms_before = self.get_rooms(property_obj)
+        parking_before = list(Parking.objects.filter(connected_property=property_obj).values_list("pk", flat=True))
+
+        # Change the kitchen, remove the bathroom and add a parking
+        updated_listing = copy.deepcopy(self.listing)
+        kitchen, living_room, bedroom, bathroom = updated_listing["Building"]["Rooms"]["Room"]
+        kitchen["Dimension"] = "12.00 Ft x 14.00 Ft"
+        updated_listing["Building"]["Rooms"]["Room"] = [living_room, bedroom, kitchen]
+        updated_listing["ParkingSpaces"]["Parking"].append(
+            {"Name": {"#text": "Carport", "ID": "5", "LookupName": "ParkingType"}, "Spaces": "1"}
+        )
+
+        writer = self.write(
+            updated_listing, {"pk": property_obj.pk, "creation_date": property_obj.creation_date}
+        )
+
+        rooms_after = self.get_rooms(property_obj)
+        self.assertEqual(
+            set(rooms_after.keys()),
+            {"15.00 Ft x 17.00 Ft", "13.00 Ft x 14.00 Ft", "12.00 Ft x 14.00 Ft"},
+        )
+        # Identical rows are kept, the changed kitchen is updated in place and the bathroom is deleted
+        self.assertEqual(rooms_after["15.00 Ft x 17.00 Ft"], rooms_before["15.00 Ft x 17.00 Ft"])
+        self.assertEqual(rooms_after["13.00 Ft x 14.00 Ft"], rooms_before["13.00 Ft x 14.00 Ft"])
+        self.assertEqual(rooms_after["12.00 Ft x 14.00 Ft"], rooms_before["11.00 Ft x 14.00 Ft"])
+        self.assertFalse(Room.objects.filter(pk=rooms_before[".00 Ft x .00 Ft"]).exists())
+
+        parking_after = list(
+            Parking.objects.filter(connected_property=property_obj).order_by("pk").values_list("pk", "spaces")
+        )
+        self.assertEqual(len(parking_after), 2)
+        self.assertEqual(parking_after[0], (parking_before[0], "2"))
+        self.assertEqual(parking_after[1][1], "1")
+
+        self.assertEqual(writer.child_rows_updated_count, 1)
+        self.assertEqual(writer.child_rows_deleted_count, 1)
+        self.assertEqual(writer.child_rows_inserted_count, 1)
+
+    def test_rewrite_unchanged_listing_keeps_every_child_row(self, *args, **kwargs):
+        self.write(self.listing)
+        property_obj = Property.objects.get(ddf_id=self.listing["ID"])
+        rooms_before = self.get_rooms(property_obj)
+
+        writer = self.write(
+            self.listing, {"pk": property_obj.pk, "creation_date": property_obj.creation_date}
+        )
+
+        self.assertEqual(self.get_rooms(property_obj), rooms_before)
+        self.assertEqual(writer.child_rows_updated_count, 0)
+        self.assertEqual(writer.child_rows_deleted_count, 0)
+        self.assertEqual(writer.child_rows_inserted_count, 0)
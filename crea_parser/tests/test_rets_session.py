@@ -0,0 +1,65 @@
+import io
+from unittest import TestCase, mock
+
+from ddf_manager.rets_lib import Session
+
+SESSION_EXPIRED_REPLY = b'<RETS ReplyCode="20037" ReplyText="Session expired"></RETS>'
+SEARCH_REPLY = (
+    b'<RETS ReplyCode="0" ReplyText="Operation Successful">'
+    b'<COUNT Records="1" />'
+    b"<RETS-RESPONSE><PropertyDetails><ListingID>1</ListingID></PropertyDetails></RETS-RESPONSE>"
+    b"</RETS>"
+)
+
+
+class FakeResponse(object):
+    def __init__(self, body):
+        self.raw = io.BytesIO(body)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class RETSSessionTestCases(TestCase):
+    """
+    Test cases of the session expiry handling of the RETS search
+    """
+
+    def setUp(self, *args, **kwargs):
+        self.session = Session("https://rets.example.com/Login.svc/Login", "username", "password")
+        self.session.capabilities["Search"] = "https://rets.example.com/Search.svc/Search"
+        return super().setUp(*args, **kwargs)
+
+    def search(self):
+        return self.session.search(
+            resource="Property",
+            resource_class="Property",
+            dmql_query="(ID=*)",
+            stream_records=True,
+        )
+
+    @mock.patch.object(Session, "login")
+    def test_search_with_expired_session_relogins_and_retries(self, login, *args, **kwargs):
+        responses = [FakeResponse(SESSION_EXPIRED_REPLY), FakeResponse(SEARCH_REPLY)]
+        with mock.patch.object(Session, "_send", side_effect=responses) as send:
+            result = self.search()
+
+            self.assertEqual(result["ReplyCode"], "0")
+            self.assertEqual(list(result["Data"]), [{"ListingID": "1"}])
+            self.assertEqual(send.call_count, 2)
+
+        login.assert_called_once_with()
+        self.assertEqual(self.session.relogin_count, 1)
+        self.assertTrue(responses[0].closed)
+
+    @mock.patch.object(Session, "login")
+    def test_search_with_expired_session_retries_once(self, login, *args, **kwargs):
+        responses = [FakeResponse(SESSION_EXPIRED_REPLY), FakeResponse(SESSION_EXPIRED_REPLY)]
+        with mock.patch.object(Session, "_send", side_effect=responses) as send:
+            result = self.search()
+
+            self.assertEqual(result["ReplyCode"], "20037")
+            self.assertEqual(send.call_count, 2)
+
+        login.assert_called_once_with()
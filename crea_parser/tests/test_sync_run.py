@@ -0,0 +1,203 @@
+from datetime import timedelta
+from unittest import mock
+
+from crea_parser.models import SyncRun
+from ddf_manager import manager
+from ddf_manager.ddf_client.ddf_client import DDFClient
+from ddf_manager.ddf_client.ddf_page_fetcher import PageFetcher
+from ddf_manager.settings import SESSION_LISTINGS_COUNT, SYNC_RUN_MAX_RESUMES, SYNC_RUN_RESUME_HOURS
+from django.test import TestCase
+from django.utils import timezone
+
+LAST_UPDATE = "2020-01-01T00:00:00Z"
+NEW_LAST_UPDATE = "2020-01-02T00:00:00Z"
+
+
+class StartSyncRunTestCases(TestCase):
+    """
+    Test cases of the sync run resumed by manager.start_sync_run
+    """
+
+    def test_running_sync_run_is_resumed(self, *args, **kwargs):
+        sync_run = SyncRun.objects.create(stage=SyncRun.STAGE_BY_ID_PAGES)
+
+        resumed = manager.start_sync_run()
+
+        self.assertEqual(resumed.pk, sync_run.pk)
+        self.assertEqual(resumed.stage, SyncRun.STAGE_BY_ID_PAGES)
+        self.assertEqual(resumed.resumed_count, 1)
+
+    def test_other_kind_of_sync_run_is_not_resumed(self, *args, **kwargs):
+        sync_run = SyncRun.objects.create(fetch_and_update_every_single_record=True)
+
+        new_sync_run = manager.start_sync_run()
+
+        self.assertNotEqual(new_sync_run.pk, sync_run.pk)
+        sync_run.refresh_from_db()
+        self.assertEqual(sync_run.status, SyncRun.STATUS_FAILED)
+
+    def test_old_sync_run_is_not_resumed(self, *args, **kwargs):
+        sync_run = SyncRun.objects.create()
+        SyncRun.objects.filter(pk=sync_run.pk).update(
+            date_created=timezone.now() - timedelta(hours=SYNC_RUN_RESUME_HOURS + 1)
+        )
+
+        new_sync_run = manager.start_sync_run()
+
+        self.assertNotEqual(new_sync_run.pk, sync_run.pk)
+        self.assertEqual(new_sync_run.stage, SyncRun.STAGE_ACTIVE_PAGES)
+        sync_run.refresh_from_db()
+        self.assertEqual(sync_run.status, SyncRun.STATUS_FAILED)
+
+    def test_sync_run_resumed_too_many_times_is_not_resumed(self, *args, **kwargs):
+        sync_run = SyncRun.objects.create(resumed_count=SYNC_RUN_MAX_RESUMES)
+
+        new_sync_run = manager.start_sync_run()
+
+        self.assertNotEqual(new_sync_run.pk, sync_run.pk)
+        sync_run.refresh_from_db()
+        self.assertEqual(sync_run.status, SyncRun.STATUS_FAILED)
+
+
+@mock.patch("ddf_manager.manager.get_db_listings_last_updated", return_value={})
+@mock.patch("ddf_manager.manager.read_last_update")
+@mock.patch("ddf_manager.manager.ddf_c")
+class ResumedFetchTestCases(TestCase):
+    """
+    Test cases of manager.fetch_updates, update_db and update_db_sharded resuming a sync run
+    interrupted after each stage
+    """
+
+    def create_sync_run(self, stage, **progress):
+        return SyncRun.objects.create(
+            stage=stage, last_update=LAST_UPDATE, new_last_update=NEW_LAST_UPDATE, **progress
+        )
+
+    def test_interrupted_fetch_is_resumed_in_the_same_time_window(self, ddf_c, read_last_update, *args, **kwargs):
+        for stage in (SyncRun.STAGE_ACTIVE_PAGES, SyncRun.STAGE_MASTER_LIST, SyncRun.STAGE_BY_ID_PAGES):
+            with self.subTest(stage=stage):
+                ddf_c.reset_mock()
+                ddf_c.update.return_value = {
+                    "Pass": True,
+                    "Listings": ddf_c.listing_disk_cache_manager,
+                    "Removed_Listings": ["1", "2"],
+                }
+                sync_run = self.create_sync_run(stage, active_count=250, active_next_offset=201)
+
+                updated, new_last_update = manager.fetch_updates(sync_run=sync_run)
+
+                self.assertEqual(new_last_update, NEW_LAST_UPDATE)
+                ddf_c.update.assert_called_once()
+                self.assertEqual(ddf_c.update.call_args.kwargs["last_update"], LAST_UPDATE)
+                ddf_c.get_gmt_time.assert_not_called()
+                read_last_update.assert_not_called()
+
+                sync_run.refresh_from_db()
+                self.assertEqual(sync_run.stage, SyncRun.STAGE_WRITE)
+                self.assertEqual(sync_run.removed_listings, ["1", "2"])
+
+    def test_fetched_sync_run_skips_the_fetch(self, ddf_c, read_last_update, *args, **kwargs):
+        sync_run = self.create_sync_run(SyncRun.STAGE_WRITE, removed_listings=["1"])
+
+        updated, new_last_update = manager.fetch_updates(sync_run=sync_run)
+
+        ddf_c.update.assert_not_called()
+        ddf_c.listing_disk_cache_manager.resume_disk_cache.assert_called_once()
+        self.assertTrue(updated["Pass"])
+        self.assertIs(updated["Listings"], ddf_c.listing_disk_cache_manager)
+        self.assertEqual(updated["Removed_Listings"], ["1"])
+        self.assertEqual(new_last_update, NEW_LAST_UPDATE)
+
+    @mock.patch("ddf_manager.manager.finalize_update")
+    @mock.patch("ddf_manager.manager.update_records", return_value=True)
+    def test_fetched_sync_run_is_written_and_completed(
+        self, update_records, finalize_update, ddf_c, *args, **kwargs
+    ):
+        sync_run = self.create_sync_run(SyncRun.STAGE_WRITE, removed_listings=["1"])
+
+        self.assertTrue(manager.update_db(sync_run=sync_run))
+
+        ddf_c.update.assert_not_called()
+        update_records.assert_called_once()
+        finalize_update.assert_called_once_with(["1"], NEW_LAST_UPDATE)
+        sync_run.refresh_from_db()
+        self.assertEqual(sync_run.status, SyncRun.STATUS_COMPLETED)
+        self.assertIsNotNone(sync_run.completed_at)
+
+    def test_partitioned_sync_run_only_returns_the_shards_left(self, ddf_c, *args, **kwargs):
+        sync_run = self.create_sync_run(
+            SyncRun.STAGE_WRITE,
+            removed_listings=["1"],
+            shards=["shard_0", "shard_1", "shard_2"],
+            shards_written=["shard_1"],
+        )
+
+        plan = manager.update_db_sharded(sync_run=sync_run)
+
+        ddf_c.update.assert_not_called()
+        ddf_c.listing_disk_cache_manager.resume_disk_cache.assert_not_called()
+        self.assertEqual(plan["Shards"], ["shard_0", "shard_2"])
+        self.assertEqual(plan["Removed_Listings"], ["1"])
+        self.assertEqual(plan["New_Last_Update"], NEW_LAST_UPDATE)
+        self.assertEqual(plan["Sync_Run"], sync_run.pk)
+
+    def test_written_shards_are_recorded(self, *args, **kwargs):
+        sync_run = self.create_sync_run(SyncRun.STAGE_WRITE, shards=["shard_0", "shard_1"])
+
+        manager.record_shard_written(sync_run.pk, "shard_0")
+        manager.record_shard_written(sync_run.pk, "shard_0")
+
+        sync_run.refresh_from_db()
+        self.assertEqual(sync_run.shards_written, ["shard_0"])
+        self.assertEqual(manager.update_db_sharded(sync_run=sync_run)["Shards"], ["shard_1"])
+
+
+class ResumedActivePagesTestCases(TestCase):
+    """
+    Test cases of DDFClient.download_active_listings resuming the active pages of a sync run
+    """
+
+    def get_client(self, sync_run):
+        client = DDFClient.__new__(DDFClient)
+        client.sync_run = sync_run
+        client.streamer = mock.Mock()
+        client.streamer.retrieve_active_records.side_effect = lambda last_update, offset=None, **kwargs: (
+            [{"ID": str(offset)}],
+            sync_run.active_count,
+        )
+        client.listing_disk_cache_manager = mock.Mock(disk_cache_count=0)
+        client.page_fetcher = PageFetcher(concurrency=1, retries=0)
+        return client
+
+    def test_active_pages_resume_at_the_next_offset(self, *args, **kwargs):
+        first_offset = SESSION_LISTINGS_COUNT + 1
+        sync_run = SyncRun.objects.create(
+            active_count=4 * SESSION_LISTINGS_COUNT,
+            active_next_offset=first_offset + SESSION_LISTINGS_COUNT,
+        )
+        client = self.get_client(sync_run)
+
+        self.assertTrue(client.download_active_listings(LAST_UPDATE))
+
+        client.listing_disk_cache_manager.resume_disk_cache.assert_called_once()
+        client.listing_disk_cache_manager.initialize_disk_cache.assert_not_called()
+        # Only the pages after the last checkpointed one are fetched
+        offsets = [call.kwargs["offset"] for call in client.streamer.retrieve_active_records.call_args_list]
+        self.assertEqual(offsets, list(range(first_offset + SESSION_LISTINGS_COUNT, sync_run.active_count, SESSION_LISTINGS_COUNT)))
+
+        sync_run.refresh_from_db()
+        self.assertEqual(sync_run.stage, SyncRun.STAGE_MASTER_LIST)
+        self.assertEqual(sync_run.active_next_offset, offsets[-1] + SESSION_LISTINGS_COUNT)
+
+    def test_downloaded_active_pages_are_skipped(self, *args, **kwargs):
+        sync_run = SyncRun.objects.create(
+            stage=SyncRun.STAGE_MASTER_LIST,
+            active_count=4 * SESSION_LISTINGS_COUNT,
+            active_next_offset=4 * SESSION_LISTINGS_COUNT + 1,
+        )
+        client = self.get_client(sync_run)
+
+        self.assertTrue(client.download_active_listings(LAST_UPDATE))
+
+        client.listing_disk_cache_manager.resume_disk_cache.assert_called_once()
+        client.streamer.retrieve_active_records.assert_not_called()
@@ -0,0 +1,198 @@
+from collections import defaultdict
+
+from django.core.cache import cache
+
+from crea_parser.mixins import parse_lookup_types
+from crea_parser.submodels.metadata import metadata_models
+from ddf_manager.ddf_logger import logger
+from ddf_manager.rets_lib.session import Session
+from ddf_manager.settings import CREA_LOGIN_URL, CREA_PASSWORD, CREA_USERNAME
+
+
+class MetadataLookupRegistry(object):
+    """
+    Preloaded registry of every crea metadata lookup, keyed by
+    (lookup_name, metadata_entry_id).
+
+    Metadata only changes when `fetch_all_metadata` runs, so instead of
+    querying a metadata table for every lookup field of every listing,
+    the rows are loaded once and resolved from memory.
+
+    The registry is invalidated by `invalidate`, which also bumps a version
+    on the shared cache so other workers reload on their next `ensure_loaded`.
+    """
+
+    version_cache_key = "crea_metadata_lookup_version"
+
+    def __init__(self):
+        self.models_by_lookup_name = {}
+        self.lookups = {}
+        self.loaded = False
+        self.loaded_version = None
+
+    def _get_shared_version(self):
+        try:
+            return cache.get(self.version_cache_key, 0)
+        except Exception as e:
+            logger.error(f"Unable to read the metadata lookup version: {e}")
+            return self.loaded_version
+
+    def load(self):
+        """
+        Loads every active metadata row of every metadata model
+        """
+        models_by_lookup_name = {}
+        lookups = {}
+
+        for model in metadata_models:
+            # Same as the old linear scan, the first model with a lookup name wins
+            if model.lookup_name in models_by_lookup_name:
+                continue
+            models_by_lookup_name[model.lookup_name] = model
+
+            for row in model.active_objects.order_by("pk"):
+                lookups.setdefault((model.lookup_name, row.metadata_entry_id), row)
+
+        self.models_by_lookup_name = models_by_lookup_name
+        self.lookups = lookups
+        self.loaded = True
+        self.loaded_version = self._get_shared_version()
+
+        logger.info(f"Loaded {len(self.lookups)} metadata lookups from {len(self.models_by_lookup_name)} lookup names")
+
+    def ensure_loaded(self):
+        """
+        Loads the registry if it's empty or another process refreshed the metadata
+        """
+        if not self.loaded or self._get_shared_version() != self.loaded_version:
+            self.load()
+
+    def invalidate(self):
+        """
+        Drops the preloaded lookups, call it whenever the metadata tables change
+        """
+        self.loaded = False
+        self.models_by_lookup_name = {}
+        self.lookups = {}
+
+        try:
+            cache.set(self.version_cache_key, (self._get_shared_version() or 0) + 1, None)
+        except Exception as e:
+            logger.error(f"Unable to bump the metadata lookup version: {e}")
+
+    def get_model(self, lookup_name):
+        if not self.loaded:
+            self.load()
+        return self.models_by_lookup_name.get(lookup_name)
+
+    def get(self, lookup_name, metadata_entry_id):
+        if not self.loaded:
+            self.load()
+        return self.lookups.get((lookup_name, metadata_entry_id))
+
+    def get_many(self, lookup_name, metadata_entry_ids):
+        if not self.loaded:
+            self.load()
+        rows = []
+        for metadata_entry_id in metadata_entry_ids:
+            row = self.lookups.get((lookup_name, metadata_entry_id))
+            if row is not None and row not in rows:
+                rows.append(row)
+        return rows
+
+
+metadata_lookup_registry = MetadataLookupRegistry()
+
+
+class MetadataRefresher(object):
+    """
+    Refreshes every metadata model over a single RETS login.
+
+    The lookups of a resource are fetched with one METADATA-LOOKUP_TYPE request (Resource:*),
+    the lookups missing from that answer are requested one by one over the same session.
+    Every model is then diffed against its table with one query and a bulk_create.
+
+    The refresh is skipped when the metadata version announced at login didn't change
+    since the last complete refresh.
+    """
+
+    version_cache_key = "crea_metadata_server_version"
+
+    def __init__(self, models=None):
+        self.models = models or metadata_models
+
+    def fetch_lookups(self, rets_session):
+        """
+        Returns {(resource, lookup name): list of entries dict} for every model
+        """
+        lookup_names_by_resource = defaultdict(set)
+        for model in self.models:
+            lookup_names_by_resource[model.resource].add(model.lookup_name)
+
+        lookups = {}
+        for resource, lookup_names in lookup_names_by_resource.items():
+            try:
+                response = rets_session.get_response_lookup_values(resource, "*")
+                for lookup_name, entries in parse_lookup_types(response).items():
+                    lookups[(resource, lookup_name)] = entries
+            except Exception as e:
+                logger.error(f"Unable to fetch every lookup of the resource {resource}: {e}")
+
+            for lookup_name in lookup_names:
+                if (resource, lookup_name) in lookups:
+                    continue
+                try:
+                    response = rets_session.get_response_lookup_values(resource, lookup_name)
+                    lookups[(resource, lookup_name)] = parse_lookup_types(response).get(lookup_name, [])
+                except Exception as e:
+                    logger.error(f"Unable to fetch the lookup '{resource}:{lookup_name}': {e}")
+        return lookups
+
+    def refresh(self, force=False):
+        """
+        Fetches and inserts the new metadata of every model.
+        Returns True if something went wrong, like fetch_all_metadata did
+        """
+        rets_session = Session(CREA_LOGIN_URL, CREA_USERNAME, CREA_PASSWORD)
+        try:
+            if not rets_session.login():
+                logger.error("Unable to login to refresh the metadata")
+                return True
+        except Exception as e:
+            logger.error(f"Unable to login to refresh the metadata: {e}")
+            return True
+
+        general_error = False
+        inserted_count = 0
+        try:
+            metadata_version = rets_session.get_metadata_version()
+            if not force and metadata_version and cache.get(self.version_cache_key) == metadata_version:
+                logger.info(f"Metadata version {metadata_version} didn't change, skipping the metadata refresh")
+                return False
+
+            lookups = self.fetch_lookups(rets_session)
+            for model in self.models:
+                model_inserted_count, without_a_hitch = model.update_metadata(
+                    lookups.get((model.resource, model.lookup_name), [])
+                )
+                inserted_count += model_inserted_count
+                if not without_a_hitch:
+                    general_error = True
+
+            logger.info(f"Metadata refreshed, {inserted_count} entries inserted")
+            if metadata_version and not general_error:
+                cache.set(self.version_cache_key, metadata_version, None)
+        finally:
+            try:
+                rets_session.logout()
+            except Exception as e:
+                logger.error(e)
+
+        if inserted_count:
+            # Lookups are preloaded for the type casting, reload them on the next write
+            metadata_lookup_registry.invalidate()
+
+        return general_error
+
+
+metadata_refresher = MetadataRefresher()
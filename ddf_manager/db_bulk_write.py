@@ -0,0 +1,666 @@
+import datetime
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Prefetch
+from django.utils import timezone
+
+from .db_mapping import *
+from .db_summary import *
+from .db_geocode import queue_geocoding
+from .db_write import filter_fields, prefilter_listings
+from .settings import ASYNC_GEOCODING, BULK_WRITE_BATCH_SIZE, BULK_WRITE_CHUNK_SIZE, DIFF_CHILDREN_RECORDS
+
+##Batched counterpart of db_write.update_records.
+##db_write saves every table row of every listing with its own query, this module maps a
+##whole chunk of listings in memory first and then writes each table with a bulk_create.
+##The mapping rules (db_mapping children lists, db_fields and rename_fields_dict) are shared
+##with db_write so both writers persist exactly the same data.
+
+# Fields the update path of db_write.update_records touches on an existing Property.
+PROPERTY_UPDATE_FIELDS = [
+    "listing_id",
+    "ddf_id",
+    "last_updated",
+    "creation_date",
+    "is_active",
+    "date_updated",
+]
+
+# Children tables wiped by db_write.wipe_children_table, all linked through connected_property.
+PROPERTY_CHILDREN_MODELS = [
+    PropertyInfo,
+    AlternateURL,
+    Building,
+    Address,
+    Land,
+    Parking,
+    Business,
+    Event,
+    Room,
+    AgentDetails,
+    PropertyPhoto,
+    Utility,
+]
+
+# Children relations of the staged models, (child model, foreign key to the parent)
+CHILDREN_RELATIONS = {
+    Property: [(model, "connected_property") for model in PROPERTY_CHILDREN_MODELS],
+    AgentDetails: [
+        (OfficeDetails, "agent"),
+        (Address, "agent"),
+        (Phone, "agent"),
+        (Website, "agent"),
+    ],
+    OfficeDetails: [(Address, "office"), (Phone, "office"), (Website, "office")],
+}
+
+# Fields that aren't mapped from DDF, they never take part in a fingerprint
+FINGERPRINT_EXCLUDED_FIELDS = {
+    "date_created",
+    "date_updated",
+    "is_active",
+    "previous_price",
+    "previous_lease",
+    "connected_property",
+    "agent",
+    "office",
+}
+
+_fingerprint_fields = {}
+
+
+def get_fingerprint_fields(model):
+    # (concrete fields, many to many fields) compared between a staged record and a db row
+    fields = _fingerprint_fields.get(model)
+    if fields is None:
+        concrete_fields = [
+            field
+            for field in model._meta.concrete_fields
+            if not field.primary_key and field.name not in FINGERPRINT_EXCLUDED_FIELDS
+        ]
+        fields = _fingerprint_fields[model] = (concrete_fields, list(model._meta.many_to_many))
+    return fields
+
+
+def normalize_field_value(field, value):
+    # Brings a mapped value and a value read from the db to the same python value
+    try:
+        value = field.to_python(value)
+    except Exception:
+        pass
+    if isinstance(value, datetime.datetime) and settings.USE_TZ and timezone.is_naive(value):
+        try:
+            value = timezone.make_aware(value, timezone.get_default_timezone())
+        except Exception:
+            pass
+    return value
+
+
+class StagedRecord(object):
+    """
+    A table row mapped from DDF data that is waiting to be bulk inserted.
+
+    `parent_field` is the foreign key pointing to `parent`, it is only
+    resolved once the parent has been inserted and has a primary key.
+    """
+
+    __slots__ = ("model", "fields", "m2m_fields", "parent", "parent_field", "children", "instance")
+
+    def __init__(self, model, fields, m2m_fields, parent=None, parent_field=None):
+        self.model = model
+        self.fields = fields
+        self.m2m_fields = m2m_fields
+        self.parent = parent
+        self.parent_field = parent_field
+        self.children = []
+        self.instance = None
+
+    def get_m2m_pks(self):
+        concrete_fields, m2m_fields = get_fingerprint_fields(self.model)
+        return tuple(
+            tuple(sorted({value.pk for value in self.m2m_fields.get(field.name) or []}))
+            for field in m2m_fields
+        )
+
+    def build_instance(self):
+        kwargs = dict(self.fields)
+        if self.parent_field:
+            kwargs[self.parent_field] = self.parent.instance
+        self.instance = self.model(**kwargs)
+        return self.instance
+
+
+def get_table_rows(source, item, single_element_dict):
+    # Same unwrapping as the add_*_children functions of db_write
+    if isinstance(source[item], dict) and single_element_dict in source[item].keys():
+        return source[item][single_element_dict]
+    return source[item]
+
+
+def stage_table(table, TABLE, table_fields, parent, parent_field):
+    # Mirrors db_write.update_table, returns the last staged record or None
+    staged = None
+    if not table:
+        return staged
+
+    records = table if isinstance(table, list) else [table]
+    for record in records:
+        record_filtered, m2m_record_filtered = filter_fields(
+            TABLE, record, table_fields, rename_fields=rename_fields_dict
+        )
+        if not record_filtered:
+            continue
+        staged = StagedRecord(TABLE, record_filtered, m2m_record_filtered, parent, parent_field)
+        parent.children.append(staged)
+    return staged
+
+
+def stage_children(source, children_mapping, parent, parent_field):
+    for (item, itemClass, item_db_fields, single_element_dict) in children_mapping:
+        if item in source.keys():
+            stage_table(
+                get_table_rows(source, item, single_element_dict),
+                itemClass,
+                db_fields[item_db_fields],
+                parent,
+                parent_field,
+            )
+
+
+def stage_agents_details(agents, property_staged):
+    if not isinstance(agents, list):
+        agents = [agents]
+
+    for agent in agents:
+        agent_staged = stage_table(
+            agent,
+            AgentDetails,
+            db_fields["agent_details_fields"],
+            property_staged,
+            "connected_property",
+        )
+        if not agent_staged:
+            continue
+
+        if "Office" in agent.keys():
+            office_staged = stage_table(
+                agent["Office"],
+                OfficeDetails,
+                db_fields["office_details_fields"],
+                agent_staged,
+                "agent",
+            )
+            if office_staged:
+                stage_children(agent["Office"], office_children, office_staged, "office")
+
+        stage_children(agent, agent_children, agent_staged, "agent")
+
+
+def stage_property_children(listing, property_staged):
+    # Same layout as db_write.add_property_children
+    stage_table(
+        listing,
+        PropertyInfo,
+        db_fields["property_info_fields"],
+        property_staged,
+        "connected_property",
+    )
+
+    if "Building" in listing.keys():
+        building_staged = stage_table(
+            listing["Building"],
+            Building,
+            db_fields["building_fields"],
+            property_staged,
+            "connected_property",
+        )
+        if building_staged:
+            # Rooms hang off the property, not the building
+            stage_children(listing["Building"], building_children, property_staged, "connected_property")
+
+    if "AgentDetails" in listing.keys():
+        stage_agents_details(listing["AgentDetails"], property_staged)
+
+    stage_children(listing, property_children, property_staged, "connected_property")
+
+
+def bulk_set_many_to_many(model, staged_records):
+    # Inserts the through table rows of freshly created records in one query per field
+    through_rows = defaultdict(list)
+    for staged in staged_records:
+        for field_name, values in staged.m2m_fields.items():
+            if not values:
+                continue
+            field = model._meta.get_field(field_name)
+            through = field.remote_field.through
+            for value in values:
+                through_rows[through].append(
+                    through(
+                        **{
+                            f"{field.m2m_field_name()}_id": staged.instance.pk,
+                            f"{field.m2m_reverse_field_name()}_id": value.pk,
+                        }
+                    )
+                )
+
+    for through, rows in through_rows.items():
+        through.objects.bulk_create(rows, batch_size=BULK_WRITE_BATCH_SIZE, ignore_conflicts=True)
+
+
+def bulk_create_staged_children(property_staged_records):
+    # Inserts the staged tree one level at a time so every parent has a pk before its children
+    level = [child for staged in property_staged_records for child in staged.children]
+    while level:
+        by_model = OrderedDict()
+        for staged in level:
+            staged.build_instance()
+            by_model.setdefault(staged.model, []).append(staged)
+
+        for model, staged_records in by_model.items():
+            model.objects.bulk_create(
+                [staged.instance for staged in staged_records],
+                batch_size=BULK_WRITE_BATCH_SIZE,
+            )
+            bulk_set_many_to_many(model, staged_records)
+
+        level = [child for staged in level for child in staged.children]
+
+
+def get_row_m2m_pks(row):
+    concrete_fields, m2m_fields = get_fingerprint_fields(type(row))
+    return tuple(
+        tuple(sorted({value.pk for value in getattr(row, field.name).all()}))
+        for field in m2m_fields
+    )
+
+
+def get_fingerprint(instance, m2m_pks):
+    """
+    Fingerprint of a child record, its mapped field values and its many to many ids.
+    Identical fingerprints mean the db row already holds the staged record.
+    """
+    concrete_fields, m2m_fields = get_fingerprint_fields(type(instance))
+    return (
+        tuple(normalize_field_value(field, getattr(instance, field.attname)) for field in concrete_fields),
+        m2m_pks,
+    )
+
+
+def wipe_children_tables(property_ids):
+    # Bulk version of db_write.wipe_children_table
+    if not property_ids:
+        return
+
+    for model in PROPERTY_CHILDREN_MODELS:
+        model.objects.filter(connected_property__in=property_ids).delete()
+
+
+class BulkRecordsWriter(object):
+    """
+    Writes DDF listings to the db chunk by chunk.
+
+    Unchanged listings are dropped page by page by db_write.prefilter_listings,
+    which also hands over the pk of the existing properties, then properties are bulk created / bulk updated. Children of new
+    properties are inserted with one bulk_create per table, children of
+    updated ones are fingerprinted against their db rows so identical rows
+    are left untouched (see sync_children).
+    """
+
+    def __init__(self, fetch_and_update_every_single_record=False):
+        self.fetch_and_update_every_single_record = fetch_and_update_every_single_record
+
+        self.new_listings_count = 0
+        self.updated_count = 0
+        self.not_updated_count = 0
+        self.missing_address_count = 0
+        self.geolocation_added_count = 0
+        self.geolocation_request_count = 0
+        self.geolocation_queued_count = 0
+        self.failed_count = 0
+        self.progress_count = 0
+
+        self.child_rows_skipped_count = 0
+        self.child_rows_updated_count = 0
+        self.child_rows_inserted_count = 0
+        self.child_rows_deleted_count = 0
+
+    def get_counters(self):
+        return {key: value for key, value in vars(self).items() if key.endswith("_count")}
+
+    def stage_listing(self, listing, existing):
+        # Maps a single prefiltered listing, existing is its db row values or None when new
+        if existing is not None:
+            creation_date = existing["creation_date"]
+            if creation_date is None:
+                creation_date = timezone.now()
+            listing["creation_date"] = creation_date
+        else:
+            listing["creation_date"] = listing["LastUpdated"]
+
+        record_filtered, m2m_record_filtered = filter_fields(
+            Property, listing, db_fields["property_fields"], rename_fields_dict
+        )
+        if not record_filtered:
+            raise ValueError(f"Couldn't map Property fields for Listing: {listing['ID']}")
+
+        property_staged = StagedRecord(Property, record_filtered, m2m_record_filtered)
+        if existing is not None:
+            # Only the pk is known, bulk_update writes PROPERTY_UPDATE_FIELDS
+            property_obj = Property(pk=existing["pk"])
+            property_obj.listing_id = record_filtered.get("listing_id", "")
+            property_obj.ddf_id = record_filtered.get("ddf_id", "")
+            property_obj.last_updated = record_filtered.get("last_updated", None)
+            property_obj.creation_date = record_filtered.get("creation_date", None)
+            # Bring back to life the properties that was updated that is still here
+            property_obj.is_active = True
+            property_obj.date_updated = timezone.now()
+            property_staged.instance = property_obj
+        else:
+            property_staged.build_instance()
+
+        stage_property_children(listing, property_staged)
+        return property_staged
+
+    def write_chunk(self, listings_to_write):
+        # listings_to_write: [(listing, existing)] pairs of db_write.prefilter_listings
+        # Later duplicates of the same ID win, like the row by row writer
+        unique_listings = OrderedDict()
+        for listing, existing in listings_to_write:
+            if listing["ID"] in unique_listings:
+                self.not_updated_count += 1
+                del unique_listings[listing["ID"]]
+            unique_listings[listing["ID"]] = (listing, existing)
+
+        to_create = []
+        to_update = []
+        staged_listings = []
+        for ddf_id, (listing, existing) in unique_listings.items():
+            try:
+                property_staged = self.stage_listing(listing, existing)
+            except Exception as e:
+                logger.error(f"Code Error: {e}")
+                logger.error("Error in updating record for listing: %s", ddf_id)
+                self.failed_count += 1
+                continue
+
+            if existing is not None:
+                logger.debug("Listing %s is updated", ddf_id)
+                to_update.append(property_staged)
+            else:
+                logger.debug("Creating New Listing %s", ddf_id)
+                to_create.append(property_staged)
+            staged_listings.append((listing, property_staged))
+
+        if not staged_listings:
+            return
+
+        with transaction.atomic():
+            Property.objects.bulk_create(
+                [staged.instance for staged in to_create],
+                batch_size=BULK_WRITE_BATCH_SIZE,
+            )
+            Property.objects.bulk_update(
+                [staged.instance for staged in to_update],
+                PROPERTY_UPDATE_FIELDS,
+                batch_size=BULK_WRITE_BATCH_SIZE,
+            )
+            if DIFF_CHILDREN_RECORDS:
+                self.sync_children(to_create, to_update)
+            else:
+                wipe_children_tables([staged.instance.pk for staged in to_update])
+                bulk_create_staged_children(to_create + to_update)
+
+        self.new_listings_count += len(to_create)
+        self.updated_count += len(to_update)
+        self.progress_count += len(staged_listings)
+        logger.info(f"{self.progress_count} number of property written in bulk")
+
+        self.add_geolocations(staged_listings)
+        PropertySearchIndex.refresh([property_staged.instance.pk for listing, property_staged in staged_listings])
+
+    def get_existing_children(self, model, parent_field, parent_ids):
+        concrete_fields, m2m_fields = get_fingerprint_fields(model)
+        return model.objects.filter(**{f"{parent_field}__in": parent_ids}).order_by("pk").prefetch_related(
+            *[
+                Prefetch(field.name, queryset=field.related_model.objects.only("pk"))
+                for field in m2m_fields
+            ]
+        )
+
+    def match_children(self, staged_children, rows, matches):
+        """
+        Pairs the staged children of a parent with its db rows.
+        Identical rows are kept as is, the remaining ones are updated in place
+        in order, and only the surplus is inserted or deleted.
+        """
+        rows_by_fingerprint = OrderedDict()
+        rows_m2m_pks = {}
+        for row in rows:
+            rows_m2m_pks[row.pk] = get_row_m2m_pks(row)
+            rows_by_fingerprint.setdefault(get_fingerprint(row, rows_m2m_pks[row.pk]), []).append(row)
+
+        changed = []
+        for staged in staged_children:
+            staged.build_instance()
+            candidates = rows_by_fingerprint.get(get_fingerprint(staged.instance, staged.get_m2m_pks()))
+            if candidates:
+                staged.instance = candidates.pop(0)
+                matches["skipped"].append(staged)
+            else:
+                changed.append(staged)
+
+        leftover_rows = sorted(
+            (row for candidates in rows_by_fingerprint.values() for row in candidates),
+            key=lambda row: row.pk,
+        )
+        for staged, row in zip(changed, leftover_rows):
+            matches["updated"].append((staged, row, rows_m2m_pks[row.pk]))
+        matches["inserted"].extend(changed[len(leftover_rows):])
+        matches["deleted"].extend(leftover_rows[len(changed):])
+
+    def update_rows_in_place(self, updated):
+        # updated: [(staged, db row, db row many to many ids)]
+        by_model = OrderedDict()
+        m2m_changes = defaultdict(list)
+        now = timezone.now()
+
+        for staged, row, row_m2m_pks in updated:
+            concrete_fields, m2m_fields = get_fingerprint_fields(staged.model)
+            if staged.model is PropertyInfo:
+                # Same as PropertyInfo.save, keep the price before the update
+                row.previous_price = row.price
+                row.previous_lease = row.lease
+            for field in concrete_fields:
+                setattr(row, field.attname, getattr(staged.instance, field.attname))
+            row.date_updated = now
+
+            for field, row_pks, staged_pks in zip(m2m_fields, row_m2m_pks, staged.get_m2m_pks()):
+                if row_pks != staged_pks:
+                    m2m_changes[field].append((row.pk, staged_pks))
+
+            staged.instance = row
+            by_model.setdefault(staged.model, []).append(row)
+
+        for model, rows in by_model.items():
+            concrete_fields, m2m_fields = get_fingerprint_fields(model)
+            update_fields = [field.name for field in concrete_fields] + ["date_updated"]
+            if model is PropertyInfo:
+                update_fields += ["previous_price", "previous_lease"]
+            model.objects.bulk_update(rows, update_fields, batch_size=BULK_WRITE_BATCH_SIZE)
+
+        for field, changes in m2m_changes.items():
+            through = field.remote_field.through
+            source_column = f"{field.m2m_field_name()}_id"
+            target_column = f"{field.m2m_reverse_field_name()}_id"
+            through.objects.filter(**{f"{source_column}__in": [pk for pk, pks in changes]}).delete()
+            through.objects.bulk_create(
+                [
+                    through(**{source_column: pk, target_column: target_pk})
+                    for pk, pks in changes
+                    for target_pk in pks
+                ],
+                batch_size=BULK_WRITE_BATCH_SIZE,
+                ignore_conflicts=True,
+            )
+
+    def sync_children(self, created, updated):
+        """
+        Writes the staged children level by level. Children of new records
+        are inserted, children of existing records are diffed against their
+        db rows by fingerprint so only the delta is written.
+        """
+        insert_parents = list(created)
+        diff_parents = list(updated)
+
+        while insert_parents or diff_parents:
+            matches = {"skipped": [], "updated": [], "inserted": [], "deleted": []}
+            matches["inserted"].extend(child for parent in insert_parents for child in parent.children)
+
+            parents_by_model = OrderedDict()
+            for parent in diff_parents:
+                parents_by_model.setdefault(parent.model, []).append(parent)
+
+            for parent_model, parents in parents_by_model.items():
+                for model, parent_field in CHILDREN_RELATIONS.get(parent_model, []):
+                    rows_by_parent = defaultdict(list)
+                    for row in self.get_existing_children(
+                        model, parent_field, [parent.instance.pk for parent in parents]
+                    ):
+                        rows_by_parent[getattr(row, f"{parent_field}_id")].append(row)
+
+                    for parent in parents:
+                        self.match_children(
+                            [
+                                child
+                                for child in parent.children
+                                if child.model is model and child.parent_field == parent_field
+                            ],
+                            rows_by_parent.get(parent.instance.pk, []),
+                            matches,
+                        )
+
+            deleted_by_model = OrderedDict()
+            for row in matches["deleted"]:
+                deleted_by_model.setdefault(type(row), []).append(row.pk)
+            for model, pks in deleted_by_model.items():
+                model.objects.filter(pk__in=pks).delete()
+
+            self.update_rows_in_place(matches["updated"])
+
+            inserted_by_model = OrderedDict()
+            for staged in matches["inserted"]:
+                staged.build_instance()
+                inserted_by_model.setdefault(staged.model, []).append(staged)
+            for model, staged_records in inserted_by_model.items():
+                model.objects.bulk_create(
+                    [staged.instance for staged in staged_records],
+                    batch_size=BULK_WRITE_BATCH_SIZE,
+                )
+                bulk_set_many_to_many(model, staged_records)
+
+            self.child_rows_skipped_count += len(matches["skipped"])
+            self.child_rows_updated_count += len(matches["updated"])
+            self.child_rows_inserted_count += len(matches["inserted"])
+            self.child_rows_deleted_count += len(matches["deleted"])
+
+            # Children of inserted records are all new, the others are diffed again
+            insert_parents = matches["inserted"]
+            diff_parents = matches["skipped"] + [staged for staged, row, row_m2m_pks in matches["updated"]]
+
+    def add_geolocations(self, staged_listings):
+        geocoding_queue = []
+        for listing, property_staged in staged_listings:
+            if "Address" not in listing.keys():
+                self.missing_address_count += 1
+                continue
+
+            if ASYNC_GEOCODING:
+                geocoding_queue.append(property_staged.instance.pk)
+                continue
+
+            try:
+                added_geolocation, request_made = add_geolocation(property_staged.instance)
+            except Exception as e:
+                logger.error(f"Code Error: {e}")
+                continue
+
+            if added_geolocation:
+                self.geolocation_added_count += 1
+
+            if request_made:
+                self.geolocation_request_count += 1
+
+        # Sent once the chunk commits
+        queue_geocoding(geocoding_queue)
+        self.geolocation_queued_count += len(geocoding_queue)
+
+    def write_chunk_safely(self, listings_to_write):
+        # A failing chunk is retried one listing at a time so a single bad record
+        # doesn't drop the whole chunk
+        counters = self.get_counters()
+        try:
+            with transaction.atomic():
+                self.write_chunk(listings_to_write)
+        except Exception as e:
+            # Counters of the rolled back chunk are recounted by the retry
+            vars(self).update(counters)
+            logger.error(f"Bulk write of {len(listings_to_write)} listings failed: {e}")
+            logger.info("Retrying the chunk one listing at a time")
+            for listing, existing in listings_to_write:
+                try:
+                    with transaction.atomic():
+                        self.write_chunk([(listing, existing)])
+                except Exception as e:
+                    logger.info(e)
+                    logger.info("Error in updating record for listing: %s", listing.get("ID"))
+                    self.failed_count += 1
+
+    def log_summary(self):
+        logger.info("New Listings       : %s", self.new_listings_count)
+        logger.info("Updated Listings   : %s", self.updated_count)
+        logger.info("No Change Listings : %s", self.not_updated_count)
+        logger.info("No Address Listings: %s", self.missing_address_count)
+        logger.info("Failed Listings    : %s", self.failed_count)
+        logger.info(f"Added geolocation count: {self.geolocation_added_count}")
+        logger.info(f"Geolocation request count: {self.geolocation_request_count}")
+        logger.info(f"Geolocation queued count: {self.geolocation_queued_count}")
+        logger.info(
+            "Children rows skipped: %s, updated: %s, inserted: %s, deleted: %s",
+            self.child_rows_skipped_count,
+            self.child_rows_updated_count,
+            self.child_rows_inserted_count,
+            self.child_rows_deleted_count,
+        )
+
+
+# update_records: batched drop in replacement of db_write.update_records.
+# Prefilters every disk cache page, then buffers the changed listings up to BULK_WRITE_CHUNK_SIZE
+# and writes them chunk by chunk.
+def update_records(listing_disk_cache_manager, fetch_and_update_every_single_record=False):
+    # Picks up metadata refreshed by another process
+    metadata_lookup_registry.ensure_loaded()
+
+    writer = BulkRecordsWriter(fetch_and_update_every_single_record)
+
+    chunk = []
+    for rows in listing_disk_cache_manager.iter_rows():
+        listings_to_write, unchanged_count = prefilter_listings(
+            rows, writer.fetch_and_update_every_single_record
+        )
+        writer.not_updated_count += unchanged_count
+        chunk.extend(listings_to_write)
+        if len(chunk) >= BULK_WRITE_CHUNK_SIZE:
+            writer.write_chunk_safely(chunk)
+            chunk = []
+
+    if chunk:
+        writer.write_chunk_safely(chunk)
+
+    writer.log_summary()
+
+    # Wipe everything once it's committed, a rolled back sync is resumed from the disk cache
+    transaction.on_commit(listing_disk_cache_manager.wipe)
+
+    return True
@@ -0,0 +1,238 @@
+import decimal
+
+from core.shortcuts import convert_to_snakecase
+from crea_parser.utils import metadata_lookup_registry
+from dateutil import parser
+
+from .db_mapping import DDFManagerTypeCasting, rename_fields_dict
+from .ddf_logger import logger
+
+##Compiled field mappers, the hot path counterpart of db_write.filter_fields and DDFManagerTypeCasting.
+##A mapper is compiled once per (model, db_fields table, rename table): every DDF key seen is resolved
+##once to its django field and a caster function, mapping a record is then a plain dict walk.
+##The casters follow DDFManagerTypeCasting rule for rule.
+
+STRING_MODES = ("CharField", "TextField")
+INTEGER_MODES = ("SmallIntegerField", "IntegerField")
+RELATION_MODES = ("ForeignKey", "OneToOneField", "ManyToManyField")
+
+# Sentinel for DDF keys that don't map to a field of the model
+SKIP = None
+
+
+def get_lookup_name(value):
+    lookup_name = value.get("LookupName", None)
+    if lookup_name == "HeatingType":
+        # Same as DDFManagerTypeCasting, crea expects a space on the lookup name
+        return "Heating Type"
+    return lookup_name
+
+
+def cast_string(field_name, value):
+    return str(value)
+
+
+def cast_text_of_lookup(field_name, value):
+    # DDFManagerTypeCasting.LOOKUP_TEXT_FIELD_EXCEPTIONS, a lookup object is saved as its text
+    return str(value.get("#text")) if isinstance(value, dict) else str(value)
+
+
+def cast_integer(field_name, value):
+    try:
+        return int(value)
+    except Exception as e:
+        logger.error(f"Type casting failed on integer with value of {value}, returning value as string")
+        logger.error(f"Error message is: {e}")
+        return str(value)
+
+
+def cast_date(field_name, value):
+    try:
+        return parser.parse(value)
+    except TypeError:
+        logger.info("Type casting failed on datetime, might be already a datetime")
+        return value
+    except ValueError:
+        logger.info("Type casting failed on a date failed! ")
+        return None
+
+
+def cast_boolean(field_name, value):
+    if value == "true" or value == "1" or value == 1 or value is True:
+        return True
+    elif value == "false" or value == "0" or value == 0 or value is False:
+        return False
+    return None
+
+
+def cast_decimal(field_name, value):
+    if not value:
+        return None
+    try:
+        return decimal.Decimal(value)
+    except decimal.InvalidOperation:
+        logger.info("Type casting failed on a decimal failed! ")
+        return None
+
+
+def cast_single_lookup(field_name, value):
+    lookup_name = get_lookup_name(value) if isinstance(value, dict) else None
+    if not lookup_name:
+        # Skip foreign key or one to one field that has no lookup name
+        return None
+
+    if not metadata_lookup_registry.get_model(lookup_name):
+        logger.error(f"Can't get the specific lookup model for lookupname {lookup_name}")
+        return None
+
+    metadata_row = metadata_lookup_registry.get(lookup_name, value.get("ID"))
+    if not metadata_row:
+        logger.error(f"Lookup with {lookup_name} and id of {value} not found, Please check the fields")
+    return metadata_row
+
+
+def cast_multiple_lookup(field_name, value):
+    lookup_name = get_lookup_name(value) if isinstance(value, dict) else None
+    if not lookup_name:
+        return None
+
+    if not metadata_lookup_registry.get_model(lookup_name):
+        logger.error(f"Can't get the specific lookup model for lookupname {lookup_name}")
+        return None
+
+    rows = metadata_lookup_registry.get_many(lookup_name, value.get("ID", "").split(","))
+    if not rows:
+        logger.error(f"Lookup with {lookup_name} and id of {value} not found, Please check the fields")
+    return rows
+
+
+def cast_unknown(field_name, value):
+    logger.error(f"Can't get the mode for field {field_name} with value of {value}, trying to typecast to string")
+    return str(value)
+
+
+def cast_one_to_one(field_name, value):
+    lookup_name = get_lookup_name(value) if isinstance(value, dict) else None
+    if not lookup_name:
+        # Skip one to one field that has no lookup name
+        return None
+    # DDFManagerTypeCasting has no one to one lookup, a value with a lookup name falls through to the string cast
+    return cast_unknown(field_name, value)
+
+
+CASTERS = {
+    "DateTimeField": cast_date,
+    "BooleanField": cast_boolean,
+    "DecimalField": cast_decimal,
+    "ForeignKey": cast_single_lookup,
+    "ManyToManyField": cast_multiple_lookup,
+    "OneToOneField": cast_one_to_one,
+}
+CASTERS.update(dict.fromkeys(STRING_MODES, cast_string))
+CASTERS.update(dict.fromkeys(INTEGER_MODES, cast_integer))
+
+
+def get_caster(model, field_name, internal_type):
+    for field_exception in DDFManagerTypeCasting.LOOKUP_TEXT_FIELD_EXCEPTIONS:
+        if (
+            field_exception.get("model", "") == model.__name__
+            and field_exception.get("field_name") == field_name
+            and internal_type in STRING_MODES
+        ):
+            return cast_text_of_lookup
+    return CASTERS.get(internal_type, cast_unknown)
+
+
+class CompiledFieldMapper(object):
+    """
+    Maps DDF records of a single model to (fields, m2m fields) dictionaries,
+    the same output as db_write.filter_fields.
+
+    The key table {DDF key: (django field, caster, is m2m)} is filled the first
+    time a DDF key is seen, later records only do dictionary lookups.
+    """
+
+    def __init__(self, model, table_fields, rename_fields=rename_fields_dict):
+        self.model = model
+        self.table_fields = table_fields
+        self.rename_fields = rename_fields
+        self.key_table = {}
+
+    def compile_key(self, key):
+        snake_case_key = convert_to_snakecase(key)
+        if key in self.rename_fields:
+            django_key = self.rename_fields[key]
+        elif snake_case_key in self.table_fields:
+            django_key = snake_case_key
+        else:
+            return SKIP
+
+        if django_key not in self.table_fields:
+            # A renamed key the model doesn't have
+            return SKIP
+
+        internal_type = self.table_fields[django_key].get("internal_type", "")
+        return (
+            django_key,
+            get_caster(self.model, django_key, internal_type),
+            internal_type == "ManyToManyField",
+        )
+
+    def cast(self, django_key, caster, value):
+        try:
+            if isinstance(value, dict) and "LookupName" not in value and value.get("Unit", None):
+                # PropertyMeasureUnit as stated on the crea docs, a value and its unit
+                output = {}
+                raw_unit_value = value.get("#text", None)
+                if raw_unit_value:
+                    output[django_key] = cast_decimal(django_key, raw_unit_value)
+                output[f"{django_key}_unit"] = cast_single_lookup(
+                    django_key, {"LookupName": "MeasureUnit", "ID": value.get("Unit")}
+                )
+                return output
+            return {django_key: caster(django_key, value)}
+        except Exception as e:
+            logger.error(f"Something went wrong on type casting...")
+            logger.error(f"Error message: {e}")
+            logger.error(f"Internal values are {django_key}, {value}")
+            return {django_key: None}
+
+    def map(self, record):
+        output = {}
+        m2m_output = {}
+        if not record:
+            return output, m2m_output
+
+        key_table = self.key_table
+        for key, value in record.items():
+            if not value:
+                continue
+
+            try:
+                compiled = key_table[key]
+            except KeyError:
+                compiled = key_table[key] = self.compile_key(key)
+
+            if compiled is SKIP:
+                continue
+
+            django_key, caster, is_m2m = compiled
+            if is_m2m:
+                m2m_output.update(self.cast(django_key, caster, value))
+            else:
+                output.update(self.cast(django_key, caster, value))
+        return output, m2m_output
+
+
+_compiled_mappers = {}
+
+
+def get_field_mapper(model, table_fields, rename_fields=rename_fields_dict):
+    """
+    Returns the compiled mapper of a model, compiled on the first call
+    """
+    key = (model, id(table_fields), id(rename_fields))
+    mapper = _compiled_mappers.get(key)
+    if mapper is None:
+        mapper = _compiled_mappers[key] = CompiledFieldMapper(model, table_fields, rename_fields)
+    return mapper
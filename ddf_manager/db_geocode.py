@@ -0,0 +1,315 @@
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from core.celery import app
+from core.settings.base import GEOCODE_API_KEY, GEOCODE_URL
+from crea_parser.models import Address, GeocodedAddress, Geolocation, PropertySearchIndex
+from django.contrib.gis.geos import Point
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
+
+from .ddf_logger import logger
+from .settings import BULK_WRITE_BATCH_SIZE, GEOCODE_BATCH_SIZE, GEOCODE_CONCURRENCY, GEOCODE_RATE_LIMIT
+
+##Queued counterpart of db_summary.add_geolocation.
+##The writers only queue the ids of the written properties (queue_geocoding), the geocoding itself runs in
+##the crea_parser.tasks.geocode_ddf_properties task: addresses are normalized and coalesced, resolved from the
+##GeocodedAddress cache table first, only the misses are requested from the geocoder through a pooled and
+##rate limited session, then Geolocation rows are written in bulk.
+
+GEOCODE_TASK_NAME = "crea_parser.tasks.geocode_ddf_properties"
+
+BACKFILL_CHECKPOINT_KEY = "ddf_geocode_backfill_checkpoint"
+
+ADDRESS_FIELDS = ("street_address", "city", "province", "postal_code")
+
+
+def get_address_query(address):
+    # Same query as db_summary.add_geolocation
+    return " ".join(str(address.get(field) or "") for field in ADDRESS_FIELDS)
+
+
+def normalize_address(query):
+    # Case, punctuation and spacing don't change the geocoded position
+    return " ".join(re.sub(r"[^\w\s]", " ", query.lower()).split())
+
+
+class RateLimiter(object):
+    """
+    Spaces the requests of every thread sharing it to `rate` requests per second
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_request = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_request - now
+            self.next_request = max(now, self.next_request) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class BatchGeocoder(object):
+    """
+    Geocodes batches of addresses against the GeocodedAddress cache.
+
+    BatchGeocoder Constructor
+    :param `concurrency': Maximum number of geocoder requests in flight.
+    :param `rate_limit': Maximum number of geocoder requests per second, 0 disables the limit.
+    """
+
+    def __init__(self, concurrency=GEOCODE_CONCURRENCY, rate_limit=GEOCODE_RATE_LIMIT):
+        self.concurrency = max(1, concurrency)
+        self.rate_limiter = RateLimiter(rate_limit)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(10, self.concurrency))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.cache_hit_count = 0
+        self.request_count = 0
+        self.failed_request_count = 0
+
+    def request(self, query):
+        """
+        Returns (found, Point or None), found is None when the request itself failed
+        """
+        self.rate_limiter.wait()
+        json_response = None
+        try:
+            response = self.session.get(
+                GEOCODE_URL, params={"q": query, "apiKey": GEOCODE_API_KEY}, timeout=30
+            )
+            json_response = response.json()
+            if response.status_code != 200:
+                logger.error(f"{json_response}")
+                return None, None
+
+            items = json_response.get("items") or []
+            if not items:
+                return False, None
+
+            location = items[0]["position"]
+            return True, Point(float(location["lng"]), float(location["lat"]))
+        except Exception as e:
+            logger.error(e)
+            logger.error(f"The json response of the request: {json_response}")
+            return None, None
+
+    def geocode(self, queries):
+        """
+        Geocodes {normalized address: query}, returns {normalized address: Point or None}.
+        Only the addresses missing from the cache are requested, the answers are cached.
+        """
+        coordinates = {}
+        for row in GeocodedAddress.objects.filter(normalized_address__in=list(queries.keys())).values_list(
+            "normalized_address", "coordinates"
+        ):
+            coordinates[row[0]] = row[1]
+        self.cache_hit_count += len(coordinates)
+
+        misses = [normalized for normalized in queries if normalized not in coordinates]
+        if not misses:
+            return coordinates
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = list(executor.map(lambda normalized: self.request(queries[normalized]), misses))
+        self.request_count += len(misses)
+
+        cache_rows = []
+        for normalized, (found, point) in zip(misses, results):
+            if found is None:
+                # Not cached, the next run tries again
+                self.failed_request_count += 1
+                continue
+            coordinates[normalized] = point
+            cache_rows.append(GeocodedAddress(normalized_address=normalized, coordinates=point))
+
+        GeocodedAddress.objects.bulk_create(cache_rows, batch_size=BULK_WRITE_BATCH_SIZE, ignore_conflicts=True)
+        return coordinates
+
+
+def write_coordinates(coordinates_by_property):
+    """
+    Writes {property id: Point} to the Geolocation table with one bulk_update and one bulk_create
+    """
+    geolocations = {
+        geolocation.connected_property_id: geolocation
+        for geolocation in Geolocation.objects.filter(connected_property__in=list(coordinates_by_property.keys()))
+    }
+
+    to_update = []
+    to_create = []
+    now = timezone.now()
+    for property_id, point in coordinates_by_property.items():
+        geolocation = geolocations.get(property_id)
+        if geolocation is None:
+            to_create.append(Geolocation(connected_property_id=property_id, coordinates=point))
+        else:
+            geolocation.coordinates = point
+            geolocation.date_updated = now
+            to_update.append(geolocation)
+
+    with transaction.atomic():
+        Geolocation.objects.bulk_update(to_update, ["coordinates", "date_updated"], batch_size=BULK_WRITE_BATCH_SIZE)
+        Geolocation.objects.bulk_create(to_create, batch_size=BULK_WRITE_BATCH_SIZE, ignore_conflicts=True)
+        PropertySearchIndex.update_coordinates(coordinates_by_property)
+
+
+def geocode_addresses(addresses, geocoder):
+    """
+    Geocodes Address values rows (connected_property_id and ADDRESS_FIELDS) and writes the
+    coordinates of their properties. Returns the number of geolocations written.
+    """
+    # Duplicated addresses are only geocoded once
+    queries = {}
+    normalized_by_property = {}
+    for address in addresses:
+        query = get_address_query(address)
+        normalized = normalize_address(query)
+        if not normalized:
+            continue
+        queries.setdefault(normalized, query)
+        normalized_by_property[address["connected_property_id"]] = normalized
+
+    coordinates = geocoder.geocode(queries) if queries else {}
+    coordinates_by_property = {
+        property_id: coordinates[normalized]
+        for property_id, normalized in normalized_by_property.items()
+        if coordinates.get(normalized) is not None
+    }
+    write_coordinates(coordinates_by_property)
+    return len(coordinates_by_property)
+
+
+def geocode_properties(property_ids, override=False, geocoder=None):
+    """
+    Geocodes the address of every property, properties that already have coordinates are skipped
+    unless override is set. Returns the counters of the run.
+    """
+    geocoder = geocoder or BatchGeocoder()
+
+    skipped_ids = set()
+    if not override:
+        skipped_ids = set(
+            Geolocation.objects.filter(
+                connected_property__in=property_ids, coordinates__isnull=False
+            ).values_list("connected_property_id", flat=True)
+        )
+
+    addresses = Address.objects.filter(
+        connected_property__in=[property_id for property_id in property_ids if property_id not in skipped_ids]
+    ).values("connected_property_id", *ADDRESS_FIELDS)
+    geolocations_added = geocode_addresses(addresses, geocoder)
+
+    counters = {
+        "properties": len(property_ids),
+        "skipped": len(skipped_ids),
+        "cache_hits": geocoder.cache_hit_count,
+        "requests": geocoder.request_count,
+        "failed_requests": geocoder.failed_request_count,
+        "geolocations_added": geolocations_added,
+    }
+    logger.info(f"Geocoded properties: {counters}")
+    return counters
+
+
+def queue_geocoding(property_ids):
+    """
+    Queues the geocoding of the properties once the current transaction commits,
+    the write path never waits on the geocoder
+    """
+    property_ids = list(property_ids)
+    if not property_ids:
+        return
+
+    def send_tasks():
+        for start in range(0, len(property_ids), GEOCODE_BATCH_SIZE):
+            try:
+                app.send_task(GEOCODE_TASK_NAME, args=[property_ids[start : start + GEOCODE_BATCH_SIZE]])
+            except Exception as e:
+                logger.error(e)
+                logger.error(f"Failed to queue the geocoding of the properties {start} to {start + GEOCODE_BATCH_SIZE}")
+
+    transaction.on_commit(send_tasks)
+
+
+def get_backfill_checkpoint_key(override):
+    return f"{BACKFILL_CHECKPOINT_KEY}_{'override' if override else 'missing'}"
+
+
+def backfill_coordinates(override=False, chunk_size=GEOCODE_BATCH_SIZE, restart=False, geocoder=None, report=None):
+    """
+    Geocodes the addresses of every active property, only the ones without coordinates unless override is set.
+
+    The addresses are selected with a single join and streamed in chunks ordered by property id.
+    The last property id of every written chunk is checkpointed in the cache, an interrupted backfill
+    resumes after it unless restart is set. `report` gets a progress line after every chunk.
+    Returns the counters of the run.
+    """
+    geocoder = geocoder or BatchGeocoder()
+    report = report or logger.info
+    checkpoint_key = get_backfill_checkpoint_key(override)
+
+    addresses = Address.objects.filter(connected_property__is_active=True)
+    if not override:
+        addresses = addresses.filter(
+            Q(connected_property__Geo__isnull=True) | Q(connected_property__Geo__coordinates__isnull=True)
+        )
+    addresses = addresses.order_by("connected_property_id").values("connected_property_id", *ADDRESS_FIELDS)
+
+    if restart:
+        cache.delete(checkpoint_key)
+    checkpoint = cache.get(checkpoint_key) or 0
+    if checkpoint:
+        report(f"Resuming the backfill after property {checkpoint}")
+
+    total = addresses.filter(connected_property_id__gt=checkpoint).count()
+    report(f"{total} properties to geocode")
+
+    processed_count = 0
+    geolocations_added = 0
+    start = time.monotonic()
+    while True:
+        chunk = list(addresses.filter(connected_property_id__gt=checkpoint)[:chunk_size])
+        if not chunk:
+            break
+
+        geolocations_added += geocode_addresses(chunk, geocoder)
+        processed_count += len(chunk)
+        checkpoint = chunk[-1]["connected_property_id"]
+        cache.set(checkpoint_key, checkpoint, None)
+
+        elapsed = max(time.monotonic() - start, 0.001)
+        report(
+            f"{processed_count}/{total} properties, {geolocations_added} geolocations added, "
+            f"{processed_count / elapsed:.1f} properties/s, {geocoder.request_count / elapsed:.1f} requests/s, "
+            f"{geocoder.cache_hit_count} cache hits"
+        )
+
+    # Done, the next backfill starts over
+    cache.delete(checkpoint_key)
+
+    counters = {
+        "properties": processed_count,
+        "cache_hits": geocoder.cache_hit_count,
+        "requests": geocoder.request_count,
+        "failed_requests": geocoder.failed_request_count,
+        "geolocations_added": geolocations_added,
+        "seconds": round(time.monotonic() - start, 2),
+    }
+    logger.info(f"Coordinates backfill: {counters}")
+    return counters
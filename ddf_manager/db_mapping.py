@@ -2,7 +2,7 @@ import decimal
 import parser
 
 from crea_parser.models import *
-from crea_parser.submodels.metadata import metadata_models
+from crea_parser.utils import metadata_lookup_registry
 from .ddf_logger import logger
 
 ###This file is used to map the values retrived from the ddf_client to the Django database.
@@ -194,14 +194,9 @@ class DDFManagerTypeCasting(object):
             logger.error(f"Internal values are {self.mode}, {self.value}, {self.lookup_name}")
             return {self.field_name: None}
 
-    def _search_for_metadata_model_lookup(self):
-
-        for model in metadata_models:
-            if model.lookup_name == self.lookup_name:
-                specific_lookup_model = model
-                break
-        
-        return specific_lookup_model
+    def _search_for_metadata_model_lookup(self, lookup_name=None):
+        # Resolved from the preloaded registry, no query involved
+        return metadata_lookup_registry.get_model(lookup_name or self.lookup_name)
 
     def _type_cast_to_measure_unit_and_value(self):
         logger.info(f"Measure unit with value detected, typecasting measure unit with value")
@@ -237,7 +232,9 @@ class DDFManagerTypeCasting(object):
         specific_lookup_model = self._search_for_metadata_model_lookup()
 
         if specific_lookup_model:
-            queryset_list = list(specific_lookup_model.active_objects.filter(metadata_entry_id__in=self.value.get("ID", "").split(",")))
+            queryset_list = metadata_lookup_registry.get_many(
+                self.lookup_name, self.value.get("ID", "").split(",")
+            )
 
             if not queryset_list:
                 logger.error(f"Lookup with {self.lookup_name} and id of {self.value} not found, Please check the fields")
@@ -262,10 +259,10 @@ class DDFManagerTypeCasting(object):
         logger.info(f"Searching for a single lookup for {lookup_name} and value of {value}")
 
         specific_lookup_model = None
-        specific_lookup_model = self._search_for_metadata_model_lookup()
+        specific_lookup_model = self._search_for_metadata_model_lookup(lookup_name)
 
         if specific_lookup_model:
-            metadata_row = get_object_or_None(specific_lookup_model.active_objects, metadata_entry_id=value.get('ID'))
+            metadata_row = metadata_lookup_registry.get(lookup_name, value.get('ID'))
             if not metadata_row:
                 logger.error(f"Lookup with {lookup_name} and id of {value} not found, Please check the fields")
             else:
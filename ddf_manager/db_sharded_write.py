@@ -0,0 +1,83 @@
+import zlib
+
+from core.utils import DiskCacheManager
+from django.db import transaction
+
+from . import db_bulk_write, db_write
+from .ddf_logger import logger
+from .settings import BULK_WRITE_RECORDS
+
+##Sharded ingest, the fan-out counterpart of manager.update_db.
+##The fetched listings are partitioned into shards spilled to their own disk cache,
+##every shard is then mapped and written by its own celery task in its own transaction
+##(see crea_parser.tasks.write_ddf_listings_shard), so a failing shard only rolls back itself.
+
+SHARD_DISK_CACHE_NAME = "fetch_listing_disk_cache_shard"
+
+
+def get_shard_name(index):
+    return f"{SHARD_DISK_CACHE_NAME}_{index}"
+
+
+def get_shard_index(listing_id, shards):
+    # Stable across processes, the same listing always lands on the same shard
+    return zlib.crc32(str(listing_id).encode()) % shards
+
+
+def partition_listings(listing_disk_cache_manager, shards):
+    """
+    Splits the listings of a disk cache into `shards` disk caches.
+    Duplicates of a listing stay on the same shard and keep their order.
+    Returns the names of the shards that got listings, the source disk cache is left to the caller
+    to wipe once the shards are recorded.
+    """
+    shard_caches = [DiskCacheManager(disk_cache_name=get_shard_name(index)) for index in range(shards)]
+    for shard_cache in shard_caches:
+        shard_cache.initialize_disk_cache()
+
+    try:
+        for rows in listing_disk_cache_manager.iter_rows():
+            shard_rows = [[] for _ in range(shards)]
+            for listing in rows:
+                shard_rows[get_shard_index(listing.get("ID", ""), shards)].append(listing)
+
+            for shard_cache, listings in zip(shard_caches, shard_rows):
+                if listings:
+                    shard_cache.insert_row_on_disk(listings)
+    finally:
+        for shard_cache in shard_caches:
+            shard_cache.close()
+
+    shard_names = []
+    for shard_cache in shard_caches:
+        if shard_cache.disk_cache_count:
+            shard_names.append(shard_cache.disk_cache_name)
+            logger.info(f"Shard {shard_cache.disk_cache_name} has {shard_cache.disk_cache_count} listings")
+        else:
+            shard_cache.wipe()
+
+    return shard_names
+
+
+def write_shard(shard_name, fetch_and_update_every_single_record=False):
+    """
+    Maps and writes a single shard in its own transaction, the shard disk cache is wiped once written
+    """
+    shard_cache = DiskCacheManager(disk_cache_name=shard_name)
+    if not shard_cache.resume_disk_cache():
+        logger.warning(f"Shard {shard_name} is empty or missing, nothing to write")
+        shard_cache.wipe()
+        return True
+
+    logger.info(f"Writing shard {shard_name} with {shard_cache.disk_cache_count} listings")
+    try:
+        with transaction.atomic():
+            if BULK_WRITE_RECORDS:
+                return db_bulk_write.update_records(shard_cache, fetch_and_update_every_single_record)
+            return db_write.update_records(shard_cache, fetch_and_update_every_single_record)
+    except Exception as e:
+        logger.error(e)
+        logger.error(f"Error in writing shard {shard_name}, changes of the shard have been ignored")
+        # The shard is kept on disk, the resumed sync run writes it again
+        shard_cache.close()
+        return False
@@ -1,9 +1,13 @@
-from core.shortcuts import get_object_or_None, convert_to_snakecase
+from core.shortcuts import get_object_or_None
 from dateutil import parser
+from django.db import transaction
 from django.utils import timezone
 
+from .db_field_mapper import get_field_mapper
+from .db_geocode import queue_geocoding
 from .db_mapping import *
 from .db_summary import *
+from .settings import ASYNC_GEOCODING
 
 ##This file maps the DDF data retrived by the ddf_client to the proper table in the database.
 
@@ -11,56 +15,10 @@ from .db_summary import *
 ##https://www.crea.ca/wp-content/uploads/2016/02/Data_Distribution_Facility_Data_Feed_Technical_Documentation.pdf
 
 
-def handle_filtered_field(TABLE, django_key, input, field_name_and_internal_value, ddf_key):
-    # Handle typecast for fields
-    logger.info(f"Typecasting the django key of {django_key} and the ddf_key of {ddf_key}")
-
-    type_casted_fields_and_values = DDFManagerTypeCasting(
-        TABLE,
-        django_key,
-        input[ddf_key],
-        field_name_and_internal_value[django_key].get("internal_type", "")
-    ).type_cast_field()
-    return type_casted_fields_and_values
-
-# Adds new attribute to object with a corresponding key
-def insert_field_keys_to_output(output_alias, to_insert):
-    for key in to_insert.keys():
-        output_alias[key] = to_insert[key]
-
-    return output_alias
-
 # filter_fields: used to get fields that are neither a list nor a dictionary elements for saving in db. Also renames the fields if needed.
+# The key resolution and type casting are compiled once per model, see db_field_mapper.py
 def filter_fields(TABLE, input, field_name_and_internal_value, rename_fields):
-    output = {}
-    m2m_output = {}
-    if input:
-        for key in input.keys():
-            snake_case_input_key = convert_to_snakecase(key)
-            if not input[key]:
-                logger.debug(f"Null value or no key, while getting the key '{key}' in the passed object '{input}'")
-                continue
-            # rename if in rename_fields
-            elif key in rename_fields or snake_case_input_key in field_name_and_internal_value.keys():
-                django_key = snake_case_input_key
-
-                if key in rename_fields:
-                    django_key = rename_fields[key]
-
-                # Typecast and inserts the typecasted fields to their respective outputs
-                if field_name_and_internal_value[django_key].get("internal_type", "") == "ManyToManyField":
-                    m2m_output = insert_field_keys_to_output(m2m_output, handle_filtered_field(TABLE, django_key, input, field_name_and_internal_value, key))
-                else:
-                    output = insert_field_keys_to_output(output, handle_filtered_field(TABLE, django_key, input, field_name_and_internal_value, key))
-                
-            elif (isinstance(input[key], list)
-                or isinstance(input[key], dict)):
-                logger.debug(f"Skipping list with dictionary")
-                logger.debug(f"A list and dictionary instance with a key of {key} is skipped since it's not part of the field table")
-                logger.debug(f"NOTE: this might be a children property")
-                logger.debug(f"The object in the input is {input[key]}")
-                continue
-    return output, m2m_output
+    return get_field_mapper(TABLE, field_name_and_internal_value, rename_fields).map(input)
 
 
 def finalize_table_data(TABLE, table_fields, record_obj, record_filtered, m2m_record_filtered, **kwargs):
@@ -117,7 +75,7 @@ def check_if_exists(listing, fetch_and_update_every_single_record):
     try:
         last_updated = parser.parse(listing["LastUpdated"])
     except ValueError:
-        logger.debug(f"Property with and id of {row.pk} wasn't able to get a last updated row")
+        logger.debug(f"Property with and id of {obj.pk} wasn't able to get a last updated row")
         last_updated = datetime.datetime(2020,5,1)
 
     if obj.last_updated == last_updated and fetch_and_update_every_single_record == False:
@@ -129,6 +87,54 @@ def check_if_exists(listing, fetch_and_update_every_single_record):
     return True, obj, creation_date
 
 
+def parse_listing_last_updated(listing):
+    try:
+        return parser.parse(listing["LastUpdated"])
+    except (KeyError, ValueError, OverflowError):
+        logger.debug(f"Listing {listing.get('ID')} wasn't able to get a last updated value")
+        return None
+
+
+# prefilter_listings: batched check_if_exists for a whole disk cache page.
+# Loads the existing (pk, ddf_id, last_updated, creation_date) of every listing of the page with a single query
+# and drops the unchanged listings before any mapping work.
+# Returns the (listing, existing) pairs to write, existing is None for new listings, and the number of skipped listings.
+def prefilter_listings(listings, fetch_and_update_every_single_record=False):
+    # Later duplicates of the same ID win
+    unique_listings = {}
+    skipped_count = 0
+    for listing in listings:
+        if not listing.get("ID"):
+            logger.error("Couldn't create Property object for Listing: %s", listing)
+            continue
+        if listing["ID"] in unique_listings:
+            skipped_count += 1
+            del unique_listings[listing["ID"]]
+        unique_listings[listing["ID"]] = listing
+
+    existing_listings = {
+        row["ddf_id"]: row
+        for row in Property.objects.filter(ddf_id__in=list(unique_listings.keys())).values(
+            "pk", "ddf_id", "last_updated", "creation_date"
+        )
+    }
+
+    to_write = []
+    for ddf_id, listing in unique_listings.items():
+        existing = existing_listings.get(ddf_id)
+        if (
+            existing is not None
+            and not fetch_and_update_every_single_record
+            and existing["last_updated"] == parse_listing_last_updated(listing)
+        ):
+            logger.debug("Listing %s found without updates", ddf_id)
+            skipped_count += 1
+            continue
+        to_write.append((listing, existing))
+
+    return to_write, skipped_count
+
+
 ##Maps all DDF tables that are children of the 'office' table in DDF to the db
 def add_office_children(office, office_obj):
     for (item, itemClass, item_db_fields, single_element_dict) in office_children:
@@ -314,6 +320,9 @@ def add_property_children(listing, property_obj):
 # It received 'new_listings' as a list of dictionaries and it applied the db updates accordingly.
 # This function updates only records and is not responsible on handling photos.
 def update_records(listing_disk_cache_manager, fetch_and_update_every_single_record=False):
+    # Picks up metadata refreshed by another process
+    metadata_lookup_registry.ensure_loaded()
+
 
     new_listings_count = 0
     updated_count = 0
@@ -321,30 +330,33 @@ def update_records(listing_disk_cache_manager, fetch_and_update_every_single_rec
     missing_address_count = 0
     geolocation_added_count = 0
     geolocation_request_count = 0
+    geolocation_queued_count = 0
     progress_count = 0
 
-    for key in listing_disk_cache_manager.get_all_disk_saved_keys():
-        new_listings = listing_disk_cache_manager.get_disk_row(key)
-        for listing in new_listings:
+    for new_listings in listing_disk_cache_manager.iter_rows():
+        listings_to_write, unchanged_count = prefilter_listings(
+            new_listings, fetch_and_update_every_single_record
+        )
+        not_updated_count += unchanged_count
+        geocoding_queue = []
+        written_property_ids = []
+
+        for listing, existing in listings_to_write:
             try:
-                listing_exist, listing_instance, creation_date = check_if_exists(
-                    listing, fetch_and_update_every_single_record
-                )
+                property_obj = None
                 # used to keep track of orginal creation date
-                if listing_exist:
-                    if listing_instance:
-                        listing["creation_date"] = creation_date
-                        logger.debug(
-                            "Listing %s is updated old ts:%s new ts:%s",
-                            listing["ID"],
-                            creation_date,
-                            listing["LastUpdated"],
-                        )
-                        updated_count += 1
-                    else:
-                        logger.debug("Listing %s found without updates", listing["ID"])
-                        not_updated_count += 1
-                        continue
+                if existing:
+                    creation_date = existing["creation_date"]
+                    if creation_date is None:
+                        creation_date = timezone.now()
+                    listing["creation_date"] = creation_date
+                    logger.debug(
+                        "Listing %s is updated old ts:%s new ts:%s",
+                        listing["ID"],
+                        creation_date,
+                        listing["LastUpdated"],
+                    )
+                    updated_count += 1
                 else:
                     logger.debug("Creating New Listing %s", listing["ID"])
                     listing["creation_date"] = listing["LastUpdated"]
@@ -355,7 +367,7 @@ def update_records(listing_disk_cache_manager, fetch_and_update_every_single_rec
                 # A workaround on the bug where the property and recently viewed, cascades
                 # Still ugly, and we still need to refactor the ddf manager if we have the time
 
-                if not listing_instance:
+                if not existing:
                     property_obj = update_table(
                         listing, Property, db_fields["property_fields"]
                     )
@@ -367,7 +379,8 @@ def update_records(listing_disk_cache_manager, fetch_and_update_every_single_rec
                     if record_filtered:
                         error_message = ""
                         try:
-                            property_obj = listing_instance
+                            # Only the pk is known, save only the updated fields
+                            property_obj = Property(pk=existing["pk"])
                             property_obj.listing_id = record_filtered.get(
                                 "listing_id", ""
                             )
@@ -380,7 +393,16 @@ def update_records(listing_disk_cache_manager, fetch_and_update_every_single_rec
                             )
                             # Bring back to life the properties that was updated that is still here
                             property_obj.is_active = True
-                            property_obj.save()
+                            property_obj.save(
+                                update_fields=[
+                                    "listing_id",
+                                    "ddf_id",
+                                    "last_updated",
+                                    "creation_date",
+                                    "is_active",
+                                    "date_updated",
+                                ]
+                            )
                             wipe_children_table(property_obj)
                         except Exception as e:
                             error_message = e
@@ -392,10 +414,13 @@ def update_records(listing_disk_cache_manager, fetch_and_update_every_single_rec
                     # add the rest of the records
                     add_property_children(listing, property_obj)
 
+                    written_property_ids.append(property_obj.pk)
                     logger.info(f"Property with a ddf id {property_obj.ddf_id} is queued for insertion")
                     progress_count += 1
                     logger.info(f"{progress_count} number of property queued for insertion")
-                    if "Address" in listing.keys():
+                    if "Address" in listing.keys() and ASYNC_GEOCODING:
+                        geocoding_queue.append(property_obj.pk)
+                    elif "Address" in listing.keys():
                         added_geolocation, request_made = add_geolocation(property_obj)
 
                         if added_geolocation:
@@ -415,14 +440,21 @@ def update_records(listing_disk_cache_manager, fetch_and_update_every_single_rec
                 logger.info("Error in updating record for listing: %s", listing["ID"])
                 continue
 
+        queue_geocoding(geocoding_queue)
+        geolocation_queued_count += len(geocoding_queue)
+
+        # Rebuilds the search rows of the page listings, once their children are written
+        PropertySearchIndex.refresh(written_property_ids)
+
     logger.info("New Listings       : %s", new_listings_count)
     logger.info("Updated Listings   : %s", updated_count)
     logger.info("No Change Listings : %s", not_updated_count)
     logger.info("No Address Listings: %s", missing_address_count)
     logger.info(f"Added geolocation count: {geolocation_added_count}")
     logger.info(f"Geolocation request count: {geolocation_request_count}")
+    logger.info(f"Geolocation queued count: {geolocation_queued_count}")
 
-    # Wipe everything, we don't need it anymore
-    listing_disk_cache_manager.wipe()
+    # Wipe everything once it's committed, a rolled back sync is resumed from the disk cache
+    transaction.on_commit(listing_disk_cache_manager.wipe)
 
     return True
@@ -7,7 +7,9 @@ from core.utils import DiskCacheManager
 from ..ddf_logger import *
 from ..rets_lib import Session
 from ..settings import *
+from .ddf_diff import diff_listings
 from .ddf_media import MediaHandler
+from .ddf_page_fetcher import PageFetcher
 from .ddf_s3 import S3Handler
 from .ddf_streamer import Streamer
 
@@ -27,18 +29,29 @@ class DDFClient:
 
     def __init__(self, media_path, format_type="STANDARD-XML-Encoded", s3_reader=True):
         try:
-            self.rets_session = Session(CREA_LOGIN_URL, CREA_USERNAME, CREA_PASSWORD)
+            self.rets_session = Session(
+                CREA_LOGIN_URL,
+                CREA_USERNAME,
+                CREA_PASSWORD,
+                retries=RETS_REQUEST_RETRIES,
+                backoff=RETS_REQUEST_BACKOFF,
+                timeout=RETS_REQUEST_TIMEOUT,
+            )
             if not s3_reader:
                 self.media_handler = MediaHandler(media_path, self.rets_session)
             else:
                 self.media_handler = S3Handler(media_path, self.rets_session)
             self.streamer = Streamer(self.rets_session, format_type)
+            self.page_fetcher = PageFetcher(rets_session=self.rets_session)
+            # crea_parser SyncRun checkpointing the update, set by the manager
+            self.sync_run = None
             self.format = format_type
         except Exception as e:
             logger.error(e)
 
         self.listing_disk_cache_manager = DiskCacheManager(
-            disk_cache_name="fetch_listing_disk_cache"
+            disk_cache_name="fetch_listing_disk_cache",
+            id_key="ListingKey" if format_type == "COMPACT-DECODED" else "ID",
         )
 
         return super().__init__()
@@ -49,8 +62,23 @@ class DDFClient:
 
     def logout(self):
         """Uses Streamer Object to logout"""
+        logger.info("RETS transport: %s", self.rets_session.get_transport_stats())
         return self.streamer.logout()
 
+    def checkpoint(self, stage=None, **progress):
+        """Records the progress of the update on the sync run, if any"""
+        if self.sync_run is None:
+            return
+        try:
+            self.sync_run.checkpoint(stage, **progress)
+        except Exception as e:
+            logger.error(e)
+            logger.error("Failed to checkpoint the sync run")
+
+    def is_stage_done(self, stage):
+        """Returns True if a resumed sync run already completed the stage"""
+        return self.sync_run is not None and self.sync_run.is_done(stage)
+
     @staticmethod
     def get_gmt_time(**kwargs):
         """Gets GMT time and converts it to 'YYYY-MM-DDTHH:MM:SSZ' format"""
@@ -113,15 +141,8 @@ class DDFClient:
                         logger.error("%s was not found in :%s", id_key, item)
                 return listings_keys
             else:
-                for key in self.listing_disk_cache_manager.get_all_disk_saved_keys():
-                    input_list = self.listing_disk_cache_manager.get_disk_row(key)
-                    for item in input_list:
-                        try:
-                            listings_keys.append(item[id_key])
-                        except Exception as e:
-                            logger.error(e)
-                            logger.error("%s was not found in :%s", id_key, item)
-                return listings_keys
+                # ids are indexed by the disk cache, no need to read the rows back
+                return self.listing_disk_cache_manager.get_listing_ids()
         except Exception as e:
             traceback.print_exc()
             logger.error(e)
@@ -135,40 +156,43 @@ class DDFClient:
             2- The offset for the first record.The API is limited to 100 records per call, so incase there is a 1000 records since that timestamp. 10 API calls are required with offsets
                 0,100,200... 900.
             3- limit: The limit for number of active records to be retrived. Set to SESSION_LISTINGS_COUNT by default
-        Returns (True,listings) if the call was successful"""
+        Returns (True, count) if the call was successful, (False, count) if a page still failed after its retries,
+        the listings downloaded so far are kept in the disk cache so a resumed sync run only fetches the missing ones"""
 
         downloaded_by_id_count = 0
+        # Listings downloaded by a previous attempt of a resumed sync run
+        downloaded_before = self.sync_run.by_id_downloaded if self.sync_run is not None else 0
         if limit:
             listings_keys = listings_keys[:limit]
         try:
-            # loop in group of 100s
-            for offset in range(0, len(listings_keys), SESSION_LISTINGS_COUNT):
+            # loop in group of 100s, PAGE_FETCH_CONCURRENCY groups are requested at the same time
+            pages = self.page_fetcher.fetch_pages(
+                lambda offset: self.streamer.retrieve_by_id(
+                    listings_keys[offset : offset + SESSION_LISTINGS_COUNT],
+                    pack_rows=self.listing_disk_cache_manager.pack_rows,
+                ),  # use offset to get each group of 100
+                range(0, len(listings_keys), SESSION_LISTINGS_COUNT),
+            )
+            for offset, new_listings, count in pages:
                 logger.info(
-                    "Downloading Listings found by ID with Offset:%s-%s",
+                    "Downloaded Listings found by ID with Offset:%s-%s",
                     offset,
                     offset + SESSION_LISTINGS_COUNT,
                 )
-                try:
-                    new_listings, count = self.streamer.retrieve_by_id(
-                        listings_keys[offset : offset + SESSION_LISTINGS_COUNT]
-                    )  # use offset to get each group of 100
-
-                    if not isinstance(new_listings, list):  # convert to list if not
-                        new_listings = [new_listings]
-
-                    self.listing_disk_cache_manager.insert_row_on_disk(new_listings)
-                    if type(count) == str:
-                        count = int(count)
-
-                    downloaded_by_id_count += count
-                except Exception as e:
-                    logger.error(e)
+                if int(count) < 0:
+                    # A dropped page would silently shrink the dataset, fail the download instead
                     logger.error(
                         "Error in downloading Listings found by ID with offset:%s-%s for class :%s",
                         offset,
                         offset + SESSION_LISTINGS_COUNT,
                         search_class,
                     )
+                    return False, downloaded_by_id_count
+
+                # Packed while the page was received
+                self.listing_disk_cache_manager.insert_row_on_disk(new_listings)
+                downloaded_by_id_count += int(count)
+                self.checkpoint(by_id_downloaded=downloaded_before + downloaded_by_id_count)
             return True, downloaded_by_id_count
         except Exception as e:
             logger.error(e)
@@ -189,73 +213,84 @@ class DDFClient:
                 SESSION_LISTINGS_COUNT,
                 last_update,
             )
-            try:
-                # get active records, first 100.
-                listings, count = self.streamer.retrieve_active_records(
-                    last_update, limit=limit, offset=offset
-                )
+            if self.sync_run is not None and self.sync_run.active_next_offset:
+                # Resumed sync run, the pages fetched so far are still in the disk cache
+                self.listing_disk_cache_manager.resume_disk_cache()
+                if self.is_stage_done(self.sync_run.STAGE_ACTIVE_PAGES):
+                    logger.info("Active listings were already downloaded by the resumed sync run")
+                    return True
+                count = self.sync_run.active_count
+                first_offset = self.sync_run.active_next_offset
+                logger.info("Resuming the active listings download at offset %s", first_offset)
+            else:
+                first_offset = SESSION_LISTINGS_COUNT + 1
+                try:
+                    # get active records, first 100.
+                    listings, count = self.streamer.retrieve_active_records(
+                        last_update,
+                        limit=limit,
+                        offset=offset,
+                        pack_rows=self.listing_disk_cache_manager.pack_rows,
+                    )
 
-                if not isinstance(
-                    listings, list
-                ):  # make it a list if not, example: 1 item only
-                    listings = [listings]
-                if int(count) < 0:  # if count is less than zero terminate
-                    logger.error("Failed to retrieve active records")
+                    if int(count) < 0:  # if count is less than zero terminate
+                        logger.error("Failed to retrieve active records")
+                        return False
+                    if limit and limit < int(
+                        count
+                    ):  # if limit is applied and limit is less than count
+                        count = limit  # Used for logging
+
+                    # Pass the memory load to our disk
+                    self.listing_disk_cache_manager.initialize_disk_cache()
+                    self.listing_disk_cache_manager.insert_row_on_disk(listings)
+                    self.checkpoint(active_count=int(count), active_next_offset=first_offset)
+                except Exception as e:
+                    logger.error(e)
+                    logger.error(
+                        "Failed to download new active listings at %s", last_update
+                    )
                     return False
-                if limit and limit < int(
-                    count
-                ):  # if limit is applied and limit is less than count
-                    count = limit  # Used for logging
-
-                # Pass the memory load to our disk
-                self.listing_disk_cache_manager.initialize_disk_cache()
-                self.listing_disk_cache_manager.insert_row_on_disk(listings)
-            except Exception as e:
-                logger.error(e)
-                logger.error(
-                    "Failed to download new active listings at %s", last_update
-                )
-                return False
             logger.info("%s active listings found since %s", int(count), last_update)
 
             try:
                 # if count larger than RETS SESSION MAX (100)
                 if int(count) > SESSION_LISTINGS_COUNT:
-                    # get group of 100 or less each time using an offset of 100
-                    for offset in range(
-                        SESSION_LISTINGS_COUNT + 1, int(count), SESSION_LISTINGS_COUNT
-                    ):
-                        logger.debug(
-                            "Attempting to download new active listings Offset:%s-%s",
-                            offset,
-                            offset + SESSION_LISTINGS_COUNT,
-                        )
-                        try:
-                            (
-                                new_listings,
-                                new_count,
-                            ) = self.streamer.retrieve_active_records(
-                                last_update, limit=limit, offset=offset
-                            )
-                        except Exception as e:
-                            logger.error(e)
+                    # get group of 100 or less each time using an offset of 100,
+                    # PAGE_FETCH_CONCURRENCY groups are requested at the same time
+                    pages = self.page_fetcher.fetch_pages(
+                        lambda offset: self.streamer.retrieve_active_records(
+                            last_update,
+                            limit=limit,
+                            offset=offset,
+                            pack_rows=self.listing_disk_cache_manager.pack_rows,
+                        ),
+                        range(first_offset, int(count), SESSION_LISTINGS_COUNT),
+                    )
+                    for offset, new_listings, new_count in pages:
+                        if int(new_count) < 0:
+                            # Fail instead of skipping the page, the last update timestamp stays put
+                            # and active_next_offset still points at this page for a resumed run
                             logger.error(
                                 "Failed to download new active listings Offset:%s-%s",
                                 offset,
                                 offset + SESSION_LISTINGS_COUNT,
                             )
-                        # Pass the memory load to our disk
+                            return False
+
+                        # Pass the memory load to our disk, the page was packed while it was received
                         logger.info(
                             f"Fetching from crea progress: {self.listing_disk_cache_manager.disk_cache_count}/{count}"
                         )
                         self.listing_disk_cache_manager.insert_row_on_disk(new_listings)
+                        self.checkpoint(active_next_offset=offset + SESSION_LISTINGS_COUNT)
             except Exception as e:
                 logger.error(e)
                 logger.error(
                     "Failed to download active listing exceeding %s",
                     SESSION_LISTINGS_COUNT,
                 )
-                return Fals
+                return False
 
             if self.listing_disk_cache_manager.disk_cache_count != int(
                 count
@@ -272,6 +307,8 @@ class DDFClient:
                     self.listing_disk_cache_manager.disk_cache_count,
                 )
                 # self.listings=listings
+            if self.sync_run is not None:
+                self.checkpoint(self.sync_run.STAGE_MASTER_LIST)
         except Exception as e:
             logger.error(e)
             return False
@@ -282,7 +319,8 @@ class DDFClient:
         calls download_by_id to download missing listings
         also it finds removed listings and return a list of them
         Parameters:
-            1- previous listings_keys: a list of listings keys that exists in the database
+            1- previous listings_keys: a list of listings keys that exists in the database, or a dictionary of {listing key: last updated}
+               in which case the listings whose LastUpdated changed outside the active listings are downloaded by ID too
             2- limit: The limit for number of active records to be retrived. Set to SESSION_LISTINGS_COUNT by default
         """
 
@@ -291,10 +329,8 @@ class DDFClient:
             logger.info("Attempting to download listings by id")
 
             try:
-                # get master list of all listings from DDF
-                master_list, count = self.streamer.retrieve_master_list()
-                if not isinstance(master_list, list):
-                    master_list = [master_list]
+                # stream master list of all listings from DDF, only the keys are kept in memory
+                master_list, count = self.streamer.stream_master_list()
                 if int(count) < 0:
                     logger.error("Failed to Retrieve Master List")
                     return False, 0, []
@@ -304,47 +340,48 @@ class DDFClient:
                 return False, 0, []
 
             try:
-                if master_list:
-                    logger.info(f"Getting listing keys...")
-                    master_listings_keys = self.get_listings_keys(master_list)
-                    if not master_listings_keys:
-                        logger.error("Failed to extract master listing keys")
-                        return False, 0, []
-                else:
+                logger.info(f"Reconciling master list against available listings...")
+                id_key = "ListingKey" if self.format == "COMPACT-DECODED" else "ID"
+                listings_diff = diff_listings(master_list, previous_listings_keys, id_key=id_key)
+                if not listings_diff.master_count:
                     logger.error("Master list was empty")
                     return False, 0, []
-
             except Exception as e:
                 logger.error(e)
                 logger.error("Failed to get listing keys from Master List")
                 return False, 0, []
 
-            logger.info(f"Getting keys that are neither in db nor in active listings..")
-            # get list of missing listings keys than are neither in db nor in active listings
-            added_listings_keys = [
-                listing_key
-                for listing_key in master_listings_keys
-                if listing_key not in previous_listings_keys
-            ]
-
-            logger.info(f"Getting a list of removed listings than are not in master list but in db...")
-            # get a list of removed listings than are not in master list but in db
-            removed_listings_keys = [
-                listing_key
-                for listing_key in previous_listings_keys
-                if listing_key not in master_listings_keys
-            ]
+            # keys that are neither in db nor in active listings
+            added_listings_keys = listings_diff.added
+            # removed listings than are not in master list but in db
+            removed_listings_keys = listings_diff.removed
+            # keys in db whose LastUpdated moved without appearing in the active listings
+            changed_listings_keys = listings_diff.changed
+            if self.sync_run is not None:
+                # On a resumed run the listings already downloaded by ID are in the disk cache,
+                # the diff only keeps the remaining ones
+                self.checkpoint(
+                    self.sync_run.STAGE_BY_ID_PAGES,
+                    master_count=listings_diff.master_count,
+                    by_id_count=len(added_listings_keys) + len(changed_listings_keys),
+                )
+
             logger.info(
                 "Listings found to be added by ID are: %s", len(added_listings_keys)
             )
             logger.info(
                 "Listings found to be removed by ID are: %s", len(removed_listings_keys)
             )
+            if isinstance(previous_listings_keys, dict):
+                logger.info(
+                    "Listings with a changed LastUpdated outside the active listings are: %s",
+                    len(changed_listings_keys),
+                )
 
             logger.info(f"Downloading by id...")
             # download missing listings by ID
             downloaded_by_id, download_by_id_count = self.download_by_id(
-                added_listings_keys, limit
+                added_listings_keys + changed_listings_keys, limit
             )
 
             # if an error during downloading by ID.
@@ -354,6 +391,8 @@ class DDFClient:
 
         except Exception as e:
             logger.error(e)
+            logger.error("Failed to Download by ID")
+            return False, 0, []
         logger.info("Successfully updated all listings by ID")
         return True, download_by_id_count, removed_listings_keys
 
@@ -371,7 +410,7 @@ class DDFClient:
             2- offset: The offset for the first record.The API is limited to 100 records per call, so incase there is a 1000 records since that timestamp. 10 API calls are required with offsets
                 0,100,200... 900.
             3- limit: The limit for number of active records to be retrived. Set to SESSION_LISTINGS_COUNT by default
-            4- previous_listing_keys: a list of strings for the existing listings ids
+            4- previous_listing_keys: a list of strings for the existing listings ids, or a dictionary of {id: last updated}
 
         Returns:
             1- Boolean (True/False) if the operation was successful/failed.
@@ -423,9 +462,16 @@ class DDFClient:
                         active_listings_keys = []  # empty List
 
                     # current available listings = db listings + listings since last update
-                    available_listings_keys = (
-                        active_listings_keys + previous_listings_keys
-                    )
+                    if isinstance(previous_listings_keys, dict):
+                        # active listings are already fresh, no need to compare their LastUpdated
+                        available_listings_keys = dict(previous_listings_keys)
+                        available_listings_keys.update(
+                            dict.fromkeys(active_listings_keys)
+                        )
+                    else:
+                        available_listings_keys = (
+                            active_listings_keys + list(previous_listings_keys)
+                        )
 
                     # download any missing listing other than the available, uses master list to compare againts available listings
                     (
@@ -516,9 +562,10 @@ class DDFClient:
             )
             return False
 
-    def remove_old_listings_photos(self, removed_listings_keys):
-        """removed photos for expired listings based on removed_lisings_keys parameter."""
-        return self.media_handler.delete_photos(removed_listings_keys)
+    def remove_old_listings_photos(self, removed_listings_keys, dry_run=False):
+        """removed photos for expired listings based on removed_lisings_keys parameter.
+        Returns the (objects count, bytes) deleted, or that would be deleted with dry_run."""
+        return self.media_handler.delete_photos(removed_listings_keys, dry_run)
 
     def update_photos(
         self, listings, previous_photos={}, skip_photos=False, progress=0
@@ -589,7 +636,7 @@ class DDFClient:
         """Completes an entire update operation including data and photos
         Parameters:
             1- last_update: previous update timestamp, previous_listing_keys:
-            2- previous_listing_keys: list of the current listing keys that exists in the db,
+            2- previous_listing_keys: list of the current listing keys that exists in the db, or a dictionary of {id: last updated},
             3- limit: max 100.. the MLS API is limited to 100 full listings records per call. Limit can be lowered if needed
             4- offset: The offset for the first record.The API is limited to 100 records per call, so incase there is a 1000 records since that timestamp. 10 API calls are required with offsets
                 0,100,200... 900.,
@@ -637,8 +684,7 @@ class DDFClient:
 
                 progress = 1
                 # photos_updated: Boolean, failed_photos_redownloads: list
-                for key in self.listing_disk_cache_manager.get_all_disk_saved_keys():
-                    listings = self.listing_disk_cache_manager.get_disk_row(key)
+                for listings in self.listing_disk_cache_manager.iter_rows():
                     photos_updated, new_progress = self.update_photos(
                         listings,
                         previous_photos=previous_photos,
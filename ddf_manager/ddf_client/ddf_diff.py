@@ -0,0 +1,64 @@
+from collections import namedtuple
+
+from dateutil import parser
+
+from ..ddf_logger import logger
+
+# ListingsDiff
+#   added: ids in the master list that are not in the previous listings (master list order)
+#   removed: ids in the previous listings that are not in the master list (previous listings order)
+#   changed: ids in both whose LastUpdated differs from the previous value (master list order)
+#   master_count: number of ids read from the master list
+ListingsDiff = namedtuple("ListingsDiff", ["added", "removed", "changed", "master_count"])
+
+
+def parse_last_updated(value):
+    """Parses a DDF LastUpdated value, returns None if it can't be parsed"""
+    if not value:
+        return None
+    try:
+        return parser.parse(value)
+    except (ValueError, OverflowError):
+        return None
+
+
+def diff_listings(master_list, previous_listings, id_key="ID", last_updated_key="LastUpdated"):
+    """
+    Reconciles the master list against the previous listings in O(n + m) using hashed lookups.
+    Parameters:
+        1- master_list: an iterable of master list records (dictionaries with `id_key` and `last_updated_key`).
+           It's consumed once, so a streamed master list works without being held in memory.
+        2- previous_listings: either an iterable of ids, or a dictionary of {id: last_updated}.
+           With a dictionary, changed LastUpdated values are reported, a None value skips the comparison for that id.
+    Returns a ListingsDiff
+    """
+    compare_last_updated = isinstance(previous_listings, dict)
+    if compare_last_updated:
+        previous = previous_listings
+    else:
+        previous = dict.fromkeys(previous_listings)
+
+    added = []
+    changed = []
+    seen = set()
+    for record in master_list:
+        try:
+            listing_key = record[id_key]
+        except (KeyError, TypeError):
+            logger.error("%s was not found in :%s", id_key, record)
+            continue
+
+        seen.add(listing_key)
+        if listing_key not in previous:
+            added.append(listing_key)
+        elif compare_last_updated:
+            previous_last_updated = previous[listing_key]
+            if previous_last_updated is None:
+                continue
+            last_updated = parse_last_updated(record.get(last_updated_key))
+            if last_updated is None or last_updated != previous_last_updated:
+                changed.append(listing_key)
+
+    removed = [listing_key for listing_key in previous if listing_key not in seen]
+
+    return ListingsDiff(added, removed, changed, len(seen))
@@ -2,10 +2,8 @@ import os
 import shutil
 import sys
 
-import requests
-import xmltodict
-
 from ..ddf_logger import *
+from .ddf_photo_transfer import PhotoTransfer, parse_photo_rows
 
 
 class MediaHandler:
@@ -21,11 +19,13 @@ class MediaHandler:
     :param `media_dir' : Root DIR for media
     :param `rets_session`: rets_lib Session Object
     :param `format_type' : Can take 'STANDARD-XML' or 'COMPACT_DECODED'. 'COMPACT-DECODED' is not tested.
+    :param `photo_transfer' : PhotoTransfer (ddf_photo_transfer.py) downloading the photos, a new one by default.
     """
 
-    def __init__(self, media_dir, rets_session, format_type="STANDARD-XML-Encoded"):
+    def __init__(self, media_dir, rets_session, format_type="STANDARD-XML-Encoded", photo_transfer=None):
         try:
             self.rets_session = rets_session
+            self.photo_transfer = photo_transfer or PhotoTransfer()
             self.media_dir = media_dir
             self.format = format_type
             self.listings_path = "listings"
@@ -147,42 +147,29 @@ class MediaHandler:
             logger.error(e)
             logger.error("Failed to prepare folder for listing:%s", listing_key)
 
-    def save_photo(self, xml_response, listing_id, photo_id=1, agent=False):
+    def save_photo(self, xml_response, listing_id, photo_id=1, agent=False, wait=True):
         """Saves a listing/agent photo using the byte stream received from the MLS server.
         The photo is named according to the photo id. Also it is saved in a folder named according to the listing id.
+        With wait=False the photos are queued on the PhotoTransfer pool, see download_photos.
         Returns true the photo was saved successfully"""
-        dict_xml = xmltodict.parse(xml_response)
-        data = dict_xml["RETS"]["DATA"]
-        columns = dict_xml["RETS"]["COLUMNS"].split("\t")
-
+        photo_path = None
         try:
-            if agent:
-                photo_path = f"{self.media_dir}/{self.agents_dir}/{listing_id}/.jpg"
-                splitted_row = data.split("\t")
-                photo_attributes = self.build_dict(columns, splitted_row)
+            saved = True
+            for photo_attributes in parse_photo_rows(xml_response):
                 image_url = photo_attributes.get("MediaUrl", "")
-                with open(photo_path, "wb") as f:
-                    f.write(requests.get(image_url).content)
-            else:
-                photo_dir = f"{self.media_dir}/{self.listings_path}/{listing_id}"
-
-                if type(data) == list:
-                    for row in data:
-                        splitted_row = row.split("\t")
-                        photo_attributes = self.build_dict(columns, splitted_row)
-                        image_url = photo_attributes.get("MediaUrl", "")
-                        photo_path = (
-                            f"{photo_dir}/{photo_attributes.get('Order', '1')}.jpg"
-                        )
-                        with open(photo_path, "wb") as f:
-                            f.write(requests.get(image_url).content)
+                order = photo_attributes.get("Order", "1")
+                if agent:
+                    photo_path = f"{self.media_dir}/{self.agents_dir}/{listing_id}/.jpg"
+                else:
+                    photo_path = f"{self.media_dir}/{self.listings_path}/{listing_id}/{order}.jpg"
+
+                if wait:
+                    saved = self.photo_transfer.transfer(self.photo_transfer.save_to_file, image_url, photo_path) and saved
                 else:
-                    splitted_row = data.split("\t")
-                    photo_attributes = self.build_dict(columns, splitted_row)
-                    image_url = photo_attributes.get("MediaUrl", "")
-                    photo_path = f"{photo_dir}/{photo_attributes.get('Order', '1')}.jpg"
-                    with open(photo_path, "wb") as f:
-                        f.write(requests.get(image_url).content)
+                    self.photo_transfer.submit(
+                        (listing_id, order), self.photo_transfer.save_to_file, image_url, photo_path
+                    )
+            return saved
         except Exception as e:
             logger.error(e)
             logger.error("Failed to save photo: %s", photo_path)
@@ -199,8 +186,7 @@ class MediaHandler:
                 if len(xml_response) < 500:
                     logger.debug("Listing Agent Photo is less than 500 Bytes")
                 else:
-                    self.save_photo(xml_response, agent_id, agent=True)
-                    photo_downloaded = True
+                    photo_downloaded = self.save_photo(xml_response, agent_id, agent=True)
             else:
                 raise Exception("Failed to Download Agent Photo:%s", agent_id)
             return photo_downloaded
@@ -231,8 +217,7 @@ class MediaHandler:
                         xml_response,
                     )
                 else:
-                    self.save_photo(xml_response, listing_key, str(photo_id))
-                    photo_downloaded = True
+                    photo_downloaded = self.save_photo(xml_response, listing_key, str(photo_id))
             else:
                 raise Exception(
                     "Failed to download Photo:%s for Listing:%s", photo_id, listing_key
@@ -266,7 +251,7 @@ class MediaHandler:
             listing_key = listing["ID"]
             if not self.prepare_folder(listing_key):
                 raise Exception("Failed to Prepare DIR")
-            photos_object = self.rets_session.get_object(
+            photos_object = self.rets_session.iter_object(
                 resource="Property",
                 object_type="LargePhoto",
                 content_ids=listing_key,
@@ -274,15 +259,15 @@ class MediaHandler:
             )
             for photo in photos_object:
                 xml_response = photo["content"]
-                if len(xml_response) < 500:
+                photo_id = photo["object_id"]
+                if not xml_response or len(xml_response) < 500:
                     logger.error(
                         "Error in Photo:%s for listing:%s", photo_id, listing_key
                     )
                     self.append_failed_photo(photo_id, listing_key, failed_downloads)
                     continue
                 else:
-                    photo_id = photo["object_id"]
-                    self.save_photo(xml_response, listing_key, photo_id)
+                    self.save_photo(xml_response, listing_key, photo_id, wait=False)
             return True
         except Exception as e:
             logger.error(e)
@@ -397,6 +382,9 @@ class MediaHandler:
                         photos_dict, listing_key, failed_downloads
                     )
                     continue
+            # Photos queued by get_photos
+            for listing_key, photo_id in self.photo_transfer.wait():
+                self.append_failed_photo(photo_id, listing_key, failed_downloads)
             if len(failed_downloads) > 0:
                 logger.warning("Failed to Download %s Photos", len(failed_downloads))
             else:
@@ -410,18 +398,37 @@ class MediaHandler:
             logger.error("Failed to download photos for new listings")
             return False, []
 
-    def delete_photos(self, listings_keys):
-        """ Deletes all phoros for a specific listing"""
+    def purge_listings_photos(self, listings_keys, dry_run=False):
+        """Deletes the photos DIR of every listing. With dry_run nothing is deleted.
+        Returns the (objects count, bytes) deleted or that would be deleted"""
+        objects_count = 0
+        total_bytes = 0
+        for listing_key in set(listings_keys):
+            dir_path = self.media_dir + "/" + self.listings_path + "/" + str(listing_key)
+            if not os.path.exists(dir_path):
+                logger.error("Photo DIR Doesn't exist Delete Command was ignored: %s", dir_path)
+                continue
+            files = [entry for entry in os.scandir(dir_path) if entry.is_file()]
+            if not dry_run and not self.delete_dir(dir_path):
+                continue
+            objects_count += len(files)
+            total_bytes += sum(entry.stat().st_size for entry in files)
+
+        if dry_run:
+            logger.info("Dry run: %s photos (%s bytes) would be deleted", objects_count, total_bytes)
+        else:
+            logger.info("Deleted %s photos (%s bytes)", objects_count, total_bytes)
+        return objects_count, total_bytes
+
+    def delete_photos(self, listings_keys, dry_run=False):
+        """ Deletes all phoros for a specific listing
+        Returns the (objects count, bytes) deleted"""
         try:
-            for listing_key in listings_keys:
-                photos_deleted = self.delete_photo_dir(listing_key)
-                if not photos_deleted:
-                    logger.error(
-                        "Failed to delete photos for listing : %s", listing_key
-                    )
+            return self.purge_listings_photos(listings_keys, dry_run)
         except Exception as e:
             logger.error(e)
             logger.error("Error in Deleting old Listings Photos")
+            return 0, 0
 
     def build_dict(self, columns, batch_data):
         """
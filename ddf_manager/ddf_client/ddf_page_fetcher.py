@@ -0,0 +1,104 @@
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from ..ddf_logger import logger
+from ..rets_lib.transport import KeepAliveAdapter, default_retry_budget
+from ..settings import PAGE_FETCH_BACKOFF, PAGE_FETCH_CONCURRENCY, PAGE_FETCH_RETRIES
+
+
+class PageFetcher:
+    """
+    Fetches RETS search pages with a bounded number of requests in flight.
+
+    Pages are yielded in the order they were requested, whatever the order the
+    server answers them, so the disk cache is filled exactly like the sequential loop did.
+    A page that fails (exception or a negative count) is retried with an exponential
+    backoff before it is given up on. Every page retry withdraws from the retry budget of
+    the session, the same budget bounding the request retries of the session itself.
+
+    PageFetcher Constructor
+    :param `concurrency': Maximum number of in-flight page requests. 1 behaves like the old sequential loop.
+    :param `retries': Number of retries per page after the first attempt.
+    :param `backoff': Base delay in seconds between retries, doubled on every attempt.
+    :param `rets_session': Optional rets_lib Session, its connection pool is sized to the concurrency
+        and its retry budget is used, the process wide budget otherwise.
+    """
+
+    def __init__(
+        self,
+        concurrency=PAGE_FETCH_CONCURRENCY,
+        retries=PAGE_FETCH_RETRIES,
+        backoff=PAGE_FETCH_BACKOFF,
+        rets_session=None,
+    ):
+        self.concurrency = max(1, concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_budget = rets_session.retry_budget if rets_session is not None else default_retry_budget
+
+        if rets_session is not None and self.concurrency > 1:
+            self.mount_pool(rets_session.client)
+
+    def mount_pool(self, client):
+        # requests keeps 10 connections per host by default, never go below the concurrency
+        adapter = KeepAliveAdapter(
+            pool_connections=self.concurrency, pool_maxsize=max(10, self.concurrency)
+        )
+        client.mount("https://", adapter)
+        client.mount("http://", adapter)
+
+    def fetch_page(self, fetch, page):
+        """
+        Calls `fetch(page)` until it returns a valid (listings, count) tuple.
+        Returns (listings, count), count is -1 once all the retries are exhausted.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                listings, count = fetch(page)
+                if int(count) >= 0:
+                    return listings, count
+                logger.warning("Page %s returned an invalid count: %s", page, count)
+            except Exception as e:
+                logger.error(e)
+                logger.error("Failed to fetch page %s, attempt %s", page, attempt + 1)
+
+            if attempt < self.retries:
+                if not self.retry_budget.withdraw():
+                    logger.error("Retry budget exhausted, giving up on page %s", page)
+                    break
+                delay = self.backoff * (2 ** attempt)
+                time.sleep(delay + random.uniform(0, delay))
+
+        logger.error("Giving up on page %s after %s attempts", page, attempt + 1)
+        return [], "-1"
+
+    def fetch_pages(self, fetch, pages):
+        """
+        Generator yielding (page, listings, count) for every page, in the order of `pages`.
+        :param `fetch': callable taking a page and returning (listings, count) like the Streamer methods
+        :param `pages': iterable of page arguments (offsets, ids chunks...)
+        """
+        pages = iter(pages)
+
+        if self.concurrency == 1:
+            for page in pages:
+                listings, count = self.fetch_page(fetch, page)
+                yield page, listings, count
+            return
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            in_flight = deque()
+            for page in pages:
+                in_flight.append((page, executor.submit(self.fetch_page, fetch, page)))
+                # Keep at most `concurrency` pages in flight, the oldest one is always yielded first
+                if len(in_flight) >= self.concurrency:
+                    page, future = in_flight.popleft()
+                    listings, count = future.result()
+                    yield page, listings, count
+
+            while in_flight:
+                page, future = in_flight.popleft()
+                listings, count = future.result()
+                yield page, listings, count
@@ -0,0 +1,352 @@
+import hashlib
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import xmltodict
+from boto3.s3.transfer import TransferConfig
+from requests.adapters import HTTPAdapter
+
+from ..ddf_logger import logger
+from ..settings import (
+    PHOTOS_DOWNLOAD_BACKOFF,
+    PHOTOS_DOWNLOAD_CHUNK_SIZE,
+    PHOTOS_DOWNLOAD_CONCURRENCY,
+    PHOTOS_DOWNLOAD_RETRIES,
+    PHOTOS_SPOOL_SIZE,
+)
+
+# Content hash of a stored photo and the validators of the response it was downloaded from
+PhotoIndexEntry = namedtuple("PhotoIndexEntry", ["digest", "size", "etag", "last_modified"])
+
+
+class PhotoIndex:
+    """
+    Content hash index of the stored photos, {storage key (S3 key or local path): PhotoIndexEntry}.
+    The manager loads it from the PhotoDigest table before a sync and saves the entries recorded
+    during the sync (pop_changed) afterwards.
+
+    PhotoIndex Constructor
+    :param `entries': {storage key: PhotoIndexEntry} of the already stored photos.
+    """
+
+    def __init__(self, entries=None):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.keys_by_digest = {}
+        self.changed = {}
+        for key, entry in (entries or {}).items():
+            self.set(key, entry)
+
+    def set(self, key, entry):
+        self.entries[key] = entry
+        self.keys_by_digest[entry.digest] = key
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def find_duplicate(self, digest, key):
+        """
+        Returns another storage key holding the same bytes, or None
+        """
+        with self.lock:
+            duplicate_key = self.keys_by_digest.get(digest)
+            if duplicate_key is None or duplicate_key == key:
+                return None
+            # The photo may have been overwritten since it was indexed
+            if self.entries[duplicate_key].digest != digest:
+                return None
+            return duplicate_key
+
+    def record(self, key, entry):
+        with self.lock:
+            self.set(key, entry)
+            self.changed[key] = entry
+
+    def pop_changed(self):
+        with self.lock:
+            changed, self.changed = self.changed, {}
+        return changed
+
+
+class PhotoTransfer:
+    """
+    Downloads photos from their MediaUrl with a pooled HTTP session and a bounded worker pool,
+    shared by MediaHandler (local storage) and S3Handler (S3 storage).
+
+    Bodies are never fully buffered: they are streamed in chunks to a temporary file that is renamed
+    once complete, or handed to the boto3 managed transfer, which switches to a multipart upload for
+    large photos. A failed transfer is retried with an exponential backoff.
+
+    Every photo is hashed while it's received and recorded in the PhotoIndex. A photo already in the
+    index is requested with its validators (a 304 skips the download), identical bytes are not written
+    again and bytes already stored under another key are hard linked (local) or copied server side (S3).
+    The bytes avoided that way are counted, see get_counters.
+
+    PhotoTransfer Constructor
+    :param `concurrency': Maximum number of photos transferred at the same time.
+    :param `retries': Number of retries per photo after the first attempt.
+    :param `backoff': Base delay in seconds between retries, doubled on every attempt.
+    :param `s3_client': boto3 S3 client, only needed by save_to_s3.
+    :param `photo_index': PhotoIndex of the stored photos, an empty one by default.
+    """
+
+    COUNTERS = ("not_modified", "unchanged", "deduplicated")
+
+    def __init__(
+        self,
+        concurrency=PHOTOS_DOWNLOAD_CONCURRENCY,
+        retries=PHOTOS_DOWNLOAD_RETRIES,
+        backoff=PHOTOS_DOWNLOAD_BACKOFF,
+        s3_client=None,
+        photo_index=None,
+    ):
+        self.concurrency = max(1, concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.s3_client = s3_client
+        self.photo_index = photo_index or PhotoIndex()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(10, self.concurrency))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        # The transfers already run in parallel, upload every photo from its own worker
+        self.s3_transfer_config = TransferConfig(
+            multipart_threshold=8 * 1024 * 1024,
+            multipart_chunksize=8 * 1024 * 1024,
+            use_threads=False,
+        )
+
+        self.executor = None
+        self.pending = []
+        self.lock = threading.Lock()
+        # Bounds the queued transfers so the RETS loop feeding them can't run away
+        self.slots = threading.BoundedSemaphore(self.concurrency * 4)
+
+        self.reset_counters()
+
+    def reset_counters(self):
+        with self.lock:
+            self.transferred_count = 0
+            self.transferred_bytes = 0
+            for name in self.COUNTERS:
+                setattr(self, f"{name}_count", 0)
+                setattr(self, f"{name}_bytes", 0)
+
+    def count(self, name, size):
+        with self.lock:
+            setattr(self, f"{name}_count", getattr(self, f"{name}_count") + 1)
+            setattr(self, f"{name}_bytes", getattr(self, f"{name}_bytes") + size)
+
+    def get_counters(self):
+        """
+        Returns the counters since the last reset, bytes_avoided adds up the bytes that were not downloaded
+        (not_modified) and the bytes that were not written or uploaded (unchanged, deduplicated)
+        """
+        with self.lock:
+            counters = {"transferred_count": self.transferred_count, "transferred_bytes": self.transferred_bytes}
+            for name in self.COUNTERS:
+                counters[f"{name}_count"] = getattr(self, f"{name}_count")
+                counters[f"{name}_bytes"] = getattr(self, f"{name}_bytes")
+        counters["bytes_avoided"] = sum(counters[f"{name}_bytes"] for name in self.COUNTERS)
+        return counters
+
+    def open(self, image_url, entry=None):
+        headers = {}
+        if entry is not None:
+            # Conditional request, the source answers 304 if the photo didn't change
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        response = self.session.get(image_url, stream=True, timeout=60, headers=headers)
+        response.raise_for_status()
+        if response.status_code == 304 and entry is None:
+            response.close()
+            raise requests.HTTPError(f"Unexpected 304 response for {image_url}")
+        return response
+
+    @staticmethod
+    def read_into(response, f):
+        """
+        Streams the response body into f, returns its (sha256 hex digest, size)
+        """
+        digest = hashlib.sha256()
+        size = 0
+        for chunk in response.iter_content(PHOTOS_DOWNLOAD_CHUNK_SIZE):
+            f.write(chunk)
+            digest.update(chunk)
+            size += len(chunk)
+        return digest.hexdigest(), size
+
+    @staticmethod
+    def get_entry(response, digest, size):
+        return PhotoIndexEntry(
+            digest, size, response.headers.get("ETag", ""), response.headers.get("Last-Modified", "")
+        )
+
+    def save_to_file(self, image_url, photo_path):
+        entry = self.photo_index.get(photo_path)
+        if entry is not None and not os.path.exists(photo_path):
+            # The file is gone, download it again
+            entry = None
+
+        temporary_path = f"{photo_path}.part"
+        size = 0
+        try:
+            with self.open(image_url, entry) as response:
+                if response.status_code == 304:
+                    self.count("not_modified", entry.size)
+                    return 0
+                with open(temporary_path, "wb") as f:
+                    digest, size = self.read_into(response, f)
+                new_entry = self.get_entry(response, digest, size)
+
+            if entry is not None and entry.digest == digest:
+                # Same bytes under a new timestamp, the stored photo is kept
+                self.count("unchanged", size)
+            else:
+                duplicate_path = self.photo_index.find_duplicate(digest, photo_path)
+                if duplicate_path and self.link_file(duplicate_path, photo_path):
+                    self.count("deduplicated", size)
+                else:
+                    # A partial download never replaces a complete photo
+                    os.replace(temporary_path, photo_path)
+            self.photo_index.record(photo_path, new_entry)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+        return size
+
+    @staticmethod
+    def link_file(source_path, photo_path):
+        """
+        Hard links photo_path to an identical photo, returns False if the file system can't
+        """
+        link_path = f"{photo_path}.link"
+        try:
+            os.link(source_path, link_path)
+            os.replace(link_path, photo_path)
+            return True
+        except OSError as e:
+            logger.error(e)
+            if os.path.exists(link_path):
+                os.remove(link_path)
+            return False
+
+    def save_to_s3(self, image_url, bucket, key):
+        entry = self.photo_index.get(key)
+        # The body is hashed before the upload is decided, small photos stay in memory
+        with tempfile.SpooledTemporaryFile(max_size=PHOTOS_SPOOL_SIZE) as body:
+            with self.open(image_url, entry) as response:
+                if response.status_code == 304:
+                    self.count("not_modified", entry.size)
+                    return 0
+                digest, size = self.read_into(response, body)
+                new_entry = self.get_entry(response, digest, size)
+
+            if entry is not None and entry.digest == digest:
+                # Same bytes under a new timestamp, the stored object is kept
+                self.count("unchanged", size)
+            elif self.copy_object(bucket, key, digest):
+                self.count("deduplicated", size)
+            else:
+                body.seek(0)
+                self.s3_client.upload_fileobj(
+                    body,
+                    bucket,
+                    key,
+                    ExtraArgs={"Metadata": {"sha256": digest}},
+                    Config=self.s3_transfer_config,
+                )
+        self.photo_index.record(key, new_entry)
+        return size
+
+    def copy_object(self, bucket, key, digest):
+        """
+        Copies an identical object server side instead of uploading the photo, returns False if there is none
+        """
+        duplicate_key = self.photo_index.find_duplicate(digest, key)
+        if duplicate_key is None:
+            return False
+        try:
+            self.s3_client.copy_object(Bucket=bucket, Key=key, CopySource={"Bucket": bucket, "Key": duplicate_key})
+            return True
+        except Exception as e:
+            # Deleted since it was indexed, upload the photo
+            logger.error(e)
+            return False
+
+    def transfer(self, save, *destination):
+        """
+        Runs `save(*destination)` until it succeeds, returns True if the photo was saved
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                size = save(*destination)
+                with self.lock:
+                    self.transferred_count += 1
+                    self.transferred_bytes += size
+                return True
+            except Exception as e:
+                logger.error(e)
+                logger.error("Failed to save photo: %s, attempt %s", destination[-1], attempt + 1)
+
+            if attempt < self.retries:
+                delay = self.backoff * (2 ** attempt)
+                time.sleep(delay + random.uniform(0, delay))
+        return False
+
+    def submit(self, context, save, *destination):
+        """
+        Queues a transfer on the worker pool, `context` is reported back by `wait` if it fails
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+        self.slots.acquire()
+        future = self.executor.submit(self.transfer, save, *destination)
+        future.add_done_callback(lambda future: self.slots.release())
+        with self.lock:
+            self.pending.append((context, future))
+
+    def wait(self):
+        """
+        Waits for every queued transfer, returns the context of the failed ones
+        """
+        with self.lock:
+            pending, self.pending = self.pending, []
+
+        failed = []
+        for context, future in pending:
+            try:
+                if not future.result():
+                    failed.append(context)
+            except Exception as e:
+                logger.error(e)
+                failed.append(context)
+        return failed
+
+    def close(self):
+        self.wait()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def parse_photo_rows(xml_response):
+    """
+    Parses a RETS GetObject xml response into one dictionary of photo attributes (MediaUrl, Order...) per photo
+    """
+    dict_xml = xmltodict.parse(xml_response)
+    data = dict_xml["RETS"]["DATA"]
+    columns = dict_xml["RETS"]["COLUMNS"].split("\t")
+    rows = data if type(data) == list else [data]
+    return [dict(zip(columns, row.split("\t"))) for row in rows]
@@ -1,13 +1,14 @@
 import os
 import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
-import requests
-import xmltodict
 
 from ..aws_settings import *
 from ..ddf_logger import *
+from ..settings import PHOTOS_DELETE_BATCH_SIZE, PHOTOS_DELETE_CONCURRENCY
+from .ddf_photo_transfer import PhotoTransfer, parse_photo_rows
 
 
 class S3Handler:
@@ -22,9 +23,10 @@ class S3Handler:
     :param `media_dir' : Root DIR for media
     :param `rets_session`: rets_lib Session Object
     :param `format_type' : Can take 'STANDARD-XML' or 'COMPACT_DECODED'. 'COMPACT-DECODED' is not tested.
+    :param `photo_transfer' : PhotoTransfer (ddf_photo_transfer.py) uploading the photos, a new one by default.
     """
 
-    def __init__(self, media_dir, rets_session, format_type="STANDARD-XML-Encoded"):
+    def __init__(self, media_dir, rets_session, format_type="STANDARD-XML-Encoded", photo_transfer=None):
         try:
             self.rets_session = rets_session
             self.media_dir = media_dir
@@ -37,24 +39,55 @@ class S3Handler:
                 aws_access_key_id=AWS_ACCESS_KEY_ID,
                 aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
             )
+            # Clients are thread safe unlike resources, the transfers and bulk deletes share this one
+            self.s3_client = boto3.client(
+                "s3",
+                aws_access_key_id=AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+            )
+            self.photo_transfer = photo_transfer or PhotoTransfer(s3_client=self.s3_client)
             # self.create_dir(agents_dir)
         except Exception as e:
             logger.error(e)
 
+    def list_objects(self, prefix):
+        """Lists the (key, size) of every S3 object under prefix"""
+        objects = []
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=AWS_STORAGE_BUCKET_NAME, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                objects.append((obj["Key"], obj["Size"]))
+        return objects
+
+    def delete_keys(self, keys):
+        """Deletes S3 keys with delete_objects requests of PHOTOS_DELETE_BATCH_SIZE keys, run concurrently.
+        Returns the number of deleted keys"""
+
+        def delete_batch(batch):
+            response = self.s3_client.delete_objects(
+                Bucket=AWS_STORAGE_BUCKET_NAME,
+                Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+            )
+            errors = response.get("Errors", [])
+            for error in errors:
+                logger.error("Failed to delete file :%s %s", error.get("Key"), error.get("Message"))
+            return len(batch) - len(errors)
+
+        batches = [
+            keys[start : start + PHOTOS_DELETE_BATCH_SIZE]
+            for start in range(0, len(keys), PHOTOS_DELETE_BATCH_SIZE)
+        ]
+        with ThreadPoolExecutor(max_workers=PHOTOS_DELETE_CONCURRENCY) as executor:
+            return sum(executor.map(delete_batch, batches))
+
     def delete_dir(self, dir_path):
         """ "deletes S3 DIR based on dir_path
         Return True if DIR was created"""
         try:
-            found = False
-            for obj in self.s3.Bucket(AWS_STORAGE_BUCKET_NAME).objects.filter(
-                Prefix=dir_path
-            ):
-                found = True
-                logger.debug(
-                    "Deleting DIR:%s", self.s3.Object(AWS_STORAGE_BUCKET_NAME, obj.key)
-                )
-                self.s3.Object(AWS_STORAGE_BUCKET_NAME, obj.key).delete()
-            return found
+            keys = [key for key, size in self.list_objects(dir_path.rstrip("/") + "/")]
+            logger.debug("Deleting DIR:%s", dir_path)
+            self.delete_keys(keys)
+            return bool(keys)
         except Exception as e:
             logger.error(e)
             logger.error("Failed to delete DIR: %s", dir_path)
@@ -64,21 +97,41 @@ class S3Handler:
         """ "deletes S3 DIR based on dir_path
         Return True if DIR was created"""
         try:
-            found = False
-            for obj in self.s3.Bucket(AWS_STORAGE_BUCKET_NAME).objects.filter(
-                Prefix=file_path
-            ):
-                found = True
-                logger.info(
-                    "Deleting File:%s", self.s3.Object(AWS_STORAGE_BUCKET_NAME, obj.key)
-                )
-                self.s3.Object(AWS_STORAGE_BUCKET_NAME, obj.key).delete()
-            return found
+            keys = [key for key, size in self.list_objects(file_path)]
+            logger.info("Deleting File:%s", file_path)
+            self.delete_keys(keys)
+            return bool(keys)
         except Exception as e:
             logger.error(e)
             logger.error("Failed to delete file :%s", file_path)
             return False
 
+    def purge_listings_photos(self, listings_keys, dry_run=False):
+        """Deletes the photos of every listing with batched delete_objects requests.
+        With dry_run nothing is deleted.
+        Returns the (objects count, bytes) deleted or that would be deleted"""
+        prefixes = [
+            f"{self.media_dir}/{self.listings_path}/{listing_key}/" for listing_key in set(listings_keys)
+        ]
+        with ThreadPoolExecutor(max_workers=PHOTOS_DELETE_CONCURRENCY) as executor:
+            objects = [obj for listing_objects in executor.map(self.list_objects, prefixes) for obj in listing_objects]
+        total_bytes = sum(size for key, size in objects)
+
+        if dry_run:
+            logger.info(
+                "Dry run: %s photos (%s bytes) of %s listings would be deleted",
+                len(objects),
+                total_bytes,
+                len(prefixes),
+            )
+            return len(objects), total_bytes
+
+        deleted_count = self.delete_keys([key for key, size in objects])
+        logger.info(
+            "Deleted %s photos (%s bytes) of %s listings", deleted_count, total_bytes, len(prefixes)
+        )
+        return deleted_count, total_bytes
+
     def delete_photo_dir(self, listing_id):
         """ "deletes S3 file based on file_path
         Return True if the file was created"""
@@ -112,60 +165,39 @@ class S3Handler:
                 "Error in appending Listing %s to Failed Downloads", listing_key
             )
 
-    def save_photo(self, xml_response, listing_id, photo_id=1, agent=False):
+    def save_photo(self, xml_response, listing_id, photo_id=1, agent=False, wait=True):
         """Saves a listing/agent photo using the byte stream received from the MLS server.
         The photo is named according to the photo id. Also it is saved in a folder named according to the listing id.
+        With wait=False the photos are queued on the PhotoTransfer pool, see download_photos.
         Returns true the photo was saved successfully"""
-
-        dict_xml = xmltodict.parse(xml_response)
-        data = dict_xml["RETS"]["DATA"]
-        columns = dict_xml["RETS"]["COLUMNS"].split("\t")
-
+        photo_path = None
         try:
-            if agent:
-                # Assumes that all images is going to jpg, which is dangerous!
-                photo_path = f"{self.media_dir}/{self.agents_dir}/{listing_id}/.jpg"
-                splitted_row = data.split("\t")
-                photo_attributes = self.build_dict(columns, splitted_row)
+            saved = True
+            for photo_attributes in parse_photo_rows(xml_response):
                 image_url = photo_attributes.get("MediaUrl", "")
-                self.s3.Bucket(AWS_STORAGE_BUCKET_NAME).put_object(
-                    Key=photo_path, Body=requests.get(image_url).content
-                )
-            else:
-                photo_dir = f"{self.media_dir}/{self.listings_path}/{listing_id}"
-
-                if type(data) == list:
-
-                    progress = 0
-                    max_count = len(data)
-
-                    for row in data:
-                        progress += 1
-
-                        logger.info(
-                            f"- Downloading photo number {progress} out of {max_count}..."
-                        )
-
-                        splitted_row = row.split("\t")
-                        photo_attributes = self.build_dict(columns, splitted_row)
-                        image_url = photo_attributes.get("MediaUrl", "")
-                        # Assumes that all images is going to jpg, which is dangerous!
-                        photo_path = (
-                            f"{photo_dir}/{photo_attributes.get('Order', '1')}.jpg"
-                        )
+                order = photo_attributes.get("Order", "1")
+                # Assumes that all images is going to jpg, which is dangerous!
+                if agent:
+                    photo_path = f"{self.media_dir}/{self.agents_dir}/{listing_id}/.jpg"
+                else:
+                    photo_path = f"{self.media_dir}/{self.listings_path}/{listing_id}/{order}.jpg"
 
-                        self.s3.Bucket(AWS_STORAGE_BUCKET_NAME).put_object(
-                            Key=photo_path, Body=requests.get(image_url).content
+                if wait:
+                    saved = (
+                        self.photo_transfer.transfer(
+                            self.photo_transfer.save_to_s3, image_url, AWS_STORAGE_BUCKET_NAME, photo_path
                         )
+                        and saved
+                    )
                 else:
-                    splitted_row = data.split("\t")
-                    photo_attributes = self.build_dict(columns, splitted_row)
-                    image_url = photo_attributes.get("MediaUrl", "")
-                    # Assumes that all images is going to jpg, which is dangerous!
-                    photo_path = f"{photo_dir}/{photo_attributes.get('Order', '1')}.jpg"
-                    self.s3.Bucket(AWS_STORAGE_BUCKET_NAME).put_object(
-                        Key=photo_path, Body=requests.get(image_url).content
+                    self.photo_transfer.submit(
+                        (listing_id, order),
+                        self.photo_transfer.save_to_s3,
+                        image_url,
+                        AWS_STORAGE_BUCKET_NAME,
+                        photo_path,
                     )
+            return saved
         except Exception as e:
             logger.error(e)
             logger.error("Failed to save photo: %s", photo_path)
@@ -182,8 +214,7 @@ class S3Handler:
                 if len(xml_stream) < 500:
                     logger.debug("Listing Agent Photo is less than 500 Bytes")
                 else:
-                    self.save_photo(xml_stream, agent_id, agent=True)
-                    photo_downloaded = True
+                    photo_downloaded = self.save_photo(xml_stream, agent_id, agent=True)
             else:
                 raise Exception("Failed to Download Agent Photo:%s", agent_id)
         except Exception as e:
@@ -212,8 +243,7 @@ class S3Handler:
                         xml_stream,
                     )
                 else:
-                    self.save_photo(xml_stream, listing_key, str(photo_id))
-                    photo_downloaded = True
+                    photo_downloaded = self.save_photo(xml_stream, listing_key, str(photo_id))
             else:
                 raise Exception(
                     "Failed to download Photo:%s for Listing:%s", photo_id, listing_key
@@ -244,7 +274,7 @@ class S3Handler:
         Returns True if listings photos were successfully retrived and saved"""
         try:
             listing_key = listing["ID"]
-            photos_object = self.rets_session.get_object(
+            photos_object = self.rets_session.iter_object(
                 resource="Property",
                 object_type="LargePhoto",
                 content_ids=listing_key,
@@ -252,15 +282,15 @@ class S3Handler:
             )
             for photo in photos_object:
                 xml_stream = photo["content"]
-                if len(xml_stream) < 500:
+                photo_id = photo["object_id"]
+                if not xml_stream or len(xml_stream) < 500:
                     logger.error(
                         "Error in Photo:%s for listing:%s", photo_id, listing_key
                     )
                     self.append_failed_photo(photo_id, listing_key, failed_downloads)
                     continue
                 else:
-                    photo_id = photo["object_id"]
-                    self.save_photo(xml_stream, listing_key, photo_id)
+                    self.save_photo(xml_stream, listing_key, photo_id, wait=False)
             return True
         except Exception as e:
             logger.error(e)
@@ -384,6 +414,9 @@ class S3Handler:
                         photos_dict, listing_key, failed_downloads
                     )
                     continue
+            # Photos queued by get_photos
+            for listing_key, photo_id in self.photo_transfer.wait():
+                self.append_failed_photo(photo_id, listing_key, failed_downloads)
             if len(failed_downloads) > 0:
                 logger.warning("Failed to Download %s Photos", len(failed_downloads))
             else:
@@ -397,18 +430,15 @@ class S3Handler:
             logger.error("Failed to download photos for new listings")
             return False, [], progress
 
-    def delete_photos(self, listings_keys):
-        """ Deletes all phoros for a specific listing"""
+    def delete_photos(self, listings_keys, dry_run=False):
+        """ Deletes all phoros for a specific listing
+        Returns the (objects count, bytes) deleted"""
         try:
-            for listing_key in listings_keys:
-                photos_deleted = self.delete_photo_dir(listing_key)
-                if not photos_deleted:
-                    logger.error(
-                        "Failed to delete photos for listing : %s", listing_key
-                    )
+            return self.purge_listings_photos(listings_keys, dry_run)
         except Exception as e:
             logger.error(e)
             logger.error("Error in Deleting old Listings Photos")
+            return 0, 0
 
     def build_dict(self, columns, batch_data):
         """
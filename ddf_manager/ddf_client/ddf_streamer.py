@@ -1,5 +1,6 @@
 import json
 
+from core.utils import PackedRows
 from ddf_manager.settings import *
 
 from ..ddf_logger import logger
@@ -58,6 +59,62 @@ class Streamer:
             logger.error(e)
             return False
 
+    def _search(self, pack_rows=None, **kwargs):
+        """
+        Runs a search on the rets session, STANDARD-XML replies are parsed incrementally
+        while they are downloaded. The streamed records are fed to `pack_rows` if given
+        (e.g. DiskCacheManager.pack_rows) so the reply is never held as a list, otherwise
+        they are collected in a list.
+        """
+        result = self.rets_session.search(
+            format_type=self.format, stream_records=True, **kwargs
+        )
+        if result and not isinstance(result["Data"], (list, dict)):
+            if pack_rows is not None:
+                result["Data"] = pack_rows(result["Data"])
+            else:
+                result["Data"] = list(result["Data"])
+        return result
+
+    def stream_master_list(self):
+        """
+        Same as retrieve_master_list but without keeping the whole master list in memory.
+        Returns:
+            1- a generator of dictionaries containing the ids and other meta data, consumed as the reply is received.
+            2- The count (as per the source) as int.
+        """
+        try:
+            count = "-1"
+            master_list = self.rets_session.search(
+                resource="Property",
+                resource_class="Property",
+                dmql_query="(ID=*)",
+                format_type=self.format,
+                stream_records=True,
+            )
+            if not master_list:
+                logger.error(
+                    "Failed to retreive master_list, returned value:%s",
+                    str(master_list),
+                )
+                return iter([]), count
+
+            if master_list["ReplyCode"] != "0":
+                logger.error(
+                    "Search Failed by RETS Server, Returned Code: %s, Message: %s",
+                    master_list["ReplyCode"],
+                    master_list["ReplyText"],
+                )
+                return iter([]), count
+
+            count = master_list["Count"]
+            logger.info("Streaming Master List of %s Records", int(count))
+            return iter(master_list["Data"]), count
+        except Exception as e:
+            logger.error(e)
+            logger.error("Error in Retrieving Master List")
+            return iter([]), count
+
     def retrieve_master_list(self):
         """
         Retrives the Master List containing all available listings ids. This doesn't return the full listing details, just the ids.
@@ -67,11 +124,10 @@ class Streamer:
         """
         try:
             count = "-1"
-            master_list = self.rets_session.search(
+            master_list = self._search(
                 resource="Property",
                 resource_class="Property",
                 dmql_query="(ID=*)",
-                format_type=self.format,
             )
             if not master_list:
                 logger.error(
@@ -107,7 +163,7 @@ class Streamer:
             return [], count
 
     def retrieve_active_records(
-        self, last_update, offset=0, limit=SESSION_LISTINGS_COUNT
+        self, last_update, offset=0, limit=SESSION_LISTINGS_COUNT, pack_rows=None
     ):
         """
         Retrives the full details of the active records since a time stamp (last_update).
@@ -117,21 +173,22 @@ class Streamer:
             2- The offset for the first record.The API is limited to 100 records per call, so incase there is a 1000 records since that timestamp. 10 API calls are required with offsets
                 0,100,200... 900.
             3- limit: The limit for number of active records to be retrived. Set to SESSION_LISTINGS_COUNT by default
+            4- pack_rows: Optional callable the streamed records are fed to, see _search
         Returns:
-            1- a list of dictionaries containing the full listing details
+            1- a list of dictionaries containing the full listing details, or what pack_rows returned
             2- The count (as per the source) as int.
         """
         try:
             count = "-1"
             last_updated_query = "(LastUpdated=" + last_update + ")"
 
-            new_listings = self.rets_session.search(
+            new_listings = self._search(
                 resource="Property",
                 resource_class="Property",
                 dmql_query=last_updated_query,
                 limit=limit,
                 offset=offset,
-                format_type=self.format,
+                pack_rows=pack_rows,
             )
             if new_listings["ReplyCode"] == "20201":
                 logger.warning("No Active Records Founds")
@@ -147,7 +204,7 @@ class Streamer:
 
             if new_listings:
                 logger.debug("Retrieved %s Active Listings", len(new_listings["Data"]))
-                self.listings = new_listings["Data"]
+                listings = self.listings = new_listings["Data"]
                 count = new_listings["Count"]
 
             else:
@@ -155,34 +212,36 @@ class Streamer:
                     "No Active Listing found or Failed to retreive active records"
                 )
                 return [], count
-            return self.listings, count
+            # local reference, pages can be fetched from several threads at once
+            return listings, count
 
         except Exception as e:
             logger.error(e)
             logger.error("Failed to retreive active listings")
             return [], count
 
-    def retrieve_by_id(self, ids_list, search_class="Property"):
+    def retrieve_by_id(self, ids_list, search_class="Property", pack_rows=None):
         """
         Retrives the full details of listings according to a list of ids.
         Since the MLS API is limited to 100 records per call. The offset parameter can be used to adjust the starting record and move it accordingly in a loop
         Parameters:
             1- id_list: a list of ids as as string.
             2- search_class: Only "Property is used for this framework' other classes can be used in the future based on the MLS structure.
+            3- pack_rows: Optional callable the streamed records are fed to, see _search
         Returns:
-            1- a list of dictionaries containing the full listing details
+            1- a list of dictionaries containing the full listing details, or what pack_rows returned
             2- The count (as per the source) as int.
         """
         try:
             count = "-1"
             if ids_list:
                 query = "(ID=" + ",".join(map(str, ids_list)) + ")"
-                new_listings = self.rets_session.search(
+                new_listings = self._search(
                     resource=search_class,
                     resource_class=search_class,
                     dmql_query=query,
                     limit=None,
-                    format_type=self.format,
+                    pack_rows=pack_rows,
                 )
             else:
                 logger.error("ids_list argument is an empty list")
@@ -208,9 +267,9 @@ class Streamer:
                 )
                 return [], count
 
-            if new_listings and isinstance(new_listings["Data"], list):
+            if new_listings and isinstance(new_listings["Data"], (list, PackedRows)):
                 logger.info("Retrieved %s Listings by ID", len(new_listings["Data"]))
-                self.listings = new_listings["Data"]
+                listings = self.listings = new_listings["Data"]
                 count = new_listings["Count"]
             else:
                 logger.error(
@@ -219,7 +278,8 @@ class Streamer:
                 )
                 return [], count
 
-            return self.listings, count
+            # local reference, pages can be fetched from several threads at once
+            return listings, count
 
         except Exception as e:
             logger.error(e)
@@ -1,13 +1,17 @@
 import os
 import pickle
+from collections import defaultdict
+from datetime import timedelta
 
 import boto3
-from crea_parser.models import AgentDetails, DDF_LastUpdate, Property, PropertyInfo
+from crea_parser.models import AgentDetails, DDF_LastUpdate, PhotoDigest, Property, PropertyInfo, PropertyPhoto, PropertySearchIndex, SyncRun
 from django.db import transaction
+from django.utils import timezone
 
-from . import db_write
+from . import db_bulk_write, db_sharded_write, db_write
 from .aws_settings import *
 from .ddf_client.ddf_client import DDFClient
+from .ddf_client.ddf_photo_transfer import PhotoIndex, PhotoIndexEntry
 from .ddf_logger import *
 from .settings import *  # Local ddf_manager Settings.
 
@@ -20,6 +24,8 @@ if s3_reader:
 
 # writes records to DB. Passes ddf_clients listings data to the db_write.py module to write it to the db
 def update_records(data, fetch_and_update_every_single_record):
+    if BULK_WRITE_RECORDS:
+        return db_bulk_write.update_records(data["Listings"], fetch_and_update_every_single_record)
     return db_write.update_records(data["Listings"], fetch_and_update_every_single_record)
 
 
@@ -64,6 +70,7 @@ def delete_records(removed_listings):
         count = Property.active_objects.filter(ddf_id__in=removed_listings).update(
             is_active=False
         )
+        PropertySearchIndex.remove(Property.objects.filter(ddf_id__in=removed_listings).values("pk"))
         logger.info("Deleted %s old record from DB", count)
         return True
     except Exception as e:
@@ -72,48 +79,6 @@ def delete_records(removed_listings):
         return False
 
 
-# get lists of listing photos DIRs either locally or using S3 bucket
-def get_current_photos_dirs(s3=None):
-    dir = []
-    if s3:
-        try:
-            prefix = LISTING_DIR + "/"  # needed for s3 code below to work
-            FilesNotFound = True
-            # source: https://stackoverflow.com/questions/35803027/retrieving-subfolders-names-in-s3-bucket-from-boto3
-            # Paginator: https://www.slsmk.com/using-python-boto3-with-amazon-aws-s3-buckets/
-            paginator = s3.get_paginator("list_objects")
-            result = paginator.paginate(
-                Bucket=AWS_STORAGE_BUCKET_NAME, Prefix=prefix, Delimiter="/"
-            )
-            for pageobject in result:
-                for o in pageobject.get("CommonPrefixes"):
-                    dir.append(
-                        o.get("Prefix").strip(prefix).strip("/")
-                    )  # beaware not to use Numbers in LISTING_DIR as a name. otherwise it will be stripped.
-                    FilesNotFound = False
-            if FilesNotFound:
-                logger.error(
-                    "Error or No Photos dir where found in S3 Bucket:%s",
-                    AWS_STORAGE_BUCKET_NAME,
-                )
-        except Exception as e:
-            logger.error(e)
-            logger.error(
-                "Error occured white checking current DIRs in S3 Bucket: %s",
-                AWS_STORAGE_BUCKET_NAME,
-            )
-        logger.debug("Current DDF Photos DIRs:%s", dir)
-        return dir
-
-    else:
-        try:
-            dir = next(os.walk(LISTING_DIR))[1]
-        except Exception as e:
-            ddf_c.media_handler.create_dir(LISTING_DIR)
-            dir = next(os.walk(LISTING_DIR))[1]
-    return dir
-
-
 # retrive all photos info from the db for the purpose of comparasion against the new photo info from the ddf.
 def get_photos_info():
     try:
@@ -134,46 +99,50 @@ def get_photos_info():
         return {}
 
 
-# get list of photo files for a listing, used to sync photos.
-def get_listing_photos_file_list(listing_id, s3=None):
-    listing_dir_files = []
+# get_photos_inventory: indexes every listing photo in a single pass, one paginated list_objects_v2 sweep of the
+# S3 bucket or one walk of LISTING_DIR. Returns {listing id: set of photo names without extension} or None on failure.
+def get_photos_inventory(s3=None):
+    inventory = defaultdict(set)
     if s3:
         try:
-            prefix = LISTING_DIR + "/" + listing_id  # needed for s3 code below to wkr
-            FilesNotFound = True
-            # source: https://stackoverflow.com/questions/35803027/retrieving-subfolders-names-in-s3-bucket-from-boto3
-            # source: https://stackoverflow.com/questions/30249069/listing-contents-of-a-bucket-with-boto3
-            paginator = s3.get_paginator("list_objects")
-            page_iterator = paginator.paginate(
-                Bucket=AWS_STORAGE_BUCKET_NAME, Prefix=prefix
-            )
-            for page in page_iterator:
-                if "Contents" in page:
-                    for key in page["Contents"]:
-                        keyString = key["Key"]
-                        FilesNotFound = False
-                        listing_dir_files.append(keyString.split("/")[-1])
-            if FilesNotFound:
-                logger.error(
-                    "No Photos found for listing:%s dir where found in S3 Bucket:%s",
-                    listing_id,
-                    AWS_STORAGE_BUCKET_NAME,
-                )
+            prefix = LISTING_DIR + "/"
+            paginator = s3.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=AWS_STORAGE_BUCKET_NAME, Prefix=prefix):
+                for obj in page.get("Contents", []):
+                    # media/listings/{listing id}/{sequence id}.jpg
+                    parts = obj["Key"][len(prefix):].split("/")
+                    if len(parts) != 2:
+                        continue
+                    listing_id, file_name = parts
+                    listing_photos = inventory[listing_id]
+                    if file_name:
+                        listing_photos.add(file_name.rsplit(".", 1)[0])
         except Exception as e:
             logger.error(e)
             logger.error(
-                "Error occured white checking listing id: %s Photos in S3 Bucket: %s",
-                listing_id,
+                "Error occured while indexing the photos in S3 Bucket: %s",
                 AWS_STORAGE_BUCKET_NAME,
             )
+            return None
     else:
         try:
-            listing_dir_path = LISTING_DIR + "/" + listing_id
-            listing_dir_files = next(os.walk(listing_dir_path))[2]
-            return listing_dir_files
+            ddf_c.media_handler.create_dir(LISTING_DIR)
+            for listing_dir in os.scandir(LISTING_DIR):
+                if listing_dir.is_dir():
+                    inventory[listing_dir.name] = {
+                        entry.name.rsplit(".", 1)[0] for entry in os.scandir(listing_dir.path) if entry.is_file()
+                    }
         except Exception as e:
             logger.error(e)
-    return listing_dir_files
+            logger.error("Error occured while indexing the photos in %s", LISTING_DIR)
+            return None
+
+    logger.info(
+        "Indexed %s photos of %s listings",
+        sum(len(photos) for photos in inventory.values()),
+        len(inventory),
+    )
+    return dict(inventory)
 
 
 # returns current listings IDs in db
@@ -181,29 +150,88 @@ def get_db_listing_ids():
     return list(Property.active_objects.values_list("ddf_id", flat=True).filter())
 
 
+# returns current listings IDs in db with their last updated time stamp
+def get_db_listings_last_updated():
+    return dict(Property.active_objects.values_list("ddf_id", "last_updated"))
+
+
 # remove deleted photos listings DIRs by comparing the existing DIRs againts records in the DB. Folders with no db record will be deleted.
 # db records changes according to the ddf update where some records get removed from the MLS server due to expiry
-def delete_removed_photos_dirs(current_photos_dir_ids):
+def delete_removed_photos_dirs(current_photos_dir_ids, dry_run=False):
+    # Returns the (objects count, bytes) deleted, or that would be deleted with dry_run, None on failure
     try:
-        listings_ids = get_db_listing_ids()  # get current listing IDs from DB
+        listings_ids = set(get_db_listing_ids())  # get current listing IDs from DB
         # get listings that has folders but doesn't exists in DB
-        remove_photos_dir = [
-            listing for listing in current_photos_dir_ids if listing not in listings_ids
-        ]
+        remove_photos_dir = set(current_photos_dir_ids) - listings_ids
         logger.info(
             "Total Listings %s, Total Photos DIR %s, DIR Photos to be removed %s",
             len(listings_ids),
             len(current_photos_dir_ids),
             len(remove_photos_dir),
         )
-        ddf_c.remove_old_listings_photos(
-            remove_photos_dir
+        deleted = ddf_c.remove_old_listings_photos(
+            remove_photos_dir, dry_run
         )  # remove deleted listings DIRs
-        return True
+        if not dry_run:
+            # The deleted photos can't be reused by the photo transfers anymore
+            PhotoDigest.objects.filter(listing_key__in=[str(key) for key in remove_photos_dir]).delete()
+        return deleted
     except Exception as e:
         logger.error(e)
         logger.error("Error in get_removed_photos_dirs")
-        return False
+        return None
+
+
+# load_photo_index: loads the content hashes of the stored photos (PhotoDigest) into the photo transfers of the
+# media handler, the photos downloads of the sync then skip identical bytes and reuse identical photos.
+def load_photo_index():
+    if not PHOTOS_CONTENT_INDEX:
+        return
+    try:
+        entries = {
+            storage_key: PhotoIndexEntry(digest, size, etag, last_modified)
+            for storage_key, digest, size, etag, last_modified in PhotoDigest.objects.values_list(
+                "storage_key", "digest", "size", "etag", "last_modified"
+            ).iterator()
+        }
+        ddf_c.media_handler.photo_transfer.photo_index = PhotoIndex(entries)
+        ddf_c.media_handler.photo_transfer.reset_counters()
+        logger.info("Loaded the content hashes of %s photos", len(entries))
+    except Exception as e:
+        logger.error(e)
+        logger.error("Failed to load the photos content hashes")
+
+
+# save_photo_index: writes the content hashes recorded since load_photo_index and logs the bytes avoided by the sync
+def save_photo_index():
+    if not PHOTOS_CONTENT_INDEX:
+        return
+    try:
+        photo_transfer = ddf_c.media_handler.photo_transfer
+        changed = list(photo_transfer.photo_index.pop_changed().items())
+        for start in range(0, len(changed), BULK_WRITE_BATCH_SIZE):
+            batch = dict(changed[start : start + BULK_WRITE_BATCH_SIZE])
+            existing = {
+                photo_digest.storage_key: photo_digest
+                for photo_digest in PhotoDigest.objects.filter(storage_key__in=list(batch.keys()))
+            }
+            to_update = []
+            to_create = []
+            for storage_key, entry in batch.items():
+                photo_digest = existing.get(storage_key)
+                if photo_digest is None:
+                    # .../<listing id>/<order>.jpg
+                    photo_digest = PhotoDigest(storage_key=storage_key, listing_key=storage_key.rsplit("/", 2)[-2])
+                    to_create.append(photo_digest)
+                else:
+                    to_update.append(photo_digest)
+                photo_digest.digest, photo_digest.size, photo_digest.etag, photo_digest.last_modified = entry
+            PhotoDigest.objects.bulk_update(to_update, ["digest", "size", "etag", "last_modified"])
+            PhotoDigest.objects.bulk_create(to_create, ignore_conflicts=True)
+        logger.info("Photos transfers: %s", photo_transfer.get_counters())
+    except Exception as e:
+        logger.error(e)
+        logger.error("Failed to save the photos content hashes")
 
 
 # returns a list of agent photos in S3 or locally.
@@ -283,53 +311,41 @@ def sync_listing_photos(s3=None):
     # if db has records for photos that doesn't exists as a media file. These photos will be downloaded.
     # It also delete photos that doesn't have a record in the db
     try:
-        current_photos_dir_ids = get_current_photos_dirs(s3=s3)  # read current DIRs
-        if not current_photos_dir_ids:
+        photos_inventory = get_photos_inventory(s3=s3)  # index every photo in one pass
+        if not photos_inventory:
             raise Exception(
                 "Current Photos DIR are empty or failed to read from server, syncing was terminated"
             )
         delete_removed_photos_dirs(
-            current_photos_dir_ids
+            set(photos_inventory.keys())
         )  # delete removed Listing DIRs
-        listings_objs = Property.active_objects.all()  # get listings Objects
-        for listing_obj in listings_objs:
-            if listing_obj.Photos.exists():  # if listing Photos Tables exists
-                if (
-                    listing_obj.ddf_id not in current_photos_dir_ids
-                ):  # if DIR is missing
+
+        db_photos = defaultdict(list)  # Photos in db per listing
+        for ddf_id, sequence_id in (
+            PropertyPhoto.objects.filter(connected_property__is_active=True)
+            .values_list("connected_property__ddf_id", "SequenceId")
+            .iterator()
+        ):
+            db_photos[ddf_id].append(sequence_id)
+
+        for ddf_id, sequence_ids in db_photos.items():
+            listing_photos = photos_inventory.get(ddf_id)
+            if listing_photos is None:  # if DIR is missing
+                logger.info("Listing %s Photos weren't found in Media DIR", ddf_id)
+                ddf_c.media_handler.create_photo_dir(ddf_id)  # create DIR for that listing
+                missing_photos = sequence_ids  # Download all Photos
+            else:  # if DIR is not missing, check photos individually
+                missing_photos = [
+                    photo for photo in sequence_ids if str(photo) not in listing_photos
+                ]
+                if missing_photos:
                     logger.info(
-                        "Listing %s Photos weren't found in Media DIR",
-                        listing_obj.ddf_id,
+                        "Detected Missing Photos :%s for Listing:%s",
+                        missing_photos,
+                        ddf_id,
                     )
-                    ddf_c.media_handler.create_photo_dir(
-                        listing_obj.ddf_id
-                    )  # create DIR for that listing
-                    for photo_obj in listing_obj.Photos.all():  # Download all Photos
-                        ddf_c.media_handler.get_photo(
-                            photo_obj.SequenceId, listing_obj.ddf_id
-                        )
-                else:  # if DIR is not missing and listing Photos table exists, check photos individually
-                    db_photos = list(
-                        listing_obj.Photos.values_list("SequenceId", flat=True).filter()
-                    )  # list of Photos in db
-                    dir_photos = get_listing_photos_file_list(
-                        listing_obj.ddf_id, s3=s3
-                    )  # photo files
-                    missing_photos = [
-                        photo
-                        for photo in db_photos
-                        if str(photo) + ".jpg" not in dir_photos
-                    ]  # missing photos
-                    if missing_photos:  # if photo is missing
-                        logger.info(
-                            "Detected Missing Photos :%s for Listing:%s",
-                            missing_photos,
-                            listing_obj.ddf_id,
-                        )
-                        for missing_photo in missing_photos:
-                            ddf_c.media_handler.get_photo(
-                                missing_photo, listing_obj.ddf_id
-                            )
+            for missing_photo in missing_photos:
+                ddf_c.media_handler.get_photo(missing_photo, ddf_id)
         logger.info("Photos Sync was completed Successfully")
         return True
     except Exception as e:
@@ -338,14 +354,48 @@ def sync_listing_photos(s3=None):
         return False
 
 
-# update_db: updated db from DDF then updates tables,
-@transaction.atomic
-def update_db(sample=False, skip_photos=True, fetch_and_update_every_single_record=False):
-    # update_db is the primary function for reading the data from the DDF using the ddf_client and then updating the database accordingly.
-    # It triggers the photos downloads according to the new records recevied from DDF.
-    # if sample=True, only 10 records will be updated.
-    try:
-        previous_listings_keys = get_db_listing_ids()  # current listings IDs
+# start_sync_run: resumes the last interrupted sync run or starts a new one.
+# A run is only resumed for the same kind of sync, within SYNC_RUN_RESUME_HOURS and SYNC_RUN_MAX_RESUMES,
+# older interrupted runs are marked as failed.
+def start_sync_run(fetch_and_update_every_single_record=False):
+    sync_run = SyncRun.objects.filter(status=SyncRun.STATUS_RUNNING).order_by("-date_created").first()
+    if (
+        sync_run is not None
+        and sync_run.fetch_and_update_every_single_record == fetch_and_update_every_single_record
+        and sync_run.date_created > timezone.now() - timedelta(hours=SYNC_RUN_RESUME_HOURS)
+        and sync_run.resumed_count < SYNC_RUN_MAX_RESUMES
+    ):
+        sync_run.checkpoint(resumed_count=sync_run.resumed_count + 1)
+        logger.info("Resuming sync run %s at stage %s", sync_run.pk, sync_run.stage)
+        return sync_run
+
+    SyncRun.objects.filter(status=SyncRun.STATUS_RUNNING).update(
+        status=SyncRun.STATUS_FAILED, error="Abandoned, not resumable anymore"
+    )
+    return SyncRun.objects.create(fetch_and_update_every_single_record=fetch_and_update_every_single_record)
+
+
+# fetch_updates: fetch phase of update_db, reads the updated listings from the DDF using the ddf_client.
+# Returns the ddf_client update result and the new time stamp, raises if the DDF client failed.
+# With a sync_run the fetch is checkpointed, a resumed run continues its fetch or reuses the fetched listings.
+def fetch_updates(sample=False, skip_photos=True, fetch_and_update_every_single_record=False, sync_run=None):
+    if sync_run is not None and sync_run.is_done(SyncRun.STAGE_BY_ID_PAGES):
+        # Interrupted after the fetch, the listings are still in the disk cache
+        ddf_c.listing_disk_cache_manager.resume_disk_cache()
+        logger.info("Sync run %s was already fetched, skipping the DDF fetch", sync_run.pk)
+        updated = {
+            "Pass": True,
+            "Listings": ddf_c.listing_disk_cache_manager,
+            "Removed_Listings": sync_run.removed_listings,
+        }
+        return updated, sync_run.new_last_update
+
+    previous_listings_keys = get_db_listings_last_updated()  # current listings IDs and LastUpdated
+    if sync_run is not None and sync_run.last_update:
+        # Same time window as the interrupted attempt
+        last_update = sync_run.last_update
+        new_last_update = sync_run.new_last_update
+    else:
         last_update = read_last_update(fetch_and_update_every_single_record)  # Last Update time Stamp
         if not last_update:  # if no timestamp in the database
             add_initial_timestamp()  # write an initial value
@@ -355,12 +405,17 @@ def update_db(sample=False, skip_photos=True, fetch_and_update_every_single_reco
             skip_photos = True  # skip photos, will rely on the syncing
 
         new_last_update = ddf_c.get_gmt_time()  # get new time stamp
+        if sync_run is not None:
+            sync_run.checkpoint(last_update=last_update, new_last_update=new_last_update)
 
-        previous_photos = {}
+    previous_photos = {}
 
-        if not skip_photos:
-            previous_photos = get_photos_info()
+    if not skip_photos:
+        previous_photos = get_photos_info()
+        load_photo_index()
 
+    ddf_c.sync_run = sync_run
+    try:
         if sample:
             updated = ddf_c.update(
                 last_update=last_update,
@@ -378,20 +433,58 @@ def update_db(sample=False, skip_photos=True, fetch_and_update_every_single_reco
                 previous_photos=previous_photos,
                 skip_photos=skip_photos,
             )
+    finally:
+        ddf_c.sync_run = None
+
+    if not skip_photos:
+        save_photo_index()
+
+    if not updated["Pass"]:  # if update failed by DDF client
+        # if not updated['Status']:
+        raise Exception("Failed to update DDF")
+
+    if sync_run is not None:
+        sync_run.checkpoint(SyncRun.STAGE_WRITE, removed_listings=list(updated["Removed_Listings"]))
+    return updated, new_last_update
+
+
+# record_shard_written: checkpoints a shard written by crea_parser.tasks.write_ddf_listings_shard
+def record_shard_written(sync_run_id, shard_name):
+    with transaction.atomic():
+        # Shards are written in parallel, serialize the updates of the list
+        sync_run = SyncRun.objects.select_for_update().get(pk=sync_run_id)
+        if shard_name not in sync_run.shards_written:
+            sync_run.shards_written.append(shard_name)
+            sync_run.save(update_fields=["shards_written", "date_updated"])
+
+
+# finalize_update: last step of an update, applies the removals and advances the time stamp
+def finalize_update(removed_listings, new_last_update):
+    if not delete_records(removed_listings):  # if failed to delete removed listings from db
+        raise Exception("Failed to delete old records from db")
+    if not write_last_update(new_last_update):  # if failed to update timestamp
+        raise Exception("Failed to update LastUpdate time stamp in db")
+
 
-        if not updated["Pass"]:  # if update failed by DDF client
-            # if not updated['Status']:
-            raise Exception("Failed to update DDF")
-        else:  # if update passed by DDF client
+# update_db: updated db from DDF then updates tables,
+def update_db(sample=False, skip_photos=True, fetch_and_update_every_single_record=False, sync_run=None):
+    # update_db is the primary function for reading the data from the DDF using the ddf_client and then updating the database accordingly.
+    # It triggers the photos downloads according to the new records recevied from DDF.
+    # if sample=True, only 10 records will be updated.
+    # The fetch is checkpointed on the sync_run outside of the transaction, the records, the removals and the
+    # time stamp are written in a single transaction. The fetched listings are only wiped once it commits.
+    try:
+        updated, new_last_update = fetch_updates(
+            sample, skip_photos, fetch_and_update_every_single_record, sync_run
+        )
+        with transaction.atomic():
+            # if update passed by DDF client
             if not update_records(updated, fetch_and_update_every_single_record):  # if failed to write to db
                 raise Exception("Failed to update new records to db")
-            if not delete_records(
-                updated["Removed_Listings"]
-            ):  # if failed to delete removed listings from db
-                raise Exception("Failed to delete old records from db")
-            if not write_last_update(new_last_update):  # if failed to update timestamp
-                raise Exception("Failed to update LastUpdate time stamp in db")
-            logger.info("DB updated successfully")  # updated successfully
+            finalize_update(updated["Removed_Listings"], new_last_update)
+            if sync_run is not None:
+                sync_run.complete()
+        logger.info("DB updated successfully")  # updated successfully
         return True
     except Exception as e:
         logger.error(e)
@@ -399,8 +492,53 @@ def update_db(sample=False, skip_photos=True, fetch_and_update_every_single_reco
         return False
 
 
+# update_db_sharded: fan-out variant of update_db, only runs the fetch phase.
+# The fetched listings are partitioned into INGEST_SHARDS disk caches, written afterwards by parallel tasks
+# (crea_parser.tasks.write_ddf_listings_shard), the removals and the time stamp are left for finalize_update.
+# Returns the sync plan {"Shards", "Removed_Listings", "New_Last_Update"} or False.
+# A resumed sync_run that was already partitioned only returns the shards that weren't written yet.
+def update_db_sharded(
+    sample=False, skip_photos=True, fetch_and_update_every_single_record=False, sync_run=None
+):
+    try:
+        if sync_run is not None and sync_run.shards:
+            shards = [shard for shard in sync_run.shards if shard not in sync_run.shards_written]
+            logger.info("Resuming sync run %s, %s shards left to write", sync_run.pk, len(shards))
+            return {
+                "Shards": shards,
+                "Removed_Listings": list(sync_run.removed_listings),
+                "New_Last_Update": sync_run.new_last_update,
+                "Sync_Run": sync_run.pk,
+            }
+
+        updated, new_last_update = fetch_updates(
+            sample, skip_photos, fetch_and_update_every_single_record, sync_run
+        )
+        shards = db_sharded_write.partition_listings(updated["Listings"], INGEST_SHARDS)
+        logger.info("Fetched listings split into %s shards", len(shards))
+        if sync_run is not None:
+            sync_run.checkpoint(shards=shards)
+        # The shards hold everything now
+        updated["Listings"].wipe()
+        return {
+            "Shards": shards,
+            "Removed_Listings": list(updated["Removed_Listings"]),
+            "New_Last_Update": new_last_update,
+            "Sync_Run": sync_run.pk if sync_run is not None else None,
+        }
+    except Exception as e:
+        logger.error(e)
+        logger.error("Error in database update changes have been ignored")
+        return False
+
+
 def update_server(
-    enable_photos_sync=True, sample=False, task_id="Undefined celery task", fetch_and_update_every_single_record=False
+    enable_photos_sync=True,
+    sample=False,
+    task_id="Undefined celery task",
+    fetch_and_update_every_single_record=False,
+    sharded=False,
+    sync_run=None,
 ):
     # update_server: is the parent function for updating the DDF records and photos.
     # It does the following
@@ -408,6 +546,8 @@ def update_server(
     # 2- calls update_db function to update DDF records and photos from the MLS server into the DB including the media files.
     # 3- applies photo_syncing to confirm all photos are synced and upto date.
     # 4- Logout.
+    # With sharded=True update_db_sharded is used instead and its sync plan is returned, the listings
+    # are written later by the shard tasks.
     logger.info("A celery task with an id of %s has started", task_id)
 
     exception_error = "Undefined Exception!"
@@ -417,19 +557,20 @@ def update_server(
 
     try:
         ddf_c.login()
-        result = update_db(sample, skip_download_photos, fetch_and_update_every_single_record)
+        if sharded:
+            result = update_db_sharded(
+                sample, skip_download_photos, fetch_and_update_every_single_record, sync_run
+            )
+        else:
+            result = update_db(sample, skip_download_photos, fetch_and_update_every_single_record, sync_run)
         if result:
             if enable_photos_sync and not sample:
-                s3 = None
-                if s3_reader:
-                    s3 = s3_session.client(
-                        "s3",
-                        aws_access_key_id=AWS_ACCESS_KEY_ID,  # S3 has to be defined here otherwise, connection will drop.
-                        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-                    )
+                s3 = get_s3_client()
 
                 if skip_download_photos == False:
+                    load_photo_index()
                     sync_listing_photos(s3=s3)
+                    save_photo_index()
                 else:
                     logger.info("Skipped downloading and syncing photos!")
                 # sync_agents_photos(s3=s3) #Enable only at first Download. Causes Delays as it checks for Photos that doesn't exists.
@@ -454,6 +595,26 @@ def update_server(
     return False
 
 
+# returns an S3 client when the S3 reader is used, None for the local file system
+def get_s3_client():
+    if not s3_reader:
+        return None
+    return s3_session.client(
+        "s3",
+        aws_access_key_id=AWS_ACCESS_KEY_ID,  # S3 has to be defined here otherwise, connection will drop.
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+    )
+
+
+# purge_removed_photos: deletes the photos DIRs of the listings that are no longer in the db.
+# With dry_run nothing is deleted, only the reclaimable objects and bytes are reported.
+def purge_removed_photos(dry_run=False):
+    photos_inventory = get_photos_inventory(s3=get_s3_client())
+    if photos_inventory is None:
+        return None
+    return delete_removed_photos_dirs(set(photos_inventory.keys()), dry_run)
+
+
 # To initialize ddf_timestamp in the database.
 def add_initial_timestamp():
     DDF_LastUpdate.objects.update_or_create(
@@ -16,6 +16,12 @@ class HTTPException(Exception):
     pass
 
 
+class TransientHTTPException(HTTPException):
+    """The RETS server is overloaded or restarting, the request can be retried"""
+
+    pass
+
+
 class NotLoggedIn(Exception):
     """Authentication Required to Access RETS server"""
 
@@ -36,91 +36,102 @@ class ObjectParser(Base):
 class MultipleObjectParser(ObjectParser):
     """Parses multiple object responses such as multiple images in a multi-part response"""
 
-    def _get_multiparts(self, response):
-        # multipart
+    boundary = b"--creaboundary"
+
+    # Bytes read from the response at a time
+    chunk_size = 64 * 1024
+
+    @staticmethod
+    def _parse_part_headers(header):
+        part_header_dict = {}
+        for line in header.split(b"\r\n"):
+            if b":" in line:
+                key, value = line.split(b":", 1)
+                part_header_dict[key.decode().strip()] = value.decode().strip()
+        return part_header_dict
+
+    def _split_part(self, buffer, start, end):
         """
-        From this
-        'multipart/parallel; boundary="874e43d27ec6d83f30f37841bdaf90c7"; charset=utf-8'
-        get this
-        --874e43d27ec6d83f30f37841bdaf90c7
+        Splits the part of buffer between start and end (two boundaries) into its headers dict and body.
+        The delimiters are searched in place, the body is the only bytes copied out of the buffer.
+        Returns None for an empty part.
         """
-        # boundary = None
-        # for part in response.headers.get('Content-Type', '').split(';'):
-        #     if 'boundary=' in part:
-        #         boundary = b'--{}'.format(part.split('=', 1)[1].strip('\"'))
-        #
-        # if not boundary:
-        #     raise ParseError("Was not able to find the boundary between objects in a multipart response")
-        #
-        # if response.content is None:
-        #     return []
-
-        boundary = b"--creaboundary"
-
-        # response_string = response.content if PY2 else response.content.decode(errors='replace')
-        response_string = response.content
-
         #  help bad responses be more multipart compliant
-        whole_body = response_string.strip(b"\r\n")
-        no_front_boundary = whole_body.strip(boundary)
-        # The boundary comes with some characters
-
-        multi_parts = []
-        for part in no_front_boundary.split(boundary):
-            multi_parts.append(part.strip(b"\r\n"))
-
-        return multi_parts
-
-    def parse_image_response(self, response):
+        while start < end and buffer[start] in b"\r\n":
+            start += 1
+        while end > start and buffer[end - 1] in b"\r\n":
+            end -= 1
+        if end - start <= 2 and buffer[start:end] in (b"", b"--"):
+            # Nothing or the closing boundary
+            return None
+
+        separator = buffer.find(b"\r\n\r\n", start, end)
+        if separator == -1:
+            return self._parse_part_headers(buffer[start:end]), None
+
+        with memoryview(buffer) as view:
+            body = bytes(view[separator + 4 : end])
+        return self._parse_part_headers(buffer[start:separator]), body or None
+
+    def iter_multiparts(self, chunks):
         """
-        Parse multiple objects from the RETS feed. A lot of string methods are used to handle the response before
-        encoding it back into bytes for the object.
-        :param response: The response from the feed
-        :return: list of SingleObjectParser
+        Scans the boundaries over the chunks of a multipart body and yields (headers, body) per part.
+        Only the part being read is kept in memory, so bodies can be piped to storage as they come.
+        """
+        boundary = self.boundary
+        buffer = bytearray()
+        # Offset in buffer where the boundary search resumes, bytes before it were already scanned
+        search_from = 0
+        found_first_boundary = False
+
+        for chunk in chunks:
+            if not chunk:
+                continue
+            buffer += chunk
+
+            while True:
+                index = buffer.find(boundary, search_from)
+                if index == -1:
+                    # The boundary may straddle two chunks
+                    search_from = max(0, len(buffer) - len(boundary) + 1)
+                    break
+
+                if found_first_boundary:
+                    parsed_part = self._split_part(buffer, 0, index)
+                    if parsed_part is not None:
+                        yield parsed_part
+                found_first_boundary = True
+
+                # Drops the consumed part and its boundary
+                del buffer[: index + len(boundary)]
+                search_from = 0
+
+        if found_first_boundary and buffer:
+            parsed_part = self._split_part(buffer, 0, len(buffer))
+            if parsed_part is not None:
+                yield parsed_part
+
+    def iter_image_response(self, response):
+        """
+        Streams the objects of a multipart response one by one
+        :param response: The response from the feed, requested with stream=True
+        :return: generator of objects
         """
         if "xml" in response.headers.get("Content-Type"):
             # Got an XML response, likely an error code.
             xml = xmltodict.parse(response.text)
             self.analyze_reply_code(xml_response_dict=xml)
 
-        multi_parts = self._get_multiparts(response)
-        parsed = []
-        # go through each part of the multipart message
-        for part in multi_parts:
-            clean_part = part.strip(b"\r\n\r\n")
-            if b"\r\n\r\n" in clean_part:
-                header, body = clean_part.split(b"\r\n\r\n", 1)
-                # header = str(header)
-            else:
-                header = clean_part
-                body = None
-            # part_header_dict = {}
-            part_header_dict = {
-                k.decode(): v.decode()
-                for k, v in (h.split(b":", 1) for h in header.split(b"\r\n"))
-            }
-
-            # Some multipart requests respond with a text/XML part stating an error
-            # if b'xml' in part_header_dict.get('Content-Type'):
-            #     # Got an XML response, likely an error code.
-            #     xml = xmltodict.parse(body)
-            #     try:
-            #         self.analyze_reply_code(xml_response_dict=xml)
-            #     except RETSException as e:
-            #         if e.reply_code == '20403':
-            #             # The requested object_id was not found.
-            #             continue
-            #         raise e
-
-            if body:
-                obj = self._response_object_from_header(
-                    obj_head_dict=part_header_dict, content=body
-                )
-                # content=body if PY2 else body.encode())
-            else:
-                obj = self._response_object_from_header(obj_head_dict=part_header_dict)
-            parsed.append(obj)
-        return parsed
+        for part_header_dict, body in self.iter_multiparts(response.iter_content(self.chunk_size)):
+            yield self._response_object_from_header(obj_head_dict=part_header_dict, content=body)
+
+    def parse_image_response(self, response):
+        """
+        Parse multiple objects from the RETS feed.
+        :param response: The response from the feed
+        :return: list of objects
+        """
+        return list(self.iter_image_response(response))
 
 
 class SingleObjectParser(ObjectParser):
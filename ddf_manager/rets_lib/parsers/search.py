@@ -37,9 +37,16 @@ def etree_to_dict(t):
     return d
 
 
+def strip_namespace(tag):
+    return re.sub(r"{.*}", "", tag)
+
+
 class OneXSearchCursor(Base):
     """Parses Search Result Data"""
 
+    # Depth of the records in a STANDARD-XML reply: RETS > RETS-RESPONSE > record
+    RECORD_DEPTH = 3
+
     def __init__(self):
         self.parsed_rows = 0
 
@@ -85,6 +92,80 @@ class OneXSearchCursor(Base):
 
         return response_dic
 
+    def stream_xml(self, response, resource):
+        """
+        Streaming version of generator_xml.
+
+        Reads the reply header (ReplyCode, ReplyText and Count) straight from
+        response.raw and returns the same dictionary as generator_xml, except
+        that "Data" is a generator yielding one record (e.g. PropertyDetails)
+        at a time. Records are parsed while the body is still being received
+        and their elements are cleared once yielded, so memory use doesn't
+        grow with the size of the reply.
+        :param response: a Requests response object with stream=True
+        :param resource: The searched resource, records are `resource` or `resource`Details tags
+        :return: dict
+        """
+        response.raw.decode_content = True
+
+        response_dic = {
+            "ReplyCode": "-1",
+            "ReplyText": "No Query applied or Unknown Error occuried",
+            "Count": "0",
+            "Data": [],
+        }
+
+        events = ET.iterparse(response.raw, events=("start", "end"))
+        depth = 0
+        for event, elem in events:
+            tag = strip_namespace(elem.tag)
+            if event == "start":
+                depth += 1
+                if tag == "RETS":
+                    if "ReplyCode" not in elem.attrib or "ReplyText" not in elem.attrib:
+                        response.close()
+                        return response_dic
+                    response_dic["ReplyCode"] = elem.get("ReplyCode")
+                    response_dic["ReplyText"] = elem.get("ReplyText")
+                elif tag == "RETS-RESPONSE":
+                    # No COUNT tag, same as generator_xml there is no data to return
+                    response.close()
+                    return response_dic
+            else:
+                depth -= 1
+                if tag == "COUNT":
+                    response_dic["Count"] = elem.get("Records", response_dic["Count"])
+                    response_dic["Data"] = self._iter_xml_records(
+                        response, events, resource, depth
+                    )
+                    return response_dic
+
+        response.close()
+        return response_dic
+
+    def _iter_xml_records(self, response, events, resource, depth):
+        record_tags = (resource, resource + "Details")
+        container = None
+        try:
+            for event, elem in events:
+                if event == "start":
+                    depth += 1
+                    if depth == self.RECORD_DEPTH - 1:
+                        container = elem
+                    continue
+
+                depth -= 1
+                if depth == self.RECORD_DEPTH - 1 and strip_namespace(elem.tag) in record_tags:
+                    record = etree_to_dict(elem)
+                    self.parsed_rows += 1
+                    yield next(iter(record.values()))
+                    # Drop the yielded record and its already processed siblings
+                    elem.clear()
+                    if container is not None:
+                        container.clear()
+        finally:
+            response.close()
+
     def generator(self, response):
         """
         Takes a response socket connection and iteratively parses and yields the results as python dictionaries.
@@ -1,5 +1,9 @@
 import hashlib
 import logging
+import threading
+import time
+from collections import defaultdict
+
 import xmltodict
 
 import requests
@@ -12,11 +16,20 @@ from .exceptions import (
     MissingVersion,
     NotLoggedIn,
     RETSException,
+    TransientHTTPException,
 )
 from .parsers.get_object import MultipleObjectParser, SingleObjectParser
 from .parsers.login import OneXLogin
 from .parsers.metadata import CompactMetadata, StandardXMLetadata
 from .parsers.search import OneXSearchCursor
+from .transport import (
+    RETRY_STATUS_CODES,
+    SESSION_EXPIRED_REPLY_CODES,
+    KeepAliveAdapter,
+    LatencyHistogram,
+    backoff_delay,
+    default_retry_budget,
+)
 from .utils import DMQLHelper
 from .utils.get_object import GetObject
 
@@ -30,6 +43,7 @@ except ImportError:
     from urllib.parse import quote, urlparse
 
 logging.getLogger("urllib3").setLevel(logging.ERROR)  # IH
+logger = logging.getLogger("rets")
 # logger = logging.getLogger('rets').setLevel(logging.ERROR)
 # logging.getLogger('requests').setLevel(logging.ERROR)
 
@@ -52,6 +66,11 @@ class Session(object):
         follow_redirects=True,
         use_post_method=True,
         metadata_format="STANDARD-XML-Encoded",
+        retries=3,
+        backoff=0.5,
+        timeout=None,
+        retry_budget=None,
+        auto_relogin=True,
     ):
         """
         Session constructor
@@ -65,6 +84,11 @@ class Session(object):
         :param use_post_method: Use HTTP POST method when making requests instead of GET. The default is True
         :param metadata_format: COMPACT_DECODED or STANDARD_XML. The client will attempt to set this automatically
         based on response codes from the RETS server.
+        :param retries: Retries of a request failing with a connection error, a timeout or a RETRY_STATUS_CODES status
+        :param backoff: Base delay in seconds between retries, doubled on every attempt and jittered
+        :param timeout: requests timeout, (connect, read) seconds. None waits forever
+        :param retry_budget: RetryBudget bounding the retries, the process wide budget by default
+        :param auto_relogin: Login again and replay the request when the RETS session expired
         """
         self.client = requests.Session()
         self.login_url = login_url
@@ -84,7 +108,23 @@ class Session(object):
         self.capabilities = {}
 
         self.client = requests.Session()
+        adapter = KeepAliveAdapter()
+        self.client.mount("https://", adapter)
+        self.client.mount("http://", adapter)
         self.session_id = None
+
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.retry_budget = retry_budget or default_retry_budget
+        self.auto_relogin = auto_relogin
+        # Incremented on every login, concurrent requests failing on the same expired session login once
+        self.login_generation = 0
+        self.login_lock = threading.RLock()
+        self.latency = defaultdict(LatencyHistogram)
+        self.retry_count = 0
+        self.relogin_count = 0
+        self.login_details = {}
         if self.http_authentication == "basic":
             self.client.auth = HTTPBasicAuth(self.username, self.password)
         else:
@@ -147,6 +187,9 @@ class Session(object):
         parser.parse(response)
 
         self.session_id = response.cookies.get("RETS-Session-ID", "")
+        self.login_generation += 1
+        # MetadataVersion, MetadataTimestamp... of the login response
+        self.login_details = parser.details
 
         if parser.headers.get("RETS-Version") is not None:
             self.version = str(parser.headers.get("RETS-Version"))
@@ -167,6 +210,33 @@ class Session(object):
         self._request(capability="Logout")
         return True
 
+    def relogin(self, login_generation):
+        """
+        Logs in again unless another request already did since login_generation
+        :param login_generation: The login_generation the failed request was sent with
+        :return: None
+        """
+        with self.login_lock:
+            if self.login_generation != login_generation:
+                return
+            logger.warning("The RETS session expired, logging in again")
+            self.relogin_count += 1
+            self.login()
+
+    def get_transport_stats(self):
+        """
+        Retries, relogins and the latency histograms per capability. The latency is the time to the
+        response headers, the streamed bodies are read afterwards.
+        :return: dict
+        """
+        return {
+            "retries": self.retry_count,
+            "relogins": self.relogin_count,
+            "retry_budget_tokens": round(self.retry_budget.tokens, 2),
+            "retry_budget_exhausted": self.retry_budget.exhausted_count,
+            "latency": {capability: histogram.snapshot() for capability, histogram in self.latency.items()},
+        }
+
     def get_system_metadata(self):
         """
         Get the top level metadata
@@ -322,6 +392,29 @@ class Session(object):
         :param location: The path to get Objects from
         :return: list
         """
+        return list(
+            self.iter_object(
+                resource=resource,
+                object_type=object_type,
+                content_ids=content_ids,
+                object_ids=object_ids,
+                location=location,
+            )
+        )
+
+    def iter_object(
+        self, resource, object_type, content_ids, object_ids="*", location=0
+    ):
+        """
+        Streams the Objects of a resource, multipart responses are parsed part by part as they
+        are received so only one object body is held in memory at a time
+        :param resource: The resource to get objects from
+        :param object_type: The type of object to fetch
+        :param content_ids: The unique id of the item to get objects for
+        :param object_ids: ids of the objects to download
+        :param location: The path to get Objects from
+        :return: generator of objects
+        """
         object_helper = GetObject()
         request_ids = object_helper.ids(content_ids=content_ids, object_ids=object_ids)
         submit_id = ",".join(request_ids)
@@ -336,16 +429,20 @@ class Session(object):
                     "Location": location,
                 }
             },
+            stream=True,
         )
 
-        if "multipart" in response.headers.get("Content-Type"):
-            parser = MultipleObjectParser()
-            collection = parser.parse_image_response(response)
-        else:
-            parser = SingleObjectParser()
-            collection = [parser.parse_image_response(response)]
-
-        return collection
+        try:
+            if "multipart" in response.headers.get("Content-Type"):
+                parser = MultipleObjectParser()
+                for obj in parser.iter_image_response(response):
+                    yield obj
+            else:
+                parser = SingleObjectParser()
+                yield parser.parse_image_response(response)
+        finally:
+            # Gives the connection back to the pool even if the caller stops early
+            response.close()
 
     def search(
         self,
@@ -358,6 +455,7 @@ class Session(object):
         optional_parameters=None,
         auto_offset=True,
         format_type="STANDARD-XML-Encoded",
+        stream_records=False,
     ):
         """
         Preform a search on the RETS board
@@ -369,6 +467,7 @@ class Session(object):
         :param offset: Offset for RETS request. Useful when RETS limits number of results or transactions
         :param optional_parameters: Values for option paramters
         :param auto_offset: Should the search be allowed to trigger subsequent searches.
+        :param stream_records: Parse the reply incrementally, "Data" is then a generator of records (STANDARD-XML only)
         :return: dict
         """
 
@@ -408,47 +507,99 @@ class Session(object):
         if offset:
             parameters["Offset"] = offset
 
-        search_cursor = OneXSearchCursor()
+        relogged = False
+        while True:
+            search_cursor = OneXSearchCursor()
 
-        response = self._request(
-            capability="Search",
-            options={
-                "query": parameters,
-            },
-            stream=True,
-        )
-        # print(parameters)
-        try:
-            if format_type == "STANDARD-XML-Encoded":
-                return search_cursor.generator_xml(response=response, resource=resource)
-            else:
-                return search_cursor.generator(response=response)
-
-        except MaxrowException as max_exception:
-            if auto_offset and limit > len(max_exception.rows_returned):
-                new_limit = limit - len(
-                    max_exception.rows_returned
-                )  # have not returned results to the desired limit
-                new_offset = offset + len(max_exception.rows_returned)  # adjust offset
-                results = self.search(
-                    resource=resource,
-                    resource_class=resource_class,
-                    search_filter=None,
-                    dmql_query=dmql_query,
-                    offset=new_offset,
-                    limit=new_limit,
-                    optional_parameters=optional_parameters,
-                    auto_offset=auto_offset,
-                    format_type=format_type
-                )
+            response = self._request(
+                capability="Search",
+                options={
+                    "query": parameters,
+                },
+                stream=True,
+            )
+            # print(parameters)
+            login_generation = self.login_generation
+            try:
+                if format_type == "STANDARD-XML-Encoded" and stream_records:
+                    result = search_cursor.stream_xml(response=response, resource=resource)
+                elif format_type == "STANDARD-XML-Encoded":
+                    result = search_cursor.generator_xml(response=response, resource=resource)
+                else:
+                    result = search_cursor.generator(response=response)
+
+            except MaxrowException as max_exception:
+                if auto_offset and limit > len(max_exception.rows_returned):
+                    new_limit = limit - len(
+                        max_exception.rows_returned
+                    )  # have not returned results to the desired limit
+                    new_offset = offset + len(max_exception.rows_returned)  # adjust offset
+                    results = self.search(
+                        resource=resource,
+                        resource_class=resource_class,
+                        search_filter=None,
+                        dmql_query=dmql_query,
+                        offset=new_offset,
+                        limit=new_limit,
+                        optional_parameters=optional_parameters,
+                        auto_offset=auto_offset,
+                        format_type=format_type
+                    )
+
+                    previous_results = max_exception.rows_returned
+                    return previous_results + results
+                return max_exception.rows_returned
 
-                previous_results = max_exception.rows_returned
-                return previous_results + results
-            return max_exception.rows_returned
+            # The parsers return the reply code instead of raising, and the streamed
+            # reply header is read before any record, so the search is replayed once
+            if (
+                self.auto_relogin
+                and not relogged
+                and result.get("ReplyCode") in SESSION_EXPIRED_REPLY_CODES
+            ):
+                response.close()
+                relogged = True
+                self.relogin(login_generation)
+                continue
+
+            return result
 
     def _request(self, capability, options=None, stream=False):
         """
-        Make a _request to the RETS server
+        Make a _request to the RETS server. Connection errors, timeouts and RETRY_STATUS_CODES statuses are
+        retried with a jittered backoff while the retry budget allows it, an expired session is logged in again
+        :param capability: The name of the capability to use to get the URI
+        :param options: Options to put into the _request
+        :return: Response
+        """
+        self.retry_budget.deposit()
+        attempt = 0
+        relogged = False
+        while True:
+            login_generation = self.login_generation
+            start = time.monotonic()
+            try:
+                response = self._send(capability, options, stream)
+                self.latency[capability].observe(time.monotonic() - start)
+                return response
+            except NotLoggedIn:
+                self.latency[capability].observe(time.monotonic() - start)
+                if relogged or not self.auto_relogin or capability in ("Login", "Action", "Logout"):
+                    raise
+                relogged = True
+                self.relogin(login_generation)
+            except (requests.ConnectionError, requests.Timeout, TransientHTTPException) as e:
+                self.latency[capability].observe(time.monotonic() - start)
+                if attempt >= self.retries or not self.retry_budget.withdraw():
+                    raise
+                logger.warning("%s request failed (%s), retry %s", capability, e, attempt + 1)
+                self.retry_count += 1
+                time.sleep(backoff_delay(self.backoff, attempt))
+                attempt += 1
+
+    def _send(self, capability, options=None, stream=False):
+        """
+        Sends a single request to the RETS server
         :param capability: The name of the capability to use to get the URI
         :param options: Options to put into the _request
         :return: Response
@@ -477,7 +628,7 @@ class Session(object):
         ):  # Action Requests should always be GET
             query = options.get("query")
             response = self.client.post(
-                url, data=query, headers=options["headers"], stream=stream
+                url, data=query, headers=options["headers"], stream=stream, timeout=self.timeout
             )
         else:
             if "query" in options:
@@ -485,14 +636,23 @@ class Session(object):
                     "{0!s}={1!s}".format(k, quote(str(v)))
                     for k, v in options["query"].items()
                 )
-            response = self.client.get(url, headers=options["headers"], stream=stream)
+            response = self.client.get(
+                url, headers=options["headers"], stream=stream, timeout=self.timeout
+            )
         if response.status_code in [400, 401]:
+            response.close()
             if capability == "Login":
                 m = "Could not log into the RETS server with the provided credentials."
             else:
                 m = "The RETS server returned a 401 status code. You must be logged in to make this request."
             raise NotLoggedIn(m)
 
+        elif response.status_code in RETRY_STATUS_CODES:
+            response.close()
+            raise TransientHTTPException(
+                "The RETS server returned a {0!s} status code.".format(response.status_code)
+            )
+
         elif response.status_code == 404 and self.use_post_method:
             raise HTTPException(
                 "Got a 404 when making a POST request. Try setting use_post_method=False when "
@@ -526,6 +686,16 @@ class Session(object):
         return digest
 
 
+    def get_metadata_version(self):
+        """
+        The metadata version announced by the server at login, it changes whenever the metadata changes
+        :return: str or None
+        """
+        version = self.login_details.get("MetadataVersion")
+        if not version:
+            return None
+        return "{0!s}:{1!s}".format(version, self.login_details.get("MetadataTimestamp", ""))
+
     def get_response_lookup_values(self, resource, lookup_name):
         """
         Get the raw response from lookup values
@@ -0,0 +1,128 @@
+import bisect
+import random
+import socket
+import threading
+
+from requests.adapters import HTTPAdapter
+
+# HTTP status codes worth retrying, the server is overloaded or restarting
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Reply codes of an expired or unknown RETS session, a new login fixes them
+SESSION_EXPIRED_REPLY_CODES = ("20037", "20701")
+
+# Upper bounds in seconds of the latency histograms buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """
+    HTTPAdapter enabling TCP keep-alive on the pooled connections, so a connection idle between
+    two pages isn't silently dropped by a NAT or a load balancer
+    """
+
+    def __init__(self, keepalive_idle=60, keepalive_interval=15, keepalive_count=4, **kwargs):
+        self.socket_options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        # Linux only options
+        for name, value in (
+            ("TCP_KEEPIDLE", keepalive_idle),
+            ("TCP_KEEPINTVL", keepalive_interval),
+            ("TCP_KEEPCNT", keepalive_count),
+        ):
+            if hasattr(socket, name):
+                self.socket_options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = self.socket_options
+        return super().init_poolmanager(*args, **kwargs)
+
+
+class RetryBudget(object):
+    """
+    Bounds the retries to a ratio of the requests, so a degraded endpoint gets at most
+    `ratio` extra load instead of every request being multiplied by its retries.
+    Every request deposits `ratio` token, every retry withdraws one.
+    :param ratio: Retries allowed per request
+    :param reserve: Tokens available from the start, lets the first requests retry
+    :param max_tokens: Cap of the saved tokens, a long healthy period doesn't buy a retry storm
+    """
+
+    def __init__(self, ratio=0.2, reserve=10, max_tokens=100):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = float(reserve)
+        self.exhausted_count = 0
+        self.lock = threading.Lock()
+
+    def set_ratio(self, ratio):
+        with self.lock:
+            self.ratio = ratio
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """
+        Returns True if a retry is allowed
+        """
+        with self.lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            self.exhausted_count += 1
+            return False
+
+
+class LatencyHistogram(object):
+    """
+    Cumulative latency histogram, counts of the observations per LATENCY_BUCKETS bucket
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # The last bucket counts the observations above the last bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.count += 1
+            self.total += seconds
+
+    def percentile(self, percentile):
+        """
+        Upper bound of the bucket holding the percentile, None above the last bound
+        """
+        rank = self.count * percentile / 100.0
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "count": self.count,
+                "mean": self.total / self.count if self.count else 0,
+                "p50": self.percentile(50),
+                "p95": self.percentile(95),
+                "p99": self.percentile(99),
+                "buckets": dict(zip([str(bound) for bound in self.buckets] + ["+Inf"], self.counts)),
+            }
+
+
+def backoff_delay(backoff, attempt):
+    # Exponential backoff with jitter, concurrent retries don't hit the server at the same time
+    delay = backoff * (2 ** attempt)
+    return delay + random.uniform(0, delay)
+
+
+# Shared by every Session, the budget is global to the process
+default_retry_budget = RetryBudget()
@@ -2,6 +2,8 @@
 from core.settings.base import CREA_LOGIN_URL, CREA_PASSWORD, CREA_USERNAME
 from decouple import config
 
+from .rets_lib.transport import default_retry_budget
+
 s3_reader = config(
     "SAVE_TO_AWS", default=False, cast=bool
 )  # Enable S3, if Disabled Local file System will be used.
@@ -19,3 +21,55 @@ LISTING_DIR = MEDIA_DIR + "/" + "listings"
 AGENTS_DIR = MEDIA_DIR + "/" + "agents"
 
 LOG_FILENAME = "ddf_task.log"
+
+# Writes the fetched listings with bulk queries (db_bulk_write.py) instead of row by row (db_write.py)
+BULK_WRITE_RECORDS = config("DDF_BULK_WRITE_RECORDS", default=True, cast=bool)
+BULK_WRITE_CHUNK_SIZE = 500  # Number of listings diffed and written together
+BULK_WRITE_BATCH_SIZE = 1000  # Rows per bulk_create/bulk_update query
+
+# RETS requests failing with a connection error, a timeout or a 429/5xx status are retried with a jittered backoff,
+# the retries of the whole process are capped to RETS_RETRY_BUDGET_RATIO of the requests
+RETS_REQUEST_RETRIES = config("DDF_RETS_REQUEST_RETRIES", default=3, cast=int)
+RETS_REQUEST_BACKOFF = 0.5  # Seconds, doubled on every retry
+RETS_REQUEST_TIMEOUT = (10, 300)  # Seconds to connect, seconds between two bytes of the response
+RETS_RETRY_BUDGET_RATIO = 0.2  # Retries allowed per request
+# Every session (DDF sync, metadata refresh...) shares the process wide budget
+default_retry_budget.set_ratio(RETS_RETRY_BUDGET_RATIO)
+
+# Number of RETS search pages requested at the same time, keep it within the RETS session limits
+PAGE_FETCH_CONCURRENCY = config("DDF_PAGE_FETCH_CONCURRENCY", default=4, cast=int)
+PAGE_FETCH_RETRIES = 3  # Retries per failed page
+PAGE_FETCH_BACKOFF = 1  # Seconds, doubled on every retry
+
+# Diffs the children rows of updated listings instead of wiping and re-inserting them
+DIFF_CHILDREN_RECORDS = config("DDF_DIFF_CHILDREN_RECORDS", default=True, cast=bool)
+
+# Number of shards the fetched listings are split into, every shard is written by its own celery task
+# in its own transaction. 1 keeps the single transaction update_db.
+# Shards are spilled next to the disk cache (PROJECT_PATH), the celery workers need to share it.
+INGEST_SHARDS = config("DDF_INGEST_SHARDS", default=1, cast=int)
+
+# An interrupted sync (SyncRun) is resumed by the next fetch_ddf_listings task if it started less than
+# SYNC_RUN_RESUME_HOURS ago and wasn't already resumed SYNC_RUN_MAX_RESUMES times, otherwise it starts over
+SYNC_RUN_RESUME_HOURS = config("DDF_SYNC_RUN_RESUME_HOURS", default=12, cast=int)
+SYNC_RUN_MAX_RESUMES = 3
+
+# Geocodes the written listings in a queued celery task (db_geocode.py) instead of inside the write path
+ASYNC_GEOCODING = config("DDF_ASYNC_GEOCODING", default=True, cast=bool)
+GEOCODE_BATCH_SIZE = 500  # Properties per queued geocoding task
+GEOCODE_CONCURRENCY = config("DDF_GEOCODE_CONCURRENCY", default=4, cast=int)  # Geocoder requests in flight
+GEOCODE_RATE_LIMIT = config("DDF_GEOCODE_RATE_LIMIT", default=5, cast=float)  # Geocoder requests per second, 0 to disable
+
+# Photos transferred at the same time by the PhotoTransfer worker pool (ddf_photo_transfer.py)
+PHOTOS_DOWNLOAD_CONCURRENCY = config("DDF_PHOTOS_DOWNLOAD_CONCURRENCY", default=8, cast=int)
+PHOTOS_DOWNLOAD_BACKOFF = 1  # Seconds, doubled on every retry
+PHOTOS_DOWNLOAD_CHUNK_SIZE = 64 * 1024  # Bytes written per chunk when streaming a photo to disk
+
+# Removed listings photos are purged with S3 delete_objects requests of up to 1000 keys (the S3 maximum)
+PHOTOS_DELETE_BATCH_SIZE = 1000
+PHOTOS_DELETE_CONCURRENCY = 4  # delete_objects/list requests run at the same time
+
+# Photos are hashed while they're transferred, their digests (PhotoDigest) let the next syncs skip identical
+# bytes, send conditional requests and reuse identical photos across listings
+PHOTOS_CONTENT_INDEX = config("DDF_PHOTOS_CONTENT_INDEX", default=True, cast=bool)
+PHOTOS_SPOOL_SIZE = 8 * 1024 * 1024  # Bytes of a photo kept in memory before its S3 upload, larger ones spill to disk
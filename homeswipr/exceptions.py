@@ -37,6 +37,15 @@ class LngAndLatIsNotPassed(APIException):
     default_code = "lng_and_lat_is_not_passed"
 
 
+class BboxAndZoomIsNotPassed(APIException):
+    # Raise this error when a frontend requests the map search
+    # without the bbox and the zoom
+
+    status_code = 400
+    default_detail = "Bbox (west,south,east,north) and zoom is not passed"
+    default_code = "bbox_and_zoom_is_not_passed"
+
+
 class ParameterFormatTypeNotExpected(APIException):
     # Return 400, instead of 500 if the exepcted variable type does not match
     # expected format
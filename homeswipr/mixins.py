@@ -3,15 +3,15 @@ import decimal
 import operator
 
 from core.shortcuts import convert_query_params_to_boolean, get_object_or_403
-from crea_parser.models import Parking, Property, PropertyInfo, PropertyPhoto
+from crea_parser.models import Parking, Property, PropertyInfo, PropertyPhoto, PropertySearchIndex
 from crea_parser.submodels.metadata import PropertyPropertyType, PropertyTransactionType
 from dateutil import parser
 from ddf_manager.ddf_logger import logger
 from django.contrib.gis.db.models.functions import Distance
 from django.contrib.gis.geos import Point
 from django.contrib.gis.measure import D
+from django.contrib.postgres.search import SearchRank, TrigramSimilarity
 from django.db.models import Exists, F, OuterRef, Q, base
-from django.db.models.functions import Coalesce
 from functools import reduce
 from rest_framework import filters
 
@@ -19,6 +19,10 @@ from .exceptions import (
     ParameterFormatTypeNotExpected,
 )
 from .models import UserSavedSearch
+from .utils import PropertyUserState
+
+# Metadata entry id of the "Suite" basement feature
+SUITE_BASEMENT_FEATURE = "22"
 
 
 class PropertyHelperMixin(object):
@@ -33,7 +37,7 @@ class PropertyHelperMixin(object):
         return Property.active_objects.prefetch_related(
             "Address", "Building", "Info", "land", "Photos", "Info__transaction_type",
             "Building__size_interior_unit"
-        ).annotate(general_price=Coalesce("Info__price", "Info__lease"))
+        ).annotate(general_price=F("search_index__general_price"))
 
     def filter_valid_property(self, queryset):
         """
@@ -46,25 +50,50 @@ class PropertyHelperMixin(object):
         )
 
     def filter_property_by_keyword(self, queryset, search_text):
-        # Searches the address, community name based on the search text
-        return queryset.filter(
-            Q(Address__address_line1__icontains=search_text)
-            | Q(Address__address_line2__icontains=search_text)
-            | Q(Address__street_number__icontains=search_text)
-            | Q(Address__street_direction_prefix__icontains=search_text)
-            | Q(Address__street_name__icontains=search_text)
-            | Q(Address__street_suffix__icontains=search_text)
-            | Q(Address__street_direction_suffix__icontains=search_text)
-            | Q(Address__unit_number__icontains=search_text)
-            | Q(Address__box_number__icontains=search_text)
-            | Q(Address__city__icontains=search_text)
-            | Q(Address__postal_code__icontains=search_text)
-            | Q(Address__province__icontains=search_text)
-            | Q(Address__community_name__icontains=search_text)
-            | Q(Address__neighbourhood__icontains=search_text)
-            | Q(Address__subdivision__icontains=search_text)
-            | Q(Info__public_remarks__icontains=search_text)
-        ).distinct()
+        """
+        Searches the address, community name and remarks based on the search text.
+
+        A property matches if every typed word prefixes a word of its search document
+        (full text, GIN indexed), or if the text is a substring of its address or close to it
+        (trigram, GIN indexed). Annotates `search_rank`, address matches rank above remarks matches.
+        Shared by the property list, nearby homes and the saved search emails.
+        """
+        keyword_filter = self.get_keyword_filter(search_text, "search_index__")
+        if keyword_filter is None:
+            return queryset
+
+        keyword_query, search_rank = keyword_filter
+        return queryset.filter(keyword_query).annotate(search_rank=search_rank)
+
+    def filter_search_index_by_keyword(self, search_index, search_text):
+        """
+        Same match as filter_property_by_keyword on the search index rows, without the rank.
+        Used by the map search.
+        """
+        keyword_filter = self.get_keyword_filter(search_text)
+        if keyword_filter is None:
+            return search_index
+        return search_index.filter(keyword_filter[0])
+
+    def get_keyword_filter(self, search_text, prefix=""):
+        """
+        Returns the (Q, rank expression) of the keyword on the search index fields
+        prefixed with prefix, None if nothing searchable was typed
+        """
+        keyword_search = PropertySearchIndex.get_keyword_search(search_text)
+        if keyword_search is None:
+            return None
+
+        search_query, text = keyword_search
+        keyword_query = (
+            Q(**{f"{prefix}search_vector": search_query})
+            | Q(**{f"{prefix}search_document__contains": text})
+            | Q(**{f"{prefix}search_document__trigram_similar": text})
+        )
+        search_rank = SearchRank(F(f"{prefix}search_vector"), search_query) + TrigramSimilarity(
+            f"{prefix}search_document", text
+        )
+        return keyword_query, search_rank
 
     def check_format_type_decimal_or_bad_request(self, to_check, param_name):
         try:
@@ -251,6 +280,15 @@ class PropertyHelperMixin(object):
 
         return load_more_queryset
 
+    def get_search_index(self):
+        """
+        Gets the search rows of the properties with valid property type,
+        the advance search filters on this single table
+        """
+        return PropertySearchIndex.objects.filter(
+            property_type_pk__in=PropertyPropertyType.get_valid_property_type_as_list()
+        )
+
     def advance_search(self, property_query_set, params):
         search_text = params.get("search_text", "")
 
@@ -271,6 +309,19 @@ class PropertyHelperMixin(object):
 
         # NOTE: Remember that querysets are lazy!
         # These filters are not run until the queryset is evaluated
+        # Every filter runs on the search index, the properties are
+        # matched against it at the end so no join fans out (no DISTINCT needed)
+        search_index = self.filter_search_index(self.get_search_index(), params)
+
+        return property_query_set.filter(
+            pk__in=search_index.values("connected_property_id")
+        )
+
+    def filter_search_index(self, search_index, params):
+        """
+        Applies the advance search filters of the params to the search index rows,
+        shared by the advance search and the map search
+        """
 
         # Price range part
         lower_boundary_price_range = params.get("lower_boundary_price_range", None)
@@ -281,7 +332,7 @@ class PropertyHelperMixin(object):
                 lower_boundary_price_range, "lower_boundary_price_range"
             )
 
-            property_query_set = property_query_set.filter(
+            search_index = search_index.filter(
                 general_price__gte=lower_boundary_price_range
             )
 
@@ -289,7 +340,7 @@ class PropertyHelperMixin(object):
             upper_boundary_price_range = self.check_format_type_decimal_or_bad_request(
                 upper_boundary_price_range, "upper_boundary_price_range"
             )
-            property_query_set = property_query_set.filter(
+            search_index = search_index.filter(
                 general_price__lte=upper_boundary_price_range
             )
 
@@ -300,8 +351,8 @@ class PropertyHelperMixin(object):
             least_amount_of_bedroom = self.check_format_type_integer_or_bad_request(
                 least_amount_of_bedroom, "least_amount_of_bedroom"
             )
-            property_query_set = property_query_set.filter(
-                Building__bedrooms_total__gte=least_amount_of_bedroom
+            search_index = search_index.filter(
+                bedrooms_total__gte=least_amount_of_bedroom
             )
 
         least_amount_of_bathroom = params.get("least_amount_of_bathroom", 0)
@@ -310,8 +361,8 @@ class PropertyHelperMixin(object):
             least_amount_of_bathroom = self.check_format_type_integer_or_bad_request(
                 least_amount_of_bathroom, "least_amount_of_bathroom"
             )
-            property_query_set = property_query_set.filter(
-                Building__bathroom_total__gte=least_amount_of_bathroom
+            search_index = search_index.filter(
+                bathroom_total__gte=least_amount_of_bathroom
             )
 
         # If an ownership type is passed
@@ -323,15 +374,15 @@ class PropertyHelperMixin(object):
                     ownership_id, "ownership_ids"
                 )
 
-            property_query_set = property_query_set.filter(
-                    Info__ownership_type__metadata_entry_id__in=ownership_type_ids
-                )
+            search_index = search_index.filter(
+                ownership_type_entry_id__in=[str(ownership_id) for ownership_id in ownership_type_ids]
+            )
 
         # If a transaction type is passed
         transaction_type_id_list = params.get("transaction_type_id_list", None)
         if transaction_type_id_list:
-            property_query_set = property_query_set.filter(
-                Info__transaction_type__metadata_entry_id__in=transaction_type_id_list
+            search_index = search_index.filter(
+                transaction_type_entry_id__in=[str(transaction_type_id) for transaction_type_id in transaction_type_id_list]
             )
 
         # If community search text is passed
@@ -339,11 +390,11 @@ class PropertyHelperMixin(object):
         if community_list_search_text:
 
             # NOTE: This allows dynamic number of community to be filtered
-            community_name_filter = reduce(operator.or_, (Q(Address__community_name__icontains = item) for item in community_list_search_text))
-            neighbourhood_filter = reduce(operator.or_, (Q(Address__neighbourhood__icontains = item) for item in community_list_search_text))
-            subdvision_filter = reduce(operator.or_, (Q(Address__subdivision__icontains = item) for item in community_list_search_text))
+            community_name_filter = reduce(operator.or_, (Q(community_name__icontains = item) for item in community_list_search_text))
+            neighbourhood_filter = reduce(operator.or_, (Q(neighbourhood__icontains = item) for item in community_list_search_text))
+            subdvision_filter = reduce(operator.or_, (Q(subdivision__icontains = item) for item in community_list_search_text))
 
-            property_query_set = property_query_set.filter(
+            search_index = search_index.filter(
                 community_name_filter
                 | neighbourhood_filter
                 | subdvision_filter
@@ -352,8 +403,8 @@ class PropertyHelperMixin(object):
         # If city text is passed
         city_list = params.get("city_list", [])
         if city_list:
-            city_list_filter = reduce(operator.or_, (Q(Address__city__icontains = item) for item in city_list))
-            property_query_set = property_query_set.filter(
+            city_list_filter = reduce(operator.or_, (Q(city__icontains = item) for item in city_list))
+            search_index = search_index.filter(
                 city_list_filter
             )
 
@@ -362,9 +413,7 @@ class PropertyHelperMixin(object):
         if has_video is not None:
             has_video = convert_query_params_to_boolean(has_video)
             if has_video:
-                property_query_set = property_query_set.exclude(
-                    Q(alternate_url__video_link=None) | Q(alternate_url__video_link="")
-                )
+                search_index = search_index.filter(has_video=True)
 
         # Creation date filters
         from_creation_date = params.get("from_creation_date", None)
@@ -374,7 +423,7 @@ class PropertyHelperMixin(object):
             from_creation_date = self.check_format_type_date_or_bad_request(
                 from_creation_date, "from_creation_date"
             )
-            property_query_set = property_query_set.filter(
+            search_index = search_index.filter(
                 creation_date__gte=from_creation_date
             )
 
@@ -383,7 +432,7 @@ class PropertyHelperMixin(object):
                 until_creation_date, "unil_creation_date"
             )
 
-            property_query_set = property_query_set.filter(
+            search_index = search_index.filter(
                 creation_date__lte=until_creation_date
             )
 
@@ -400,38 +449,43 @@ class PropertyHelperMixin(object):
                 until_listing_contract_date, "until_listing_contract_date"
             )
 
-            property_query_set = property_query_set.filter(
-                Info__listing_contract_date__gte=from_listing_contract_date,
-                Info__listing_contract_date__lte=until_listing_contract_date,
+            search_index = search_index.filter(
+                listing_contract_date__gte=from_listing_contract_date,
+                listing_contract_date__lte=until_listing_contract_date,
             )
 
         # Parking type filters
         parking_type_ids = params.get("parking_type_ids", [])
 
         if parking_type_ids:
-            for parking_type_id in parking_type_ids:
-                parking_type_id = self.check_format_type_integer_or_bad_request(
+            parking_type_ids = [
+                self.check_format_type_integer_or_bad_request(
                     parking_type_id, "parking_type_ids"
                 )
+                for parking_type_id in parking_type_ids
+            ]
 
-            property_query_set = property_query_set.filter(
-                Parking__name__in=parking_type_ids
+            search_index = search_index.filter(
+                parking_type_pks__overlap=parking_type_ids
             )
 
         # Zoning Filters
         zoning_keyword = params.get("zoning_keyword", None)
 
         if zoning_keyword:
-            property_query_set = property_query_set.filter(
-                Info__zoning_description__icontains=zoning_keyword
+            search_index = search_index.filter(
+                zoning_description__icontains=zoning_keyword
             )
 
         # Property Type Filter
         property_type = params.get("property_type", None)
 
         if property_type:
-            property_query_set = property_query_set.filter(
-                Info__property_type__icontains=property_type
+            property_type = self.check_format_type_integer_or_bad_request(
+                property_type, "property_type"
+            )
+            search_index = search_index.filter(
+                property_type_pk=property_type
             )
 
         # Year Built filters
@@ -442,20 +496,16 @@ class PropertyHelperMixin(object):
             year_built = int(year_built)
             # check condition
             if year_built_condition == "exact":
-                property_query_set = property_query_set.filter(
-                    Building__constructed_date__year=year_built
+                search_index = search_index.filter(
+                    constructed_year=year_built
                 )
             elif year_built_condition == "before":
-                property_query_set = property_query_set.filter(
-                    Building__constructed_date__year__lte=year_built
-                )
-            elif year_built_condition == "after":
-                property_query_set = property_query_set.filter(
-                    Building__constructed_date__year__gte=year_built
+                search_index = search_index.filter(
+                    constructed_year__lte=year_built
                 )
             else:
-                property_query_set = property_query_set.filter(
-                    Building__constructed_date__year__gte=year_built
+                search_index = search_index.filter(
+                    constructed_year__gte=year_built
                 )
 
         # Size Filters
@@ -463,78 +513,101 @@ class PropertyHelperMixin(object):
         size_unit_type = params.get("size_unit_type", None)
         if not size_unit_type and size:
             if size.isnumeric():
-                property_query_set = property_query_set.filter(
-                    Q(land__size_total__gte=size) |
-                    Q(land__size_frontage__gte=size)
+                search_index = search_index.filter(
+                    Q(size_total__gte=size) |
+                    Q(size_frontage__gte=size)
                 )
             else:
-                property_query_set = property_query_set.filter(
-                    land__size_total_text__icontains=size
+                search_index = search_index.filter(
+                    size_total_text__icontains=size
                 )
         elif size and size_unit_type:
-            property_query_set = property_query_set.filter(
-                Q(land__size_total__gte=size) &
-                Q(land__size_total_unit__metadata_entry_id__in=size_unit_type)
+            search_index = search_index.filter(
+                size_total__gte=size,
+                size_total_unit_entry_id=size_unit_type,
             )
 
         # Building Type Filters
         building_type_list = params.get("building_type_list", [])
         if building_type_list:
-            property_query_set = property_query_set.filter(
-                Building__model_type__metadata_entry_id__in=building_type_list
+            search_index = search_index.filter(
+                building_type_entry_ids__overlap=[str(item) for item in building_type_list]
             )
 
         # Basement Type Filters
         basement_type = params.get("basement_type_list", None)
         if basement_type:
-            property_query_set = property_query_set.filter(
-                Building__basement_type__metadata_entry_id__in=basement_type
+            search_index = search_index.filter(
+                basement_type_entry_ids__overlap=[str(item) for item in basement_type]
             )
 
         # Has Garage Filters
         has_garage = params.get("has_garage", None)
         if has_garage:
             if has_garage == "Garage":
-                property_query_set = property_query_set.filter(
-                    Q(Parking__name=1) |
-                    Q(Parking__name=2) |
-                    Q(Parking__name=3) |
-                    Q(Parking__name=4) |
-                    Q(Parking__name=37)
+                search_index = search_index.filter(
+                    parking_type_pks__overlap=[
+                        Parking.ATTACHED_GARAGE,
+                        Parking.INTEGRATED_GARAGE,
+                        Parking.DETACHED_GARAGE,
+                        Parking.GARAGE,
+                        Parking.HEATED_GARAGE,
+                    ]
                 )
             else:
-                property_query_set = property_query_set.filter(
-                    Q(Parking__name=13) |
-                    Q(Parking__name=15)
+                search_index = search_index.filter(
+                    parking_type_pks__overlap=[Parking.NONE, Parking.NO_GARAGE]
                 )
 
         # Has Suite Filters
         has_suite = params.get("has_suite", None)
         if has_suite:
             if has_suite == "Suite":
-                property_query_set = property_query_set.filter(
-                    Building__basement_features__metadata_entry_id=22
+                search_index = search_index.filter(
+                    basement_feature_entry_ids__contains=[SUITE_BASEMENT_FEATURE]
                 )
             else:
-                property_query_set = property_query_set.exclude(
-                    Building__basement_features__metadata_entry_id=22
+                search_index = search_index.exclude(
+                    basement_feature_entry_ids__contains=[SUITE_BASEMENT_FEATURE]
                 )
 
         # Architectural Style
         architectural_style = params.get("architectural_style", None)
         if architectural_style:
-            property_query_set = property_query_set.filter(
-                Building__architectural_style__metadata_entry_id__in=architectural_style
+            search_index = search_index.filter(
+                architectural_style_entry_ids__overlap=[str(item) for item in architectural_style]
             )
 
         # Listing Type Style
         listing_type = params.get("listing_type", None)
         if listing_type:
-            property_query_set = property_query_set.filter(
-                Info__listing_type=listing_type
+            search_index = search_index.filter(
+                listing_type=listing_type
             )
 
-        return property_query_set
+        return search_index
+
+
+class PropertyUserStateMixin(object):
+    """
+    Resolves the favorites and bookings of the request user on the page being serialized,
+    one query per table instead of one per property (see PropertyUserState).
+    Put it before the GenericViewSet so it wraps its get_serializer.
+    """
+
+    def get_serializer(self, *args, **kwargs):
+        if args:
+            instance = args[0]
+            items = instance if kwargs.get("many", False) else [instance]
+            property_pks = PropertyUserState.get_property_pks(items)
+
+            if property_pks:
+                context = kwargs.setdefault("context", self.get_serializer_context())
+                context[PropertyUserState.CONTEXT_KEY] = PropertyUserState(
+                    self.request.user
+                ).resolve(property_pks)
+
+        return super().get_serializer(*args, **kwargs)
 
 
 class FavoriteHelperMixin(object):
@@ -19,6 +19,7 @@ from crea_parser.models import (
     Property,
     PropertyInfo,
     PropertyPhoto,
+    PropertySearchIndex,
     Room,
     Utility,
     Website,
@@ -55,6 +56,7 @@ from .models import (
     Agent,
     LawFirm
 )
+from .utils import PropertyUserState
 
 
 class BrokerageSerializer(serializers.ModelSerializer):
@@ -482,41 +484,17 @@ class PropertySerializer(serializers.ModelSerializer):
         return data
 
     def get_is_favorited(self, instance):
-        if self.context["request"].user.is_authenticated:
-            exists = get_object_or_None(
-                PropertyFavorite.active_objects,
-                user=self.context["request"].user,
-                favorited_property=instance,
-            )
-            if exists:
-                return True
-        return False
+        # The favorites of the page are resolved once, see PropertyUserState
+        return PropertyUserState.from_context(self.context).get_favorite_pk(instance) is not None
 
     def get_favorite_instance_pk(self, instance):
         # Get the favorite pk to reuse the  delete api
         # on favorite viewset
-        if self.context["request"].user.is_authenticated:
-            favorite_instance = get_object_or_None(
-                PropertyFavorite.active_objects,
-                user=self.context["request"].user,
-                favorited_property=instance,
-            )
-            if favorite_instance:
-                return favorite_instance.pk
-        return None
+        return PropertyUserState.from_context(self.context).get_favorite_pk(instance)
 
     def get_booking_status(self, instance):
         # Property identifier if is booked by the logged user
-        if self.context["request"].user.is_authenticated:
-            user = self.context.get("request").user
-            booking = instance.booked_property.filter(booking_client__user__id=user.id)
-            if booking:
-                return {
-                    "is_approved": booking[0].is_approved,
-                    "is_pending": booking[0].is_pending,
-                    "is_cancel": True if booking[0].date_canceled else False,
-                }
-        return None
+        return PropertyUserState.from_context(self.context).get_booking_status(instance)
 
 
 class BusinessSerializer(serializers.ModelSerializer):
@@ -578,17 +556,7 @@ class PropertyExpandedSerializer(serializers.ModelSerializer):
         fields = "__all__"
 
     def get_is_favorited(self, instance):
-
-        if self.context["request"].user.is_authenticated:
-            exists = get_object_or_None(
-                PropertyFavorite.active_objects,
-                user=self.context["request"].user,
-                favorited_property=instance,
-            )
-
-            if exists:
-                return True
-        return False
+        return PropertyUserState.from_context(self.context).get_favorite_pk(instance) is not None
 
     def get_is_authenticated(self, instance):
         return self.context["request"].user.is_authenticated
@@ -596,15 +564,7 @@ class PropertyExpandedSerializer(serializers.ModelSerializer):
     def get_favorite_instance_pk(self, instance):
         # Get the favorite pk to reuse the  delete api
         # on favorite viewset
-        if self.context["request"].user.is_authenticated:
-            favorite_instance = get_object_or_None(
-                PropertyFavorite.active_objects,
-                user=self.context["request"].user,
-                favorited_property=instance,
-            )
-            if favorite_instance:
-                return favorite_instance.pk
-        return None
+        return PropertyUserState.from_context(self.context).get_favorite_pk(instance)
 
     def create(self, validated_data):
         validated_data_address = validated_data.get('Address', None)
@@ -776,24 +736,14 @@ class PropertyExpandedSerializer(serializers.ModelSerializer):
 
                         if phone_number:
                             Phone.objects.create(text=phone_number,agent=agent)
+
+            PropertySearchIndex.refresh([property_instance.pk])
         except Exception as e:
             raise serializers.ValidationError(f'Issue encountered: {e}')
 
         return property_instance
 
 
-class AddressAutoCompleteSerializer(serializers.ModelSerializer):
-
-    Address = AddressSerializer(read_only=True)
-
-    full_address = serializers.CharField(max_length=255)
-
-    class Meta:
-        model = Property
-        # TODO: Specify fields in the future once UI is defined
-        fields = ("Address", "full_address")
-
-
 class PropertyFavoriteSerializer(serializers.ModelSerializer):
 
     favorite_type = serializers.CharField(default="Property", read_only=True)
@@ -1,7 +1,7 @@
 import math, requests
 
 from core.celery import app
-from core.utils import TaskLock
+from core.utils import AutoCompleteIndex, TaskLock
 from datetime import datetime
 from crea_parser.models import Property, Address
 from core.mixins import FrontendUrlConstructionMixin
@@ -35,15 +35,15 @@ class EmailUserSavedSearchTask(PropertyHelperMixin, FrontendUrlConstructionMixin
 
         for saved_search in saved_searches:
             final_params = self.construct_advance_search_parameters(saved_search.pk)
-            base_property_queryset = self.filter_valid_property(
-                self.get_base_property()
+            # The valid property types are filtered by the search index in advance_search
+            queryset = self.filter_property_by_keyword(
+                self.get_base_property(), final_params.get("search_text", "")
             )
-
-            queryset = self.advance_search(base_property_queryset, final_params)
+            queryset = self.advance_search(queryset, final_params)
 
             to_email_properties = queryset.filter(
                 creation_date__gt=saved_search.last_checked_date
-            ).order_by("-pk").distinct()
+            ).order_by("-pk")
 
             if to_email_properties.count() >= 10:
                 to_email_properties = to_email_properties[:10]
@@ -122,6 +122,28 @@ def cache_listing_counts(cache_key):
     cache_listings_count.release_lock()
 
 
+@app.task
+def rebuild_auto_complete_index():
+    # Rebuilds the typeahead index of the address and community auto complete from the database
+
+    timeout_seconds = 30 * 60
+
+    rebuild_lock = TaskLock(key="rebuild_auto_complete_index", timeout=timeout_seconds)
+    rebuild_lock.check_and_acquire_lock()
+
+    if not rebuild_lock.lock_acquired:
+        logger.error("Lock wasn't acquired, ignored task to prevent running duplicate of auto complete index rebuild...")
+        return
+
+    try:
+        return AutoCompleteIndex().rebuild()
+    except Exception as e:
+        logger.error(e)
+        logger.error("Error in rebuilding the auto complete index")
+    finally:
+        rebuild_lock.release_lock()
+
+
 @app.task
 def pre_warm_endpoints():
     """
@@ -7,11 +7,13 @@ from crea_parser.tests.factories.parking import ParkingFactory
 from crea_parser.tests.factories.property import PropertyFactory
 from crea_parser.submodels.metadata import PropertyParkingType, PropertyTransactionType, PropertyOwnershipType, PropertyPropertyType
 from core.shortcuts import get_object_or_None
+from core.utils import AutoCompleteIndex
 from django.contrib.gis.geos import Point
 from django.urls import reverse
 from django.utils import timezone
 from faker import Faker
 from homeswipr.models import UserSavedSearch
+from homeswipr.tests.factories.property_favorite import PropertyFavoriteFactory
 from homeswipr.tests.factories.user_saved_search import UserSavedSearchFactory
 from rest_framework import status
 from users.models import UserHistory
@@ -73,6 +75,22 @@ class PropertyTestCases(PropertyCoreBaseTest):
         response = self.client.get(reverse(self.get_list_url()), {})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_get_property_list_with_favorites_succeeds(self, *args, **kwargs):
+        favorite = PropertyFavoriteFactory(user=self.active_user)
+        other_property = PropertyFactory()
+
+        self.login_active_user()
+
+        response = self.client.get(reverse(self.get_list_url()), {})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        results = {result["id"]: result for result in response.data["results"]}
+        self.assertTrue(results[favorite.favorited_property.pk]["is_favorited"])
+        self.assertEqual(results[favorite.favorited_property.pk]["favorite_instance_pk"], favorite.pk)
+        self.assertFalse(results[other_property.pk]["is_favorited"])
+        self.assertIsNone(results[other_property.pk]["favorite_instance_pk"])
+        self.assertIsNone(results[other_property.pk]["booking_status"])
+
     def test_get_property_list_with_saved_search_succeeds_and_checked_date_changes(
         self, *args, **kwargs
     ):
@@ -1305,6 +1323,7 @@ class AutoCompleteTestCases(PropertyCoreBaseTest):
         # This should avoid things like producing an address with faker that's the same with self
         unique_string = str(uuid.uuid4())
         PropertyFactory(address__address_line1=unique_string)
+        AutoCompleteIndex().rebuild()
         response = self.client.get(
             reverse(self.get_custom_action_url(self.extended_name)),
             data={"search_text": unique_string},
@@ -1312,6 +1331,25 @@ class AutoCompleteTestCases(PropertyCoreBaseTest):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data["count"], 1)
 
+    def test_auto_complete_short_prefix_ranks_every_match(self, *args, **kwargs):
+        # The term with the most listings is lexically last, out of reach of the scan
+        auto_complete_index = AutoCompleteIndex(scan_limit=2)
+        auto_complete_index.rebuild(
+            terms={
+                AutoCompleteIndex.CITY: {
+                    ("maple", "Maple"): 1,
+                    ("markham", "Markham"): 2,
+                    ("mississauga", "Mississauga"): 30,
+                }
+            }
+        )
+        for prefix in ("m", "M", "mi"):
+            results = auto_complete_index.search(AutoCompleteIndex.CITY, prefix, limit=1)
+            self.assertEqual(results, [{"text": "Mississauga", "listing_count": 30}])
+
+        results = auto_complete_index.search(AutoCompleteIndex.CITY, "ma")
+        self.assertEqual([result["text"] for result in results], ["Markham", "Maple"])
+
 
 class CountResultTestCases(PropertyCoreBaseTest):
     """
@@ -1899,3 +1937,45 @@ class NearbyHomesTestCases(PropertyCoreBaseTest):
         )
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data["count"], 17)
+
+
+class MapSearchTestCases(PropertyCoreBaseTest):
+    """
+    Test cases of the map search clusters and pins
+    """
+
+    base_name = "property"
+    extended_name = "map-search"
+    bbox = "-113.6,53.4,-113.3,53.7"
+
+    def setUp(self, *args, **kwargs):
+        self.property_one = PropertyFactory(geo_location__coordinates=Point(-113.49, 53.54))
+        self.property_two = PropertyFactory(geo_location__coordinates=Point(-113.48, 53.55))
+        return super().setUp(*args, **kwargs)
+
+    def test_get_map_search_clusters_succeeds(self, *args, **kwargs):
+        response = self.client.get(
+            reverse(self.get_custom_action_url(self.extended_name)),
+            {"bbox": self.bbox, "zoom": 5},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["mode"], "clusters")
+        self.assertEqual(response.data["count"], 2)
+
+    def test_get_map_search_pins_succeeds(self, *args, **kwargs):
+        response = self.client.get(
+            reverse(self.get_custom_action_url(self.extended_name)),
+            {"bbox": "-113.5,53.53,-113.47,53.56", "zoom": 16},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["mode"], "pins")
+        self.assertEqual(
+            sorted(pin["pk"] for pin in response.data["results"]),
+            sorted([self.property_one.pk, self.property_two.pk]),
+        )
+
+    def test_get_map_search_without_bbox_fails(self, *args, **kwargs):
+        response = self.client.get(
+            reverse(self.get_custom_action_url(self.extended_name)), {"zoom": 5}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
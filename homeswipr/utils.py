@@ -1,10 +1,85 @@
+from appointments.models import Booking
 from core.utils import HomeswiprMailer
+from crea_parser.models import Property
 from .constants import (
     Config,
     ClientMessages,
     AgentMessages,
     AdminMessages
 )
+from .models import PropertyFavorite
+
+
+class PropertyUserState(object):
+    """
+    The favorites and bookings of the request user on the serialized properties.
+    A page is resolved with one query per table, the property serializers read it
+    from their context (see PropertyUserStateMixin) instead of querying per property.
+    """
+
+    CONTEXT_KEY = "property_user_state"
+
+    def __init__(self, user):
+        self.user = user
+        self.favorite_pks = {}
+        self.bookings = {}
+        self.resolved_pks = set()
+
+    @classmethod
+    def from_context(cls, context):
+        # Serializers used without the view mixin resolve their property on demand
+        user_state = context.get(cls.CONTEXT_KEY)
+        if user_state is None:
+            user_state = cls(context["request"].user)
+            context[cls.CONTEXT_KEY] = user_state
+        return user_state
+
+    @staticmethod
+    def get_property_pks(items):
+        # Properties, or the favorites nesting them
+        property_pks = []
+        for item in items:
+            if isinstance(item, Property):
+                property_pks.append(item.pk)
+            elif isinstance(item, PropertyFavorite):
+                property_pks.append(item.favorited_property_id)
+        return property_pks
+
+    def resolve(self, property_pks):
+        property_pks = set(property_pks) - self.resolved_pks
+        if not property_pks:
+            return self
+        self.resolved_pks |= property_pks
+
+        if not self.user.is_authenticated:
+            return self
+
+        for property_pk, favorite_pk in (
+            PropertyFavorite.active_objects.filter(user=self.user, favorited_property__in=property_pks)
+            .order_by("pk")
+            .values_list("favorited_property_id", "pk")
+        ):
+            self.favorite_pks.setdefault(property_pk, favorite_pk)
+
+        for booking in Booking.objects.filter(
+            booked_property__in=property_pks, booking_client__user=self.user
+        ).order_by("pk"):
+            self.bookings.setdefault(booking.booked_property_id, booking)
+
+        return self
+
+    def get_favorite_pk(self, instance):
+        return self.resolve([instance.pk]).favorite_pks.get(instance.pk)
+
+    def get_booking_status(self, instance):
+        booking = self.resolve([instance.pk]).bookings.get(instance.pk)
+        if booking:
+            return {
+                "is_approved": booking.is_approved,
+                "is_pending": booking.is_pending,
+                "is_cancel": True if booking.date_canceled else False,
+            }
+        return None
 
 
 def _send_client_notification(instance, email_type, message):
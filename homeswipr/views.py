@@ -1,3 +1,5 @@
+import hashlib
+import json
 import math
 from datetime import timedelta
 
@@ -13,22 +15,22 @@ from core.pagination import (
 )
 from core.permissions import ObjectOwnerPermission, ObjectOwnerPermissionOrUserManager
 from core.shortcuts import convert_query_params_to_boolean
-from core.utils import HomeswiprMailer, PropertyUploadManager, PropertyGeolocationManager
-from crea_parser.models import Property, PropertyInfo, Address, PropertyPhoto, Building, AgentDetails, Geolocation, Land, Phone, Room
+from core.utils import AutoCompleteIndex, HomeswiprMailer, PropertyUploadManager, PropertyGeolocationManager
+from crea_parser import map_tiles
+from crea_parser.models import Property, PropertyInfo, Address, PropertyPhoto, Building, AgentDetails, Geolocation, Land, Phone, Room, PropertySearchIndex
 from crea_parser.submodels.metadata import PropertyPropertyType, PropertyTransactionType, PropertyArchitecturalStyle, PropertyMeasureUnit, PropertyRoomType, PropertyRoomLevel
 from django.contrib.auth import get_user, get_user_model
 from django.contrib.gis.db.models.functions import Distance
 from django.contrib.gis.geos import Point
 from django.contrib.gis.measure import D
 from django.core.cache import cache
-from django.db.models import Max, Q, Count
-from django.db.models.functions import Coalesce
+from django.db.models import Avg, Max, Min, Q, Count
+from django.db.models.functions import Coalesce, Substr
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.utils.formats import number_format
 from homeswipr.serializers import (
-    AddressAutoCompleteSerializer,
     AgentFavoriteSerializer,
     CreatePropertyFavoriteSerializer,
     FrequentlyAskedQuestionSerializer,
@@ -51,8 +53,8 @@ from rest_framework.response import Response
 from users.models import UserHistory
 from users.permissions import IsUserManager, IsAgent
 
-from .exceptions import LngAndLatIsNotPassed
-from .mixins import FavoriteHelperMixin, NullsLastOrderFilterMixin, PropertyHelperMixin
+from .exceptions import BboxAndZoomIsNotPassed, LngAndLatIsNotPassed, ParameterFormatTypeNotExpected
+from .mixins import FavoriteHelperMixin, NullsLastOrderFilterMixin, PropertyHelperMixin, PropertyUserStateMixin
 from .models import (
     AgentFavorite,
     FrequentlyAskedQuestion,
@@ -60,7 +62,7 @@ from .models import (
     PropertyInquiry,
     UserSavedSearch,
 )
-from .tasks import cache_listing_counts
+from .tasks import cache_listing_counts, rebuild_auto_complete_index
 from .permissions import SavedSearchOwnerPermission
 
 from .utils import (
@@ -78,6 +80,7 @@ from .constants import (
 
 
 class GeneralPropertyViewSet(
+    PropertyUserStateMixin,
     NullsLastOrderFilterMixin,
     viewsets.GenericViewSet,
     PropertyHelperMixin,
@@ -193,7 +196,8 @@ class GeneralPropertyViewSet(
         # since we are using a get method
         search_text = final_params.get("search_text", "")
         # Queryset are not run until evaluated
-        queryset = self.get_queryset()
+        # The valid property types are filtered by the search index in advance_search
+        queryset = self.get_base_property()
 
         # Advance Search
         queryset = self.filter_property_by_keyword(queryset, search_text)
@@ -204,6 +208,14 @@ class GeneralPropertyViewSet(
                 creation_date__gt=saved_search_last_check_date
             )
 
+        # The most relevant keyword matches first, unless another ordering is asked
+        if (
+            not self.mls_matched
+            and not self.request.query_params.get("ordering")
+            and PropertySearchIndex.get_keyword_search(search_text) is not None
+        ):
+            self.ordering = "-search_rank"
+
         # ordering filter
         queryset = self.filter_queryset(queryset)
 
@@ -428,54 +440,40 @@ class GeneralPropertyViewSet(
 
         return Response(data=data, status=status.HTTP_200_OK)
 
-    @action(detail=False, methods=["get"], pagination_class=AutoCompleteSetPagination)
-    def address_auto_complete(self, *args, **kwargs):
-        search_text = self.request.query_params.get("search_text", "")
-
-        queryset = self.get_queryset()
+    def get_auto_complete_response(self, kind, search_text):
+        """
+        Answers a typeahead from the redis auto complete index, the property tables aren't queried.
+        The index is rebuilt after every DDF sync, or here if it's missing.
+        """
+        auto_complete_index = AutoCompleteIndex()
+        if not auto_complete_index.is_built():
+            rebuild_auto_complete_index.delay()
 
-        queryset = (
-            queryset.filter(
-                Q(Address__street_address__startswith=search_text)
-                | Q(Address__address_line1__startswith=search_text)
+        try:
+            page_size = min(
+                int(self.request.query_params.get("page_size", AutoCompleteSetPagination.page_size)),
+                AutoCompleteSetPagination.max_page_size,
             )
-            .select_related("Address")
-            .order_by("-last_updated")
-            .distinct()
-        )
+        except ValueError:
+            page_size = AutoCompleteSetPagination.page_size
 
-        page = self.paginate_queryset(queryset)
+        results = auto_complete_index.search(kind, search_text, limit=page_size)
+        return Response({"count": len(results), "next": None, "previous": None, "results": results})
 
-        if page is not None:
-            serializer = AddressAutoCompleteSerializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-
-        serializer = AddressAutoCompleteSerializer(queryset, many=True)
-        return Response(serializer.data)
+    @action(detail=False, methods=["get"])
+    def address_auto_complete(self, *args, **kwargs):
+        search_text = self.request.query_params.get("search_text", "")
+        return self.get_auto_complete_response(AutoCompleteIndex.ADDRESS, search_text)
 
-    @action(detail=False, methods=["get"], pagination_class=AutoCompleteSetPagination)
+    @action(detail=False, methods=["get"])
     def community_auto_complete(self, *args, **kwargs):
         community_search = self.request.query_params.get("community_search", "")
+        return self.get_auto_complete_response(AutoCompleteIndex.COMMUNITY, community_search)
 
-        queryset = self.get_queryset()
-
-        queryset = (
-            queryset.filter(
-                Address__community_name__startswith=community_search
-            )
-            .select_related("Address")
-            .order_by("-last_updated")
-            .distinct()
-        )
-
-        page = self.paginate_queryset(queryset)
-
-        if page is not None:
-            serializer = AddressAutoCompleteSerializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-
-        serializer = AddressAutoCompleteSerializer(queryset, many=True)
-        return Response(serializer.data)
+    @action(detail=False, methods=["get"])
+    def city_auto_complete(self, *args, **kwargs):
+        city_search = self.request.query_params.get("city_search", "")
+        return self.get_auto_complete_response(AutoCompleteIndex.CITY, city_search)
 
     @action(detail=False, methods=["get"], pagination_class=NearbyListingsSetPagination)
     def nearby_homes(self, *args, **kwargs):
@@ -518,6 +516,160 @@ class GeneralPropertyViewSet(
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
 
+    @action(detail=False, methods=["get"])
+    def map_search(self, *args, **kwargs):
+        """
+        The listings of the map viewport, clusters (count, centroid and price range) below
+        map_tiles.PINS_MIN_ZOOM and individual pins from it.
+
+        Required Params:
+            bbox - west,south,east,north of the viewport in degrees
+            zoom - The map zoom level
+
+        Optional Params:
+            The params of the advance search (see list), and saved_search_pk
+
+        The viewport is covered by geohash tiles, the response of every tile is cached
+        until a listing of the tile changes (see PropertySearchIndex.refresh).
+        The clusters and pins of the edge tiles can be outside the viewport.
+        """
+        bbox = self.request.query_params.get("bbox", None)
+        zoom = self.request.query_params.get("zoom", None)
+
+        if bbox is None or zoom is None:
+            raise BboxAndZoomIsNotPassed
+
+        try:
+            west, south, east, north = [float(value) for value in bbox.split(",")]
+        except ValueError:
+            raise ParameterFormatTypeNotExpected(param_name="bbox", var_type="west,south,east,north")
+        zoom = self.check_format_type_integer_or_bad_request(zoom, "zoom")
+
+        final_params = self.construct_advance_search_parameters(
+            self.request.query_params.get("saved_search_pk", None)
+        )
+        search_index = self.filter_search_index(self.get_search_index(), final_params)
+        search_index = self.filter_search_index_by_keyword(
+            search_index, final_params.get("search_text", "")
+        ).exclude(geohash="")
+
+        show_pins = zoom >= map_tiles.PINS_MIN_ZOOM
+        cells, precision = map_tiles.get_covering_cells(
+            west, south, east, north, map_tiles.get_tile_precision(zoom)
+        )
+
+        # The filters are part of the cache key, the tile version invalidates it
+        filters_hash = hashlib.md5(
+            json.dumps(final_params, sort_keys=True, default=str).encode()
+        ).hexdigest()
+        mode = "pins" if show_pins else f"clusters{map_tiles.get_cluster_precision(precision)}"
+        cache_keys = {
+            cell: f"map_tile:{mode}:{cell}:{version}:{filters_hash}"
+            for cell, version in map_tiles.get_tile_versions(cells).items()
+        }
+        cached_tiles = cache.get_many(list(cache_keys.values()))
+
+        tiles = {}
+        missing_cells = []
+        for cell, cache_key in cache_keys.items():
+            if cache_key in cached_tiles:
+                tiles[cell] = cached_tiles[cache_key]
+            else:
+                missing_cells.append(cell)
+
+        if missing_cells:
+            if show_pins:
+                fresh_tiles = self.get_map_pins(search_index, missing_cells)
+            else:
+                fresh_tiles = self.get_map_clusters(
+                    search_index, missing_cells, map_tiles.get_cluster_precision(precision)
+                )
+            cache.set_many(
+                {cache_keys[cell]: items for cell, items in fresh_tiles.items()},
+                map_tiles.TILE_CACHE_TIMEOUT,
+            )
+            tiles.update(fresh_tiles)
+
+        results = [item for cell in cells for item in tiles[cell]]
+        if show_pins:
+            count = len(results)
+        else:
+            count = sum(cluster["count"] for cluster in results)
+
+        return Response(
+            data={
+                "zoom": zoom,
+                "precision": precision,
+                "mode": "pins" if show_pins else "clusters",
+                "count": count,
+                "results": results,
+            },
+            status=status.HTTP_200_OK,
+        )
+
+    def get_map_clusters(self, search_index, cells, cluster_precision):
+        """
+        Returns {cell: clusters} of the tiles, a cluster per geohash of the cluster
+        precision with one grouped query for every tile
+        """
+        tile_filter = Q()
+        for cell in cells:
+            tile_filter |= Q(geohash__startswith=cell)
+
+        clusters = (
+            search_index.filter(tile_filter)
+            .annotate(cluster=Substr("geohash", 1, cluster_precision))
+            .values("cluster")
+            .annotate(
+                count=Count("pk"),
+                latitude=Avg("latitude"),
+                longitude=Avg("longitude"),
+                min_price=Min("general_price"),
+                max_price=Max("general_price"),
+            )
+            .order_by("cluster")
+        )
+
+        tiles = {cell: [] for cell in cells}
+        precision = len(cells[0])
+        for cluster in clusters:
+            tiles[cluster["cluster"][:precision]].append(
+                {
+                    "geohash": cluster["cluster"],
+                    "count": cluster["count"],
+                    "latitude": cluster["latitude"],
+                    "longitude": cluster["longitude"],
+                    "min_price": cluster["min_price"],
+                    "max_price": cluster["max_price"],
+                }
+            )
+        return tiles
+
+    def get_map_pins(self, search_index, cells):
+        """
+        Returns {cell: pins} of the tiles, at most map_tiles.MAX_PINS_PER_TILE per tile
+        """
+        tiles = {}
+        for cell in cells:
+            tiles[cell] = [
+                {
+                    "pk": pin["connected_property_id"],
+                    "listing_id": pin["listing_id"],
+                    "latitude": pin["latitude"],
+                    "longitude": pin["longitude"],
+                    "general_price": pin["general_price"],
+                    "bedrooms_total": pin["bedrooms_total"],
+                    "bathroom_total": pin["bathroom_total"],
+                }
+                for pin in search_index.filter(geohash__startswith=cell)
+                .order_by("-creation_date", "pk")
+                .values(
+                    "connected_property_id", "listing_id", "latitude", "longitude",
+                    "general_price", "bedrooms_total", "bathroom_total",
+                )[:map_tiles.MAX_PINS_PER_TILE]
+            ]
+        return tiles
+
     @action(detail=False, methods=["get"])
     def propz_houses(self, *args, **kwargs):
         queryset = self.get_queryset()
@@ -562,6 +714,7 @@ class GeneralPropertyViewSet(
                 photo.save()
                 photo_list.append(photo)
             count = count + 1
+        PropertySearchIndex.refresh([assigned_property.pk])
         serializer = PropertyPhotoSerializer(photo_list, many=True)
         return Response(serializer.data)
 
@@ -574,6 +727,7 @@ class GeneralPropertyViewSet(
         )
         property_to_hide.is_active = False
         property_to_hide.save()
+        PropertySearchIndex.remove([property_to_hide.pk])
 
         serializer = PropertyOnlySerializer(property_to_hide)
         return Response(serializer.data)
@@ -744,6 +898,8 @@ class GeneralPropertyViewSet(
                             agent=agent
                         )
 
+        PropertySearchIndex.refresh([property_to_update.pk])
+
         return Response(serializer.data)
 
     @action(detail=True, methods=["post"])
@@ -758,6 +914,7 @@ class GeneralPropertyViewSet(
         PropertyPhoto.objects.filter(
             connected_property=property_to_update
         ).delete()
+        PropertySearchIndex.refresh([property_to_update.pk])
         serializer = PropertyOnlySerializer(property_to_update)
         return Response(serializer.data)
 
@@ -791,6 +948,7 @@ class GeneralPropertyViewSet(
         )
         property_to_unhide.is_active = True
         property_to_unhide.save()
+        PropertySearchIndex.refresh([property_to_unhide.pk])
 
         serializer = PropertyOnlySerializer(property_to_unhide)
         return Response(serializer.data)
@@ -832,6 +990,7 @@ class GeneralPropertyViewSet(
 
 
 class MyFavoritePropertyViewSet(
+    PropertyUserStateMixin,
     viewsets.GenericViewSet,
     FavoriteHelperMixin,
     ListModelMixin,
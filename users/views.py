@@ -15,7 +15,7 @@ from django.contrib.auth import get_user_model
 from django.db.models import Max, Q, query
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
-from homeswipr.mixins import FavoriteHelperMixin, PropertyHelperMixin
+from homeswipr.mixins import FavoriteHelperMixin, PropertyHelperMixin, PropertyUserStateMixin
 from homeswipr.models import Property, PropertyFavorite, PropertyInquiry
 from homeswipr.serializers import PropertyFavoriteSerializer, PropertySerializer
 from rest_framework import filters, status, viewsets
@@ -300,6 +300,7 @@ class ReferralViewSet(
 
 
 class HomeswiprUserManagerViewSet(
+    PropertyUserStateMixin,
     viewsets.GenericViewSet,
     RetrieveModelMixin,
     UpdateModelMixin,